@@ -1,15 +1,20 @@
 import streamlit as st
 import time
 import uuid
+import threading
 
-from rag import rag
+from rag import rag, warmup, is_ready
+from profiling import capture
+from singleflight import SingleFlight, normalize_question
 from db import (
     save_conversation,
     save_feedback,
-    get_recent_conversations,
+    search_conversations,
     get_feedback_stats,
 )
 
+HISTORY_PAGE_SIZE = 5
+
 def print_log(message):
     print(message, flush=True)
 
@@ -49,10 +54,27 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+@st.cache_resource
+def start_warmup():
+    # Runs once per process; the page renders while the model and index load
+    print_log("Starting warm-up in the background")
+    thread = threading.Thread(target=warmup, name="warmup", daemon=True)
+    thread.start()
+    return thread
+
+@st.cache_resource
+def get_rag_flight():
+    # Shared by all sessions, so identical questions asked at the same time run the pipeline once
+    return SingleFlight()
+
 def main():
     print_log("Starting the Health Assistant application")
     st.title("🏥 Health Assistant")
 
+    start_warmup()
+    if not is_ready():
+        st.info("The assistant is warming up. Your first answer may take a little longer.")
+
     # Session state initialization
     if "user_input" not in st.session_state:
         st.session_state.user_input = ""
@@ -73,12 +95,21 @@ def main():
 
     if st.session_state.answer_generated:
         print_log(f"User asked: '{st.session_state.user_input}'")
+
+        # Generate a new conversation ID for this Q&A pair
+        conversation_id = str(uuid.uuid4())
+        print_log(f"Generated new conversation ID: {conversation_id}")
+
         with st.spinner("Thinking... 🤔"):
             print_log("Getting answer from assistant...")
             start_time = time.time()
-            answer_data = rag(st.session_state.user_input)
+            question = st.session_state.user_input
+            with capture("rag", conversation_id):
+                answer_data, shared = get_rag_flight().do(normalize_question(question), rag, question)
             end_time = time.time()
             print_log(f"Answer received in {end_time - start_time:.2f} seconds")
+            if shared:
+                print_log("Answer shared with an identical question already in progress")
         
         st.success("Here's what I found:")
         st.markdown(f"**Answer:** {answer_data['answer']}")
@@ -86,18 +117,22 @@ def main():
         # Display monitoring information in an expander
         with st.expander("See details"):
             st.info(f"Response time: {answer_data['response_time']:.2f} seconds")
+            st.info(f"Route: {answer_data['route']}" + (f" ({answer_data['model_used']})" if answer_data['model_used'] else ""))
             st.info(f"Relevance: {answer_data['relevance']}")
             st.info(f"Total tokens: {answer_data['total_tokens']}")
+            stage_timings = answer_data.get("stage_timings", {})
+            if stage_timings:
+                st.info("Stage timings: " + ", ".join(
+                    f"{stage} {duration_ms:.0f} ms" for stage, duration_ms in stage_timings.items()
+                ))
             if answer_data["openai_cost"] > 0:
                 st.info(f"OpenAI cost: ${answer_data['openai_cost']:.4f}")
-
-        # Generate a new conversation ID for this Q&A pair
-        conversation_id = str(uuid.uuid4())
-        print_log(f"Generated new conversation ID: {conversation_id}")
+            if shared:
+                st.info("Answered together with an identical question asked at the same time")
 
         # Save conversation to database
         print_log("Saving conversation to database")
-        save_conversation(conversation_id, st.session_state.user_input, answer_data)
+        save_conversation(conversation_id, st.session_state.user_input, answer_data, shared=shared)
         print_log(f"Conversation saved successfully with ID: {conversation_id}")
 
         # Feedback buttons
@@ -126,21 +161,45 @@ def main():
             st.session_state.answer_generated = False
             st.session_state.user_input = ""
 
-    # Display recent conversations
-    st.subheader("📚 Recent Conversations")
-    relevance_filter = st.selectbox(
-        "Filter by relevance:", ["All", "RELEVANT", "PARTLY_RELEVANT", "NON_RELEVANT"])
-    
-    recent_conversations = get_recent_conversations(
-        limit=5, relevance=relevance_filter if relevance_filter != "All" else None
+    # Browse and search the conversation history, one page at a time
+    st.subheader("📚 Conversation History")
+    col1, col2 = st.columns([2, 1])
+    with col1:
+        search_text = st.text_input("Search questions and answers:", key="history_search",
+                                    placeholder='e.g., "blood pressure" -children')
+    with col2:
+        relevance_filter = st.selectbox(
+            "Filter by relevance:", ["All", "RELEVANT", "PARTLY_RELEVANT", "NON_RELEVANT"])
+
+    # A page is identified by the cursor it starts after; changing a filter starts over
+    history_filters = (search_text, relevance_filter)
+    if st.session_state.get("history_filters") != history_filters:
+        st.session_state.history_filters = history_filters
+        st.session_state.history_cursors = [None]
+    cursors = st.session_state.history_cursors
+
+    conversations, next_cursor = search_conversations(
+        query=search_text or None,
+        relevance=relevance_filter if relevance_filter != "All" else None,
+        limit=HISTORY_PAGE_SIZE,
+        after=cursors[-1],
     )
-    for conv in recent_conversations:
+    if not conversations:
+        st.caption("No conversations found.")
+    for conv in conversations:
         with st.container():
             st.markdown(f"**Q:** {conv['question']}")
             st.markdown(f"**A:** {conv['answer']}")
-            st.caption(f"Relevance: {conv['relevance']}")
+            st.caption(f"Relevance: {conv['relevance']} · {conv['timestamp']:%Y-%m-%d %H:%M}")
             st.markdown("---")
 
+    col1, col2 = st.columns(2)
+    with col1:
+        st.button("← Newer", key="history_newer", disabled=len(cursors) == 1, on_click=cursors.pop)
+    with col2:
+        st.button("Older →", key="history_older", disabled=next_cursor is None,
+                  on_click=cursors.append, args=(next_cursor,))
+
     # Display feedback stats
     st.subheader("📊 Feedback Statistics")
     feedback_stats = get_feedback_stats()
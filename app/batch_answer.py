@@ -0,0 +1,171 @@
+import os
+import sys
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+from tqdm.auto import tqdm
+
+import rag
+import ingest
+
+OUTPUT_COLUMNS = ["answer", "id", "question", "relevance", "explanation"]
+
+
+def read_questions(path):
+    """Read a CSV or JSONL file with a `question` column and an optional `id` column."""
+    if path.endswith(".jsonl"):
+        df = pd.read_json(path, lines=True, dtype={"id": str})
+    else:
+        df = pd.read_csv(path, dtype={"id": str})
+    if "question" not in df.columns:
+        raise ValueError(f"{path} has no 'question' column")
+    if "id" not in df.columns:
+        df["id"] = ""
+    return df[["id", "question"]].fillna("").to_dict(orient="records")
+
+
+def load_checkpoint(path):
+    """Results already answered by a previous run, keyed by input row number."""
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A crash can leave a partially written last line
+                continue
+            done[record["row"]] = record
+    return done
+
+
+def retrieve(questions, batch_size):
+    """Embed questions in batches and search each vector, ahead of the LLM calls."""
+    vectors = ingest.encode_in_batches(rag.model, questions, batch_size=batch_size, desc="Embedding")
+    return [rag.search_by_vector(vector.reshape(1, -1)) for vector in vectors]
+
+
+def answer(row, question, search_results, model, evaluate):
+    # A failed answer or judge call fails the row, so it is not checkpointed and is retried on resume
+    answer_data = rag.rag(
+        question["question"], model=model, search_results=search_results, evaluate=evaluate, raise_errors=True
+    )
+    answer_data.pop("stage_timings", None)
+    return {"row": row, "id": question["id"], "question": question["question"], **answer_data}
+
+
+def grade(records, judge_batch_size):
+    results = rag.evaluate_relevance_batch(
+        [(record["question"], record["answer"]) for record in records], batch_size=judge_batch_size,
+        raise_errors=True,
+    )
+    for record, (relevance, tokens) in zip(records, results):
+        rag.add_relevance(record, relevance, tokens)
+    return records
+
+
+def run(questions, checkpoint_path, model, workers, chunk_size, embed_batch_size, judge_batch_size=1):
+    # Rows are matched by position, so only trust them if the question is unchanged
+    done = {
+        row: record for row, record in load_checkpoint(checkpoint_path).items()
+        if row < len(questions) and record["question"] == questions[row]["question"]
+    }
+    pending = [row for row in range(len(questions)) if row not in done]
+    print(f"{len(done)} of {len(questions)} questions already answered, {len(pending)} to go")
+
+    rag.warmup()
+    failed = 0
+    batch_judge = judge_batch_size > 1
+    with open(checkpoint_path, "a") as checkpoint, ThreadPoolExecutor(max_workers=workers) as executor, \
+            tqdm(total=len(pending), desc="Answering") as progress:
+
+        def save(record):
+            checkpoint.write(json.dumps(record) + "\n")
+            checkpoint.flush()
+            done[record["row"]] = record
+
+        # Chunks bound the number of retrieved contexts held in memory at once
+        for start in range(0, len(pending), chunk_size):
+            rows = pending[start:start + chunk_size]
+            results = retrieve([questions[row]["question"] for row in rows], embed_batch_size)
+            futures = {
+                executor.submit(answer, row, questions[row], search_results, model, not batch_judge): row
+                for row, search_results in zip(rows, results)
+            }
+
+            # With a batched judge, answers are graded in groups as they come in
+            ungraded, judge_futures = [], {}
+            for future in as_completed(futures):
+                progress.update(1)
+                try:
+                    record = future.result()
+                except Exception as e:
+                    print(f"Question {futures[future]} failed: {e}", file=sys.stderr)
+                    failed += 1
+                    continue
+                if not batch_judge:
+                    save(record)
+                    continue
+                ungraded.append(record)
+                if len(ungraded) == judge_batch_size:
+                    judge_futures[executor.submit(grade, ungraded, judge_batch_size)] = ungraded
+                    ungraded = []
+            if ungraded:
+                judge_futures[executor.submit(grade, ungraded, judge_batch_size)] = ungraded
+
+            for future in as_completed(judge_futures):
+                try:
+                    records = future.result()
+                except Exception as e:
+                    print(f"Grading {len(judge_futures[future])} answers failed: {e}", file=sys.stderr)
+                    failed += len(judge_futures[future])
+                    continue
+                for record in records:
+                    save(record)
+    return done, failed
+
+
+def write_output(done, path):
+    records = [done[row] for row in sorted(done)]
+    df = pd.DataFrame(records).rename(columns={"relevance_explanation": "explanation"})
+    df.reindex(columns=OUTPUT_COLUMNS).to_csv(path, index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer and grade a file of questions with the RAG pipeline")
+    parser.add_argument("input", help="CSV or JSONL file with a 'question' column and optionally 'id'")
+    parser.add_argument("--output", default=None, help="Output CSV, defaults to rag-eval-<model>.csv")
+    parser.add_argument("--checkpoint", default=None, help="Defaults to <output>.checkpoint.jsonl")
+    parser.add_argument("--model", default=rag.OPENAI_MODEL)
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent questions in flight")
+    parser.add_argument("--chunk-size", type=int, default=256, help="Questions retrieved ahead of answering")
+    parser.add_argument("--embed-batch-size", type=int, default=ingest.EMBED_BATCH_SIZE)
+    parser.add_argument("--judge-batch-size", type=int, default=rag.JUDGE_BATCH_SIZE,
+                        help="Answers graded per judge call; 1 grades each answer on its own")
+    parser.add_argument("--limit", type=int, default=None, help="Only process the first N questions")
+    args = parser.parse_args()
+
+    output = args.output or f"rag-eval-{args.model}.csv"
+    checkpoint = args.checkpoint or f"{output}.checkpoint.jsonl"
+
+    questions = read_questions(args.input)[:args.limit]
+    done, failed = run(
+        questions, checkpoint, args.model, args.workers, args.chunk_size, args.embed_batch_size,
+        args.judge_batch_size,
+    )
+
+    write_output(done, output)
+    cost = sum(record["openai_cost"] for record in done.values())
+    eval_tokens = sum(record["eval_total_tokens"] for record in done.values())
+    print(f"{len(done)} answers written to {output}, {failed} failed, "
+          f"OpenAI cost ${cost:.4f}, judge tokens {eval_tokens}")
+    if failed:
+        print(f"Run again to retry the failed questions; answered ones are kept in {checkpoint}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
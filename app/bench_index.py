@@ -0,0 +1,141 @@
+import time
+import argparse
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import minsearch
+import minsearch2
+
+VECTOR_DIM = 384
+
+
+def synthetic_text_docs(num_docs, num_categories, rng, vocab_size=20000, doc_length=60):
+    # Zipf-distributed word ids give a realistic long-tailed vocabulary
+    vocab = np.array([f"w{i}" for i in range(vocab_size)])
+    docs = []
+    for i in range(num_docs):
+        words = vocab[np.minimum(rng.zipf(1.2, doc_length), vocab_size) - 1]
+        docs.append({
+            'question': " ".join(words[:12]),
+            'answer': " ".join(words[12:]),
+            'category': f"c{i % num_categories}",
+        })
+    return docs
+
+
+def synthetic_vector_docs(num_docs, num_categories, rng, dim=VECTOR_DIM):
+    matrix = rng.standard_normal((num_docs, dim), dtype=np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    return [
+        {'vector': matrix[i], 'category': f"c{i % num_categories}"}
+        for i in range(num_docs)
+    ]
+
+
+def measure_fit(make_index, docs, trace_memory):
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    index = make_index().fit(docs)
+    fit_seconds = time.perf_counter() - start
+    peak_mb = None
+    if trace_memory:
+        peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    return index, fit_seconds, peak_mb
+
+
+def measure_queries(search, queries):
+    latencies = []
+    start = time.perf_counter()
+    for query in queries:
+        query_start = time.perf_counter()
+        search(query)
+        latencies.append((time.perf_counter() - query_start) * 1000)
+    elapsed = time.perf_counter() - start
+    return {
+        'latency_p50_ms': float(np.percentile(latencies, 50)),
+        'latency_p95_ms': float(np.percentile(latencies, 95)),
+        'throughput_qps': len(queries) / elapsed,
+    }
+
+
+def bench_minsearch(num_docs, args, rng):
+    docs = synthetic_text_docs(num_docs, args.num_categories, rng)
+    index, fit_seconds, peak_mb = measure_fit(
+        lambda: minsearch.Index(['question', 'answer'], ['category']), docs, not args.no_trace_memory
+    )
+    queries = [docs[i]['question'] for i in rng.integers(0, num_docs, args.queries)]
+
+    rows = []
+    for num_results in args.num_results:
+        for filtered in (False, True):
+            filter_dict = {'category': 'c0'} if filtered else {}
+            stats = measure_queries(
+                lambda q: index.search(q, filter_dict=filter_dict, num_results=num_results), queries
+            )
+            rows.append({
+                'index': 'minsearch', 'num_docs': num_docs, 'fit_seconds': fit_seconds,
+                'fit_peak_mb': peak_mb, 'num_results': num_results, 'filtered': filtered, **stats,
+            })
+    return rows
+
+
+def bench_minsearch2(num_docs, args, rng):
+    docs = synthetic_vector_docs(num_docs, args.num_categories, rng, args.dim)
+    index, fit_seconds, peak_mb = measure_fit(
+        lambda: minsearch2.Index(['vector'], ['category']), docs, not args.no_trace_memory
+    )
+    queries = rng.standard_normal((args.queries, args.dim), dtype=np.float32)
+
+    rows = []
+    for num_results in args.num_results:
+        for filtered in (False, True):
+            filter_dict = {'category': 'c0'} if filtered else {}
+            stats = measure_queries(
+                lambda q: index.search({'vector': q}, filter_dict=filter_dict, num_results=num_results),
+                queries,
+            )
+            rows.append({
+                'index': 'minsearch2', 'num_docs': num_docs, 'fit_seconds': fit_seconds,
+                'fit_peak_mb': peak_mb, 'num_results': num_results, 'filtered': filtered, **stats,
+            })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scaling benchmarks for minsearch and minsearch2")
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000",
+                        help="Comma separated corpus sizes")
+    parser.add_argument("--indexes", default="minsearch,minsearch2")
+    parser.add_argument("--num-results", default="1,10,100",
+                        type=lambda s: [int(n) for n in s.split(",")])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--num-categories", type=int, default=100,
+                        help="Distinct keyword values; filtered queries keep 1/N of the corpus")
+    parser.add_argument("--dim", type=int, default=VECTOR_DIM)
+    parser.add_argument("--no-trace-memory", action="store_true",
+                        help="Skip tracemalloc, which slows down fitting large text corpora")
+    parser.add_argument("--output", default="bench_index.csv")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    benches = {'minsearch': bench_minsearch, 'minsearch2': bench_minsearch2}
+
+    rows = []
+    for name in args.indexes.split(","):
+        for num_docs in (int(n) for n in args.sizes.split(",")):
+            print(f"Benchmarking {name} with {num_docs} documents...", flush=True)
+            rows.extend(benches[name](num_docs, args, rng))
+
+    df = pd.DataFrame(rows)
+    df.to_csv(args.output, index=False)
+    print(df.to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import platform
+import resource
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import requests
+
+import fake_openai
+from singleflight import SingleFlight, normalize_question
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+GROUND_TRUTH_PATH = os.path.join(DATA_DIR, "ground-truth-retrieval.csv")
+
+
+class MemoryStore:
+    """In-process stand-in for the Postgres conversation store."""
+
+    def __init__(self):
+        self.conversations = {}
+        self._lock = threading.Lock()
+
+    def save_conversation(self, conversation_id, question, answer_data, timestamp=None, shared=False):
+        with self._lock:
+            self.conversations[conversation_id] = (question, answer_data)
+
+
+class NullStore:
+    def save_conversation(self, conversation_id, question, answer_data, timestamp=None, shared=False):
+        pass
+
+
+def make_store(kind):
+    if kind == "postgres":
+        import db
+        return db
+    if kind == "memory":
+        return MemoryStore()
+    return NullStore()
+
+
+def percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "mean": None}
+    values = np.asarray(values)
+    return {
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "p99": float(np.percentile(values, 99)),
+        "mean": float(values.mean()),
+    }
+
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        return None
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak / 2 ** 20 if platform.system() == "Darwin" else peak / 2 ** 10
+
+
+class Runner:
+    def __init__(self, target, url, store, single_flight=False):
+        self.target = target
+        self.url = url
+        self.store = store
+        self.flight = SingleFlight() if single_flight else None
+        self.session = requests.Session()
+        self.latencies = []
+        self.stages = defaultdict(list)
+        self.errors = 0
+        self._lock = threading.Lock()
+        if target == "inprocess":
+            import rag
+            self.rag = rag
+
+    def ask(self, question, scheduled_at=None):
+        # Closed loop requests start when a worker picks them up; they have no arrival time
+        if scheduled_at is None:
+            scheduled_at = time.perf_counter()
+        try:
+            stage_timings = {}
+            if self.target == "http":
+                response = self.session.post(self.url, json={"question": question}, timeout=120)
+                response.raise_for_status()
+            else:
+                shared = False
+                if self.flight is not None:
+                    answer_data, shared = self.flight.do(normalize_question(question), self.rag.rag, question)
+                else:
+                    answer_data = self.rag.rag(question)
+                # A shared run's stages are counted once, for the request that ran it
+                if not shared:
+                    stage_timings = dict(answer_data.get("stage_timings", {}))
+                write_start = time.perf_counter()
+                self.store.save_conversation(str(uuid.uuid4()), question, answer_data, shared=shared)
+                stage_timings["db_write"] = (time.perf_counter() - write_start) * 1000
+        except Exception as e:
+            print(f"Request failed: {e}", file=sys.stderr)
+            with self._lock:
+                self.errors += 1
+            return
+
+        # In open loop, latency is measured from the scheduled arrival, so queueing delay counts
+        latency_ms = (time.perf_counter() - scheduled_at) * 1000
+        with self._lock:
+            self.latencies.append(latency_ms)
+            for stage, duration_ms in stage_timings.items():
+                self.stages[stage].append(duration_ms)
+
+
+def run(runner, questions, concurrency, rate, num_requests):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        if rate > 0:
+            # Open loop: Poisson arrivals at the requested rate
+            next_arrival = start
+            for i in range(num_requests):
+                next_arrival += random.expovariate(rate)
+                delay = next_arrival - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(runner.ask, questions[i % len(questions)], next_arrival)
+        else:
+            # Closed loop: keep `concurrency` requests in flight, timing each from when it starts
+            for i in range(num_requests):
+                executor.submit(runner.ask, questions[i % len(questions)])
+    return time.perf_counter() - start
+
+
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    regressions = []
+    print(f"\nComparison against {baseline_path}")
+    rows = [("qps", results["qps"], baseline["qps"], False)]
+    rows += [(f"latency_{p}", results["latency_ms"][p], baseline["latency_ms"][p], True) for p in ("p50", "p95", "p99")]
+    for stage, stats in results["stages_ms"].items():
+        if stage in baseline.get("stages_ms", {}):
+            rows.append((f"{stage}_p95", stats["p95"], baseline["stages_ms"][stage]["p95"], True))
+
+    for name, new, old, lower_is_better in rows:
+        if new is None or not old:
+            continue
+        change = (new - old) / old
+        worse = change > tolerance if lower_is_better else change < -tolerance
+        if worse:
+            regressions.append(name)
+        print(f"{name:>24}: {old:10.2f} -> {new:10.2f} ({change:+.1%}){'  REGRESSION' if worse else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the RAG pipeline")
+    parser.add_argument("--target", choices=["inprocess", "http"], default="inprocess")
+    parser.add_argument("--url", default="http://localhost:5000/question", help="HTTP front end for --target http")
+    parser.add_argument("--ground-truth", default=GROUND_TRUTH_PATH)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=0, help="Arrival rate in requests/s; 0 runs closed loop")
+    parser.add_argument("--single-flight", action="store_true",
+                        help="Coalesce identical in-flight questions (inprocess only)")
+    parser.add_argument("--db", choices=["none", "memory", "postgres"], default="memory")
+    parser.add_argument("--fake-llm", action="store_true", help="Serve the OpenAI API from a local fake server")
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--llm-jitter", type=float, default=0.1)
+    parser.add_argument("--llm-token-latency", type=float, default=0.01)
+    parser.add_argument("--llm-completion-tokens", type=int, default=150)
+    parser.add_argument("--output", default=None, help="Write results as JSON to this file")
+    parser.add_argument("--compare", default=None, help="Baseline JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed relative change before flagging")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+
+    if args.fake_llm:
+        config = fake_openai.FakeOpenAIConfig(
+            latency=args.llm_latency,
+            jitter=args.llm_jitter,
+            token_latency=args.llm_token_latency,
+            completion_tokens=args.llm_completion_tokens,
+            answer=json.dumps({"Relevance": "RELEVANT", "Explanation": "Fake judge"}),
+        )
+        _, base_url = fake_openai.start_server(config=config)
+        os.environ["OPENAI_BASE_URL"] = base_url
+        os.environ.setdefault("OPENAI_API_KEY", "fake")
+        # The scheduler would hold the fake server to the real rate limits; read when rag is imported
+        os.environ.setdefault("LLM_SCHEDULER", "0")
+        print(f"Fake OpenAI server on {base_url}")
+
+    questions = pd.read_csv(args.ground_truth)["question"].tolist()
+    random.shuffle(questions)
+
+    runner = Runner(args.target, args.url, make_store(args.db), args.single_flight)
+
+    cpu_start = os.times()
+    wall = run(runner, questions, args.concurrency, args.rate, args.requests)
+    cpu_end = os.times()
+    cpu_seconds = (cpu_end.user - cpu_start.user) + (cpu_end.system - cpu_start.system)
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+        "requests": args.requests,
+        "errors": runner.errors,
+        "wall_seconds": wall,
+        "qps": len(runner.latencies) / wall if wall else 0.0,
+        "latency_ms": percentiles(runner.latencies),
+        "stages_ms": {stage: percentiles(values) for stage, values in runner.stages.items()},
+        "cpu_seconds": cpu_seconds,
+        "cpu_utilization": cpu_seconds / wall if wall else 0.0,
+        "rss_mb": current_rss_mb(),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    if args.target == "inprocess":
+        results["embedding_batcher"] = runner.rag.embedding_metrics()
+    if runner.flight is not None:
+        results["single_flight"] = runner.flight.stats()
+
+    print(f"\n{len(runner.latencies)} ok, {runner.errors} errors in {wall:.1f}s ({results['qps']:.2f} QPS)")
+    print(f"CPU {cpu_seconds:.1f}s ({results['cpu_utilization']:.0%} of one core), "
+          f"RSS {results['rss_mb'] or 0:.0f} MB, peak {results['peak_rss_mb']:.0f} MB")
+    print(f"{'stage':>16} {'p50':>10} {'p95':>10} {'p99':>10}")
+    for stage, stats in [("end_to_end", results["latency_ms"])] + sorted(results["stages_ms"].items()):
+        if stats["p50"] is None:
+            continue
+        print(f"{stage:>16} {stats['p50']:10.1f} {stats['p95']:10.1f} {stats['p99']:10.1f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+import numpy as np
+import pandas as pd
+
+import thread_budget
+
+
+def make_encode(args):
+    import embeddings
+
+    with open(embeddings.DATA_PATH) as f:
+        documents = json.load(f)
+    texts = [doc['question'] + " " + doc['answer'] for doc in documents]
+    backend = embeddings.get_backend(args.backend)
+    rng = np.random.default_rng(os.getpid())
+
+    def encode():
+        backend.encode([texts[i] for i in rng.integers(0, len(texts), args.batch_size)], batch_size=args.batch_size)
+        return args.batch_size
+    return encode
+
+
+def make_search(args):
+    import minsearch2
+
+    rng = np.random.default_rng(1)
+    vectors = rng.standard_normal((args.docs, args.dim), dtype=np.float32)
+    index = minsearch2.Index(['vector'], []).fit([{} for _ in range(args.docs)], vectors={'vector': vectors})
+    queries = rng.standard_normal((256, args.dim), dtype=np.float32)
+
+    def search():
+        index.search({'vector': queries[rng.integers(0, len(queries))]}, num_results=10)
+        return 1
+    return search
+
+
+TASKS = {'encode': make_encode, 'search': make_search}
+
+
+def run_worker(args):
+    """Set up one task, signal readiness, then run it for the duration once told to start."""
+    if args.threads == "budget":
+        thread_budget.configure(workers=args.workers)
+    elif args.threads != "default":
+        thread_budget.configure(workers=args.workers, threads=int(args.threads))
+    call = TASKS[args.task](args)
+    call()  # Warm up caches and lazy initialization
+    settings = thread_budget.report()
+
+    print("ready", flush=True)
+    sys.stdin.readline()
+
+    latencies, items = [], 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < args.duration:
+        call_start = time.perf_counter()
+        items += call()
+        latencies.append((time.perf_counter() - call_start) * 1000)
+    seconds = time.perf_counter() - start
+    print(json.dumps({"items": items, "seconds": seconds, "latencies": latencies, "settings": settings}), flush=True)
+
+
+def bench(task, workers, threads, args):
+    """Run `workers` processes of a task at the same time and combine their results."""
+    command = [
+        sys.executable, os.path.abspath(__file__), "--worker", "--task", task, "--workers", str(workers),
+        "--threads", threads, "--duration", str(args.duration), "--batch-size", str(args.batch_size),
+        "--backend", args.backend, "--docs", str(args.docs), "--dim", str(args.dim),
+    ]
+    env = dict(os.environ, THREAD_BUDGET="1")
+    processes = [
+        subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, env=env)
+        for _ in range(workers)
+    ]
+    for process in processes:
+        if process.stdout.readline().strip() != "ready":
+            raise RuntimeError(f"A {task} worker failed to start")
+    for process in processes:
+        process.stdin.write("go\n")
+        process.stdin.flush()
+    results = [json.loads(process.communicate()[0]) for process in processes]
+
+    latencies = np.concatenate([r["latencies"] for r in results])
+    settings = results[0]["settings"]
+    pools = settings["threadpools"]
+    return {
+        'task': task,
+        'workers': workers,
+        'threads': threads,
+        'blas_threads': max((pool["threads"] for pool in pools if pool["api"] != "openmp"), default=None),
+        'torch_threads': settings.get("torch", {}).get("threads"),
+        'throughput_per_s': sum(r["items"] / r["seconds"] for r in results),
+        'latency_p50_ms': float(np.percentile(latencies, 50)),
+        'latency_p95_ms': float(np.percentile(latencies, 95)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Throughput of concurrent encode and search workers under different thread settings"
+    )
+    parser.add_argument("--tasks", default="encode,search")
+    parser.add_argument("--workers", default="1,2,4", help="Comma separated numbers of concurrent processes")
+    parser.add_argument("--threads", default="default,budget,1,2",
+                        help="Threads per process: 'default' leaves the libraries alone, "
+                             "'budget' divides the CPUs between the workers, or a number")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds each configuration runs")
+    parser.add_argument("--batch-size", type=int, default=32, help="Texts per encode call")
+    parser.add_argument("--backend", default=os.getenv("EMBEDDING_BACKEND", "torch"))
+    parser.add_argument("--docs", type=int, default=100000, help="Vectors in the search index")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--output", default="bench_threads.csv")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--task", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        args.workers = int(args.workers)
+        run_worker(args)
+        return
+
+    print(f"{thread_budget.available_cpus()} CPUs available")
+    rows = []
+    for task in args.tasks.split(","):
+        for workers in (int(n) for n in args.workers.split(",")):
+            for threads in args.threads.split(","):
+                print(f"Benchmarking {task} with {workers} workers, threads {threads}...", flush=True)
+                rows.append(bench(task, workers, threads, args))
+
+    df = pd.DataFrame(rows)
+    df.to_csv(args.output, index=False)
+    print(df.to_string(index=False, float_format=lambda x: f"{x:.2f}"))
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import os
+import re
+from functools import lru_cache
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+CONTEXT_MAX_DOC_TOKENS = int(os.getenv("CONTEXT_MAX_DOC_TOKENS", "400"))
+CONTEXT_MIN_DOC_TOKENS = int(os.getenv("CONTEXT_MIN_DOC_TOKENS", "50"))
+DUPLICATE_THRESHOLD = float(os.getenv("CONTEXT_DUPLICATE_THRESHOLD", "0.8"))
+
+SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+")
+WORD = re.compile(r"[a-z0-9]+")
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model=OPENAI_MODEL):
+    import tiktoken
+
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_tokens(text, model=OPENAI_MODEL):
+    return len(get_encoding(model).encode(text))
+
+
+def truncate_tokens(text, max_tokens, model=OPENAI_MODEL):
+    encoding = get_encoding(model)
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+
+def _words(text):
+    return [w for w in WORD.findall(text.lower()) if len(w) > 2]
+
+
+def _shingles(text, size=3):
+    words = _words(text)
+    return {tuple(words[i:i + size]) for i in range(max(1, len(words) - size + 1))}
+
+
+def is_near_duplicate(shingles, seen, threshold=DUPLICATE_THRESHOLD):
+    for other in seen:
+        union = len(shingles | other)
+        if union and len(shingles & other) / union >= threshold:
+            return True
+    return False
+
+
+def extract_passage(query, text, max_tokens, model=OPENAI_MODEL):
+    """
+    Keep the sentences of `text` that share the most words with `query`,
+    in their original order, until `max_tokens` is reached.
+    """
+    if count_tokens(text, model) <= max_tokens:
+        return text
+
+    query_words = set(_words(query))
+    sentences = SENTENCE_SPLIT.split(text)
+    ranked = sorted(
+        range(len(sentences)),
+        key=lambda i: (-len(query_words & set(_words(sentences[i]))), i),
+    )
+
+    selected = []
+    used = 0
+    for i in ranked:
+        sentence_tokens = count_tokens(sentences[i], model)
+        if used + sentence_tokens > max_tokens:
+            continue
+        selected.append(i)
+        used += sentence_tokens
+
+    if not selected:
+        return truncate_tokens(sentences[ranked[0]], max_tokens, model)
+    return " ".join(sentences[i] for i in sorted(selected))
+
+
+def format_entry(doc, answer=None):
+    return f"Question: {doc['question']}\nAnswer: {doc['answer'] if answer is None else answer}\n\n"
+
+
+def build_context(query, search_results, token_budget=CONTEXT_TOKEN_BUDGET,
+                  max_doc_tokens=CONTEXT_MAX_DOC_TOKENS, model=OPENAI_MODEL):
+    """
+    Assemble the prompt context from scored search results within a token budget.
+
+    Results are taken in order of descending score. Near-duplicate answers are
+    dropped, long answers are cut down to their most relevant sentences, and
+    results stop being added once the budget is spent.
+
+    Args:
+        query (str): The user question.
+        search_results (list of tuple): (document, score) pairs from the index.
+        token_budget (int): Maximum number of context tokens.
+        max_doc_tokens (int): Maximum number of answer tokens taken from one document.
+        model (str): Model whose tokenizer is used for counting.
+
+    Returns:
+        tuple: The context string and a dict of token statistics.
+    """
+    ranked = sorted(search_results, key=lambda item: -item[1])
+
+    parts = []
+    seen = []
+    used = 0
+    full_tokens = 0
+    duplicates = 0
+
+    for doc, _ in ranked:
+        entry_tokens = count_tokens(format_entry(doc), model)
+        full_tokens += entry_tokens
+
+        shingles = _shingles(doc['answer'])
+        if is_near_duplicate(shingles, seen):
+            duplicates += 1
+            continue
+
+        remaining = token_budget - used
+        if remaining < CONTEXT_MIN_DOC_TOKENS:
+            continue
+
+        entry = format_entry(doc)
+        if entry_tokens > min(remaining, max_doc_tokens):
+            overhead = count_tokens(format_entry(doc, answer=""), model)
+            answer_budget = max(1, min(remaining, max_doc_tokens) - overhead)
+            answer = extract_passage(query, doc['answer'], answer_budget, model)
+            entry = format_entry(doc, answer=answer)
+            entry_tokens = count_tokens(entry, model)
+
+        parts.append(entry)
+        seen.append(shingles)
+        used += entry_tokens
+
+    stats = {
+        "context_docs": len(parts),
+        "context_duplicates": duplicates,
+        "context_tokens": used,
+        "context_full_tokens": full_tokens,
+        "context_tokens_saved": full_tokens - used,
+    }
+    return "".join(parts), stats
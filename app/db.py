@@ -1,6 +1,7 @@
 import os
 import psycopg2
 from psycopg2.extras import DictCursor
+from time import perf_counter
 from datetime import datetime, timezone
 from zoneinfo import ZoneInfo
 
@@ -9,6 +10,110 @@ RUN_TIMEZONE_CHECK = os.getenv('RUN_TIMEZONE_CHECK', '1') == '1'
 TZ_INFO = os.getenv("TZ", "Africa/Nairobi")  
 tz = ZoneInfo(TZ_INFO)
 
+ROLLUP_TABLES = [
+    "conversation_rollups", "feedback_rollups", "stage_timing_rollups", "route_rollups", "rollup_watermarks",
+]
+
+# Zeroed for a conversation that shared another's pipeline run, which already counted them
+USAGE_FIELDS = [
+    "prompt_tokens", "completion_tokens", "total_tokens",
+    "eval_prompt_tokens", "eval_completion_tokens", "eval_total_tokens", "openai_cost",
+]
+
+# Full-text search and keyset pagination over the conversation history. Idempotent, so
+# migrate_db() can apply it to a database created before it existed
+CONVERSATION_SEARCH_DDL = [
+    # History shows and filters by route, recorded since routing was added
+    "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS route TEXT",
+    "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS model_used TEXT",
+    """
+    ALTER TABLE conversations ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('english', question || ' ' || answer)) STORED
+    """,
+    "CREATE INDEX IF NOT EXISTS conversations_search_idx ON conversations USING GIN (search_vector)",
+    "CREATE INDEX IF NOT EXISTS conversations_timestamp_id_idx ON conversations (timestamp, id)",
+    "CREATE INDEX IF NOT EXISTS conversations_relevance_timestamp_id_idx ON conversations (relevance, timestamp, id)",
+    "CREATE INDEX IF NOT EXISTS feedback_conversation_id_idx ON feedback (conversation_id)",
+]
+
+# Stage timings and the time-bucketed aggregates maintained by rollups.py, read by
+# the dashboards. Idempotent, so migrate_db() can add them to an existing database
+MONITORING_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS stage_timings (
+        id SERIAL PRIMARY KEY,
+        conversation_id TEXT REFERENCES conversations(id),
+        stage TEXT NOT NULL,
+        duration_ms FLOAT NOT NULL,
+        timestamp TIMESTAMP WITH TIME ZONE NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS feedback_timestamp_idx ON feedback (timestamp)",
+    "CREATE INDEX IF NOT EXISTS stage_timings_timestamp_idx ON stage_timings (timestamp)",
+    """
+    CREATE TABLE IF NOT EXISTS conversation_rollups (
+        granularity TEXT NOT NULL,
+        bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+        conversations INTEGER NOT NULL,
+        response_time_avg FLOAT NOT NULL,
+        response_time_p50 FLOAT NOT NULL,
+        response_time_p95 FLOAT NOT NULL,
+        response_time_p99 FLOAT NOT NULL,
+        relevant INTEGER NOT NULL,
+        partly_relevant INTEGER NOT NULL,
+        non_relevant INTEGER NOT NULL,
+        prompt_tokens BIGINT NOT NULL,
+        completion_tokens BIGINT NOT NULL,
+        total_tokens BIGINT NOT NULL,
+        eval_total_tokens BIGINT NOT NULL,
+        openai_cost FLOAT NOT NULL,
+        PRIMARY KEY (granularity, bucket)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS feedback_rollups (
+        granularity TEXT NOT NULL,
+        bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+        thumbs_up INTEGER NOT NULL,
+        thumbs_down INTEGER NOT NULL,
+        PRIMARY KEY (granularity, bucket)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS stage_timing_rollups (
+        granularity TEXT NOT NULL,
+        bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+        stage TEXT NOT NULL,
+        requests INTEGER NOT NULL,
+        p50 FLOAT NOT NULL,
+        p95 FLOAT NOT NULL,
+        p99 FLOAT NOT NULL,
+        PRIMARY KEY (granularity, bucket, stage)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS route_rollups (
+        granularity TEXT NOT NULL,
+        bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+        route TEXT NOT NULL,
+        model_used TEXT NOT NULL,
+        conversations INTEGER NOT NULL,
+        PRIMARY KEY (granularity, bucket, route, model_used)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS rollup_watermarks (
+        name TEXT PRIMARY KEY,
+        watermark TIMESTAMP WITH TIME ZONE NOT NULL
+    )
+    """,
+]
+
+HISTORY_COLUMNS = [
+    "id", "question", "answer", "response_time", "relevance", "relevance_explanation",
+    "total_tokens", "openai_cost", "route", "model_used", "timestamp",
+]
+
 def get_db_connection():
     return psycopg2.connect(
         host=os.getenv("POSTGRES_HOST"),
@@ -22,6 +127,9 @@ def init_db():
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
+            for table in ROLLUP_TABLES:
+                cur.execute(f"DROP TABLE IF EXISTS {table}")
+            cur.execute("DROP TABLE IF EXISTS stage_timings")
             cur.execute("DROP TABLE IF EXISTS feedback")
             cur.execute("DROP TABLE IF EXISTS conversations")
 
@@ -40,6 +148,8 @@ def init_db():
                     eval_completion_tokens INTEGER NOT NULL,
                     eval_total_tokens INTEGER NOT NULL,
                     openai_cost FLOAT NOT NULL,
+                    route TEXT,
+                    model_used TEXT,
                     timestamp TIMESTAMP WITH TIME ZONE NOT NULL
                 )
             """)
@@ -51,15 +161,21 @@ def init_db():
                     timestamp TIMESTAMP WITH TIME ZONE NOT NULL
                 )
             """)
+            for statement in CONVERSATION_SEARCH_DDL + MONITORING_DDL:
+                cur.execute(statement)
         conn.commit()
     finally:
         conn.close()
 
 
-def save_conversation(conversation_id, question, answer_data, timestamp=None):
+def save_conversation(conversation_id, question, answer_data, timestamp=None, shared=False):
     if timestamp is None:
         timestamp = datetime.now(tz)
+    if shared:
+        # Only the conversation that ran the pipeline carries its cost, tokens and stage timings
+        answer_data = {**answer_data, **{field: 0 for field in USAGE_FIELDS}, "stage_timings": {}}
 
+    start = perf_counter()
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
@@ -68,8 +184,9 @@ def save_conversation(conversation_id, question, answer_data, timestamp=None):
                 INSERT INTO conversations 
                 (id, question, answer, response_time, relevance, 
                 relevance_explanation, prompt_tokens, completion_tokens, total_tokens, 
-                eval_prompt_tokens, eval_completion_tokens, eval_total_tokens, openai_cost, timestamp)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                eval_prompt_tokens, eval_completion_tokens, eval_total_tokens, openai_cost,
+                route, model_used, timestamp)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
                 """,
                 (
                     conversation_id,
@@ -85,9 +202,25 @@ def save_conversation(conversation_id, question, answer_data, timestamp=None):
                     answer_data["eval_completion_tokens"],
                     answer_data["eval_total_tokens"],
                     answer_data["openai_cost"],
+                    answer_data.get("route"),
+                    answer_data.get("model_used"),
                     timestamp
                 ),
             )
+
+            # Written after the conversation, in the same transaction, so they can include its write.
+            # Losing the timings must not lose the conversation.
+            stage_timings = dict(answer_data.get("stage_timings", {}))
+            stage_timings["db_write"] = (perf_counter() - start) * 1000
+            cur.execute("SAVEPOINT stage_timings")
+            try:
+                cur.executemany(
+                    "INSERT INTO stage_timings (conversation_id, stage, duration_ms, timestamp) VALUES (%s, %s, %s, %s)",
+                    [(conversation_id, stage, duration_ms, timestamp) for stage, duration_ms in stage_timings.items()],
+                )
+            except psycopg2.Error as e:
+                print(f"Stage timings could not be saved: {e}")
+                cur.execute("ROLLBACK TO SAVEPOINT stage_timings")
         conn.commit()
     finally:
         conn.close()
@@ -120,24 +253,102 @@ def save_feedback(conversation_id, feedback, timestamp=None):
         conn.close()
 
 
-def get_recent_conversations(limit=5, relevance=None):
+def migrate_db():
+    """
+    Bring an existing database up to date without dropping anything.
+
+    Adds the route, model and search columns and the history indexes, and
+    creates the stage timing and rollup tables if they are missing. Adding
+    the generated search column rewrites the conversations table, so run it
+    when the app is quiet.
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            for statement in CONVERSATION_SEARCH_DDL + MONITORING_DDL:
+                cur.execute(statement)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def search_conversations(query=None, relevance=None, route=None, start=None, end=None, limit=20, after=None):
+    """
+    Page through stored conversations, newest first.
+
+    Pages are read with a keyset on (timestamp, id) rather than an offset,
+    so every page costs the same however far back it is. All filters are
+    optional and passed to Postgres as parameters.
+
+    Args:
+        query (str, optional): Full-text search over question and answer, in web search syntax
+            (quoted phrases, `or`, `-word`).
+        relevance (str, optional): Only conversations with this relevance label.
+        route (str, optional): Only conversations served by this route.
+        start (datetime, optional): Only conversations at or after this time.
+        end (datetime, optional): Only conversations before this time.
+        limit (int): Conversations per page.
+        after (tuple, optional): Cursor returned with the previous page.
+
+    Returns:
+        tuple: The page of conversations, each with its latest feedback, and the cursor
+            of the next page, or None if this is the last one.
+    """
+    conditions, params = [], []
+    if query:
+        conditions.append("c.search_vector @@ websearch_to_tsquery('english', %s)")
+        params.append(query)
+    if relevance:
+        conditions.append("c.relevance = %s")
+        params.append(relevance)
+    if route:
+        conditions.append("c.route = %s")
+        params.append(route)
+    if start is not None:
+        conditions.append("c.timestamp >= %s")
+        params.append(start)
+    if end is not None:
+        conditions.append("c.timestamp < %s")
+        params.append(end)
+    if after is not None:
+        conditions.append("(c.timestamp, c.id) < (%s, %s)")
+        params.extend(after)
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    columns = ", ".join(f"c.{column}" for column in HISTORY_COLUMNS)
+    # One row per conversation, however much feedback it has, so the keyset stays exact
+    sql = f"""
+        SELECT {columns}, f.feedback
+        FROM conversations c
+        LEFT JOIN LATERAL (
+            SELECT feedback FROM feedback
+            WHERE conversation_id = c.id
+            ORDER BY timestamp DESC
+            LIMIT 1
+        ) f ON true
+        {where}
+        ORDER BY c.timestamp DESC, c.id DESC
+        LIMIT %s
+    """
+    params.append(limit + 1)
+
     conn = get_db_connection()
     try:
         with conn.cursor(cursor_factory=DictCursor) as cur:
-            query = """
-                SELECT c.*, f.feedback
-                FROM conversations c
-                LEFT JOIN feedback f ON c.id = f.conversation_id
-            """
-            if relevance:
-                query += f" WHERE c.relevance = '{relevance}'"
-            query += " ORDER BY c.timestamp DESC LIMIT %s"
-
-            cur.execute(query, (limit,))
-            return cur.fetchall()
+            cur.execute(sql, params)
+            rows = cur.fetchall()
     finally:
         conn.close()
 
+    if len(rows) <= limit:
+        return rows, None
+    last = rows[limit - 1]
+    return rows[:limit], (last["timestamp"], last["id"])
+
+
+def get_recent_conversations(limit=5, relevance=None):
+    return search_conversations(relevance=relevance, limit=limit)[0]
+
 
 def get_feedback_stats():
     conn = get_db_connection()
@@ -203,7 +414,3 @@ def check_timezone():
         conn.rollback()
     finally:
         conn.close()
-
-
-if RUN_TIMEZONE_CHECK:
-    check_timezone()
\ No newline at end of file
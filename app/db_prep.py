@@ -1,11 +1,19 @@
-import os
-from dotenv import load_dotenv
-from db import init_db
+import argparse
 
-os.environ['RUN_TIMEZONE_CHECK'] = '0'
+from dotenv import load_dotenv
+from db import init_db, migrate_db
 
 load_dotenv()
 
 if __name__ == "__main__":
-    print("Initializing database...")
-    init_db()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Create the database tables")
+    parser.add_argument("--migrate", "--add-search", dest="migrate", action="store_true",
+                        help="Add missing columns, indexes and tables to an existing database without dropping anything")
+    args = parser.parse_args()
+
+    if args.migrate:
+        print("Migrating the database...")
+        migrate_db()
+    else:
+        print("Initializing database...")
+        init_db()
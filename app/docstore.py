@@ -0,0 +1,285 @@
+import os
+import json
+from array import array
+from collections.abc import Mapping
+
+import numpy as np
+
+
+class TextColumn:
+    """Strings stored as one UTF-8 buffer with per-row offsets."""
+
+    kind = "text"
+    array_names = ("buffer", "offsets", "missing")
+
+    def __init__(self, buffer, offsets, missing):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.missing = missing
+
+    @classmethod
+    def from_values(cls, values):
+        encoded = [b"" if value is None else value.encode("utf-8") for value in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        missing = np.array([value is None for value in values], dtype=bool)
+        return cls(b"".join(encoded), offsets, missing)
+
+    def get(self, row):
+        # The buffer is bytes when built in memory and a uint8 array when loaded from disk
+        return bytes(self.buffer[self.offsets[row]:self.offsets[row + 1]]).decode("utf-8")
+
+    def arrays(self):
+        buffer = np.frombuffer(self.buffer, dtype=np.uint8) if isinstance(self.buffer, bytes) else self.buffer
+        return {"buffer": buffer, "offsets": self.offsets, "missing": self.missing}
+
+    @property
+    def nbytes(self):
+        return len(self.buffer) + self.offsets.nbytes + self.missing.nbytes
+
+
+class ArrayColumn:
+    """Scalars stored in a numpy array; anything that is not a number is kept as an object."""
+
+    kind = "array"
+    array_names = ("values", "missing")
+
+    def __init__(self, values, missing):
+        self.values = values
+        self.missing = missing
+
+    @classmethod
+    def from_values(cls, values):
+        present = [value for value in values if value is not None]
+        dtype = object
+        if present and all(isinstance(value, (int, np.integer)) and not isinstance(value, bool) for value in present):
+            dtype = np.int64
+        elif present and all(isinstance(value, (int, float, np.number)) and not isinstance(value, bool) for value in present):
+            dtype = np.float64
+        fill = 0 if dtype is not object else None
+        array = np.array([fill if value is None else value for value in values], dtype=dtype)
+        return cls(array, np.array([value is None for value in values], dtype=bool))
+
+    def get(self, row):
+        value = self.values[row]
+        return value.item() if isinstance(value, np.generic) else value
+
+    def arrays(self):
+        return {"values": self.values, "missing": self.missing}
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.missing.nbytes
+
+
+COLUMN_KINDS = {column.kind: column for column in (TextColumn, ArrayColumn)}
+
+
+def _make_column(values):
+    if all(value is None or isinstance(value, str) for value in values):
+        return TextColumn.from_values(values)
+    return ArrayColumn.from_values(values)
+
+
+class DocView(Mapping):
+    """
+    A read-only, dict-like view of one document in a ColumnarDocStore.
+
+    Fields are decoded from the store when they are read, so passing views
+    around copies nothing. Use `dict(view)` to materialize the whole document.
+    """
+
+    __slots__ = ("_store", "_row")
+
+    def __init__(self, store, row):
+        self._store = store
+        self._row = row
+
+    @property
+    def row(self):
+        return self._row
+
+    def __getitem__(self, field):
+        return self._store.get(self._row, field)
+
+    def __iter__(self):
+        return (field for field in self._store.fields if not self._store.columns[field].missing[self._row])
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"DocView({dict(self)!r})"
+
+
+class ColumnarDocStore:
+    """
+    A compact, read-only store for the text and metadata of indexed documents.
+
+    Each field is kept in its own column: text as a single UTF-8 buffer with
+    offsets, numbers as numpy arrays. This avoids a dict and a Python object
+    per field and document. Rows are accessed as DocView objects.
+
+    Attributes:
+        fields (list): Field names, in the order they were first seen.
+        columns (dict): Column for each field.
+    """
+
+    def __init__(self, columns, num_docs):
+        self.columns = columns
+        self.fields = list(columns)
+        self.num_docs = num_docs
+
+    @classmethod
+    def from_docs(cls, docs, exclude=()):
+        """
+        Build a store from a list of dicts.
+
+        Args:
+            docs (list): List of documents.
+            exclude (iterable): Fields to leave out, e.g. the ones held in a vector matrix.
+
+        Returns:
+            ColumnarDocStore: The new store.
+        """
+        exclude = set(exclude)
+        fields = {}
+        for doc in docs:
+            for field in doc:
+                if field not in exclude:
+                    fields.setdefault(field, None)
+        columns = {field: _make_column([doc.get(field) for doc in docs]) for field in fields}
+        return cls(columns, len(docs))
+
+    def get(self, row, field):
+        """Decode a single field of a row; raises KeyError if the row does not have it."""
+        column = self.columns.get(field)
+        if column is None or column.missing[row]:
+            raise KeyError(field)
+        return column.get(row)
+
+    def save(self, path):
+        """
+        Write the store to a directory of .npy files, one set per column.
+
+        Text columns can then be loaded memory-mapped, so opening a large
+        store costs almost nothing until rows are read.
+        """
+        os.makedirs(path, exist_ok=True)
+        meta = {"num_docs": self.num_docs, "columns": []}
+        for i, (field, column) in enumerate(self.columns.items()):
+            meta["columns"].append({"field": field, "kind": column.kind})
+            for name, array in column.arrays().items():
+                np.save(os.path.join(path, f"{i}.{name}.npy"), array, allow_pickle=array.dtype == object)
+        with open(os.path.join(path, "docstore.json"), "w") as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """Load a store written by `save`, memory-mapping the arrays by default."""
+        with open(os.path.join(path, "docstore.json")) as f:
+            meta = json.load(f)
+        columns = {}
+        for i, column in enumerate(meta["columns"]):
+            column_class = COLUMN_KINDS[column["kind"]]
+            arrays = {}
+            for name in column_class.array_names:
+                file = os.path.join(path, f"{i}.{name}.npy")
+                try:
+                    arrays[name] = np.load(file, mmap_mode=mmap_mode)
+                except ValueError:
+                    # Object arrays cannot be memory-mapped
+                    arrays[name] = np.load(file, allow_pickle=True)
+            columns[column["field"]] = column_class(**arrays)
+        return cls(columns, meta["num_docs"])
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in self.columns.values())
+
+    def __len__(self):
+        return self.num_docs
+
+    def __getitem__(self, row):
+        if not -self.num_docs <= row < self.num_docs:
+            raise IndexError(row)
+        return DocView(self, int(row) % self.num_docs)
+
+    def __iter__(self):
+        return (DocView(self, row) for row in range(self.num_docs))
+
+
+class ColumnarDocStoreWriter:
+    """
+    Writes a ColumnarDocStore to disk one document at a time.
+
+    For corpora too large to hold in memory: text is appended to a file per
+    field as it comes in and only the offsets are kept. The result is read
+    with `ColumnarDocStore.load`. Only text fields are supported.
+
+    Usage:
+        with ColumnarDocStoreWriter(path, ["question", "answer"]) as writer:
+            for doc in docs:
+                writer.append(doc)
+    """
+
+    def __init__(self, path, fields):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.fields = list(fields)
+        self.num_docs = 0
+        self._files = [open(self._buffer_path(i), "wb") for i in range(len(self.fields))]
+        self._offsets = [array("q", [0]) for _ in self.fields]
+        self._missing = [bytearray() for _ in self.fields]
+
+    def _buffer_path(self, i):
+        return os.path.join(self.path, f"{i}.buffer.tmp")
+
+    def append(self, doc):
+        for i, field in enumerate(self.fields):
+            value = doc.get(field)
+            if value is not None and not isinstance(value, str):
+                raise TypeError(f"Field {field!r} is not text")
+            encoded = b"" if value is None else value.encode("utf-8")
+            self._files[i].write(encoded)
+            self._offsets[i].append(self._offsets[i][-1] + len(encoded))
+            self._missing[i].append(value is None)
+        self.num_docs += 1
+
+    def close(self):
+        """Convert the appended text into the .npy files of a saved store."""
+        for file in self._files:
+            file.close()
+        for i in range(len(self.fields)):
+            size = self._offsets[i][-1]
+            buffer_file = os.path.join(self.path, f"{i}.buffer.npy")
+            if size:
+                # Copied in blocks into a memory-mapped .npy file, so the text is never fully in memory
+                buffer = np.lib.format.open_memmap(buffer_file, mode="w+", dtype=np.uint8, shape=(size,))
+                with open(self._buffer_path(i), "rb") as f:
+                    for start in range(0, size, 2 ** 24):
+                        f.readinto(buffer[start:start + 2 ** 24])
+                buffer.flush()
+                del buffer
+            else:
+                np.save(buffer_file, np.zeros(0, dtype=np.uint8))
+            os.remove(self._buffer_path(i))
+            np.save(os.path.join(self.path, f"{i}.offsets.npy"), np.frombuffer(self._offsets[i], dtype=np.int64))
+            np.save(os.path.join(self.path, f"{i}.missing.npy"), np.frombuffer(bytes(self._missing[i]), dtype=bool))
+
+        meta = {
+            "num_docs": self.num_docs,
+            "columns": [{"field": field, "kind": TextColumn.kind} for field in self.fields],
+        }
+        with open(os.path.join(self.path, "docstore.json"), "w") as f:
+            json.dump(meta, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            for file in self._files:
+                file.close()
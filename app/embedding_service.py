@@ -0,0 +1,138 @@
+import os
+import queue
+import logging
+import threading
+from time import perf_counter
+from concurrent.futures import Future
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "32"))
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", "5"))
+EMBED_METRICS_EVERY = int(os.getenv("EMBED_METRICS_EVERY", "1000"))
+
+_STOP = object()
+
+
+class EmbeddingBatcher:
+    """
+    Coalesces encode requests from many threads into batched forward passes.
+
+    A dedicated thread takes the first pending request, keeps collecting
+    requests for up to `max_wait_ms` or until `max_batch_size` are pending,
+    encodes them in one call and resolves each caller's future with its vector.
+
+    Attributes:
+        backend: Object with an `encode(texts, batch_size=...)` method.
+        max_batch_size (int): Largest number of texts encoded together.
+        max_wait_ms (float): How long the first request of a batch waits for company.
+    """
+
+    def __init__(self, backend, max_batch_size=EMBED_MAX_BATCH, max_wait_ms=EMBED_BATCH_WINDOW_MS):
+        self.backend = backend
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._stats = {
+            "requests": 0,
+            "batches": 0,
+            "max_queue_depth": 0,
+            "total_wait_ms": 0.0,
+            "max_wait_ms": 0.0,
+            "total_encode_ms": 0.0,
+        }
+        self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, text):
+        future = Future()
+        self._queue.put((text, future, perf_counter()))
+        return future
+
+    def encode(self, text, timeout=None):
+        """Encode one text, sharing the forward pass with concurrent callers."""
+        return self.submit(text).result(timeout)
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = perf_counter() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                self._queue.put(_STOP)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is _STOP:
+                return
+
+            depth = self._queue.qsize() + 1
+            batch = self._collect(first)
+            started = perf_counter()
+            futures = [future for _, future, _ in batch]
+
+            try:
+                vectors = self.backend.encode([text for text, _, _ in batch], batch_size=len(batch))
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            for future, vector in zip(futures, vectors):
+                future.set_result(vector)
+            self._record(batch, depth, started)
+
+    def _record(self, batch, depth, started):
+        finished = perf_counter()
+        waits = [(started - enqueued) * 1000 for _, _, enqueued in batch]
+        with self._lock:
+            stats = self._stats
+            stats["requests"] += len(batch)
+            stats["batches"] += 1
+            stats["max_queue_depth"] = max(stats["max_queue_depth"], depth)
+            stats["total_wait_ms"] += sum(waits)
+            stats["max_wait_ms"] = max(stats["max_wait_ms"], max(waits))
+            stats["total_encode_ms"] += (finished - started) * 1000
+            log = EMBED_METRICS_EVERY and stats["batches"] % EMBED_METRICS_EVERY == 0
+        if log:
+            logging.info(f"Embedding batcher: {self.metrics()}")
+
+    def metrics(self):
+        """
+        Batching metrics since start.
+
+        `batch_efficiency` is the average batch size relative to `max_batch_size`;
+        waits are measured from enqueue to the start of the forward pass.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        batches = stats["batches"] or 1
+        requests = stats["requests"] or 1
+        return {
+            "requests": stats["requests"],
+            "batches": stats["batches"],
+            "avg_batch_size": stats["requests"] / batches,
+            "batch_efficiency": stats["requests"] / batches / self.max_batch_size,
+            "queue_depth": self._queue.qsize(),
+            "max_queue_depth": stats["max_queue_depth"],
+            "avg_wait_ms": stats["total_wait_ms"] / requests,
+            "max_wait_ms": stats["max_wait_ms"],
+            "avg_encode_ms": stats["total_encode_ms"] / batches,
+        }
+
+    def close(self):
+        self._queue.put(_STOP)
+        self._thread.join(timeout=5)
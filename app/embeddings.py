@@ -0,0 +1,188 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+
+import numpy as np
+from dotenv import load_dotenv
+
+import thread_budget
+
+load_dotenv()
+
+MODEL_NAME = os.getenv("MODEL_NAME")
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", "0"))
+EMBEDDING_MAX_SEQ_LENGTH = int(os.getenv("EMBEDDING_MAX_SEQ_LENGTH", "0"))
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "data-with-ids.json")
+
+
+class SentenceTransformerBackend:
+    """
+    Full-precision SentenceTransformer on CPU, the reference backend.
+
+    Args:
+        model_name (str): Hugging Face model name.
+        num_threads (int): Intra-op threads for inference; 0 follows the process thread budget.
+        max_seq_length (int): Truncate inputs to this many tokens; 0 keeps the model default.
+    """
+
+    name = "torch"
+
+    def __init__(self, model_name=MODEL_NAME, num_threads=EMBEDDING_THREADS,
+                 max_seq_length=EMBEDDING_MAX_SEQ_LENGTH):
+        self.model_name = model_name
+        self.num_threads = num_threads
+        if num_threads:
+            import torch
+            torch.set_num_threads(num_threads)
+        else:
+            thread_budget.apply_torch()
+        self.model = self._load()
+        if max_seq_length:
+            self.model.max_seq_length = max_seq_length
+
+    def _load(self):
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(self.model_name, device="cpu")
+
+    def encode(self, texts, batch_size=32, **kwargs):
+        return self.model.encode(texts, batch_size=batch_size, **kwargs)
+
+
+class QuantizedTorchBackend(SentenceTransformerBackend):
+    """SentenceTransformer with its linear layers dynamically quantized to int8."""
+
+    name = "quantized"
+
+    def _load(self):
+        import torch
+        model = super()._load()
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class OnnxBackend(SentenceTransformerBackend):
+    """SentenceTransformer exported to an ONNX Runtime graph."""
+
+    name = "onnx"
+
+    def _load(self):
+        from sentence_transformers import SentenceTransformer
+
+        model_kwargs = {"provider": "CPUExecutionProvider"}
+        num_threads = self.num_threads or thread_budget.threads()
+        if num_threads:
+            import onnxruntime
+            session_options = onnxruntime.SessionOptions()
+            session_options.intra_op_num_threads = num_threads
+            model_kwargs["session_options"] = session_options
+        return SentenceTransformer(self.model_name, device="cpu", backend="onnx", model_kwargs=model_kwargs)
+
+
+BACKENDS = {
+    backend.name: backend
+    for backend in (SentenceTransformerBackend, QuantizedTorchBackend, OnnxBackend)
+}
+
+
+def get_backend(name=EMBEDDING_BACKEND, **kwargs):
+    """
+    Create an embedding backend by name, falling back to the reference backend
+    when the requested one cannot be loaded (e.g. ONNX Runtime is not installed).
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown embedding backend {name!r}, expected one of {', '.join(BACKENDS)}")
+    try:
+        return BACKENDS[name](**kwargs)
+    except (ImportError, TypeError, ValueError) as e:
+        if name == SentenceTransformerBackend.name:
+            raise
+        logging.warning(f"Embedding backend {name!r} unavailable ({e}), using {SentenceTransformerBackend.name!r}")
+        return SentenceTransformerBackend(**kwargs)
+
+
+def _cosine_rows(a, b):
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return (a * b).sum(axis=1)
+
+
+def _latency(backend, texts, runs):
+    single = []
+    for text in texts[:runs]:
+        start = time.perf_counter()
+        backend.encode([text])
+        single.append((time.perf_counter() - start) * 1000)
+    start = time.perf_counter()
+    backend.encode(texts)
+    batch_seconds = time.perf_counter() - start
+    return float(np.percentile(single, 50)), len(texts) / batch_seconds
+
+
+def parity(backend_names, num_texts=200, runs=50, min_cosine=0.98, **kwargs):
+    """
+    Compare each backend with the reference backend on corpus texts.
+
+    Reports the mean and minimum cosine similarity to the reference vectors,
+    the single-query p50 latency and the batch throughput. A backend passes
+    if it loaded as itself, rather than falling back to the reference, and
+    its minimum cosine reaches `min_cosine`.
+    """
+    with open(DATA_PATH) as f:
+        documents = json.load(f)
+    texts = [doc['question'] for doc in documents][:num_texts // 2]
+    texts += [doc['question'] + " " + doc['answer'] for doc in documents][:num_texts - len(texts)]
+
+    reference = SentenceTransformerBackend(**kwargs)
+    reference_vectors = reference.encode(texts)
+    reference_p50, reference_throughput = _latency(reference, texts, runs)
+
+    results = []
+    for name in backend_names:
+        backend = reference if name == reference.name else get_backend(name, **kwargs)
+        cosine = _cosine_rows(reference_vectors, backend.encode(texts))
+        p50, throughput = _latency(backend, texts, runs)
+        results.append({
+            "backend": name,
+            "loaded": backend.name,
+            "mean_cosine": float(cosine.mean()),
+            "min_cosine": float(cosine.min()),
+            "single_p50_ms": p50,
+            "single_speedup": reference_p50 / p50,
+            "batch_texts_per_s": throughput,
+            "batch_speedup": throughput / reference_throughput,
+            # A fallback to the reference would match it trivially
+            "passed": backend.name == name and bool(cosine.min() >= min_cosine),
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check embedding backends against the reference vectors")
+    parser.add_argument("--backends", default=",".join(BACKENDS))
+    parser.add_argument("--texts", type=int, default=200)
+    parser.add_argument("--runs", type=int, default=50, help="Single-query encodes timed per backend")
+    parser.add_argument("--min-cosine", type=float, default=0.98)
+    parser.add_argument("--threads", type=int, default=EMBEDDING_THREADS)
+    parser.add_argument("--max-seq-length", type=int, default=EMBEDDING_MAX_SEQ_LENGTH)
+    args = parser.parse_args()
+
+    results = parity(
+        args.backends.split(","), args.texts, args.runs, args.min_cosine,
+        num_threads=args.threads, max_seq_length=args.max_seq_length,
+    )
+    for r in results:
+        print(
+            f"{r['backend']:>10} ({r['loaded']}): cosine mean {r['mean_cosine']:.4f} min {r['min_cosine']:.4f}, "
+            f"single p50 {r['single_p50_ms']:.1f} ms ({r['single_speedup']:.2f}x), "
+            f"batch {r['batch_texts_per_s']:.0f} texts/s ({r['batch_speedup']:.2f}x)"
+            f"{'' if r['passed'] else '  FAIL'}"
+        )
+    sys.exit(0 if all(r["passed"] for r in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+from tqdm.auto import tqdm
+
+import ingest
+from context_builder import count_tokens, format_entry
+
+NUM_RESULTS = 10
+
+
+def hit_rate(relevance_total):
+    cnt = 0
+
+    for line in relevance_total:
+        if True in line:
+            cnt = cnt + 1
+
+    return cnt / len(relevance_total)
+
+
+def mrr(relevance_total):
+    total_score = 0.0
+
+    for line in relevance_total:
+        for rank in range(len(line)):
+            if line[rank]:  # If relevant document found
+                total_score += 1 / (rank + 1)
+                break  # Stop after finding the first relevant document
+
+    return total_score / len(relevance_total)
+
+
+def evaluate(ground_truth, search_function):
+    """
+    Evaluate a search function that returns (document, score) pairs.
+
+    Besides hit rate and MRR, reports the average number of tokens the
+    results would add to a prompt.
+    """
+    relevance_total = []
+    context_tokens = 0
+
+    for q in tqdm(ground_truth):
+        doc_id = q['id']
+        results = search_function(q)
+        relevance = [d['id'] == doc_id for d, _ in results]
+        relevance_total.append(relevance)
+        context_tokens += sum(count_tokens(format_entry(d)) for d, _ in results)
+
+    return {
+        'hit_rate': hit_rate(relevance_total),
+        'mrr': mrr(relevance_total),
+        'avg_context_tokens': context_tokens / len(ground_truth),
+    }
+
+
+def main():
+    documents = ingest.fetch_documents()
+    ground_truth = ingest.fetch_ground_truth()
+    model = ingest.load_model()
+
+    questions = [q['question'] for q in ground_truth]
+    query_vectors = dict(zip(questions, ingest.encode_in_batches(model, questions, desc="Encoding questions")))
+
+    documents_by_id = {doc['id']: doc for doc in documents}
+    passage_index = ingest.index_passages(documents, model)
+    document_index = ingest.index_documents(documents, model)
+
+    def document_search(q):
+        query = {'question_answer': query_vectors[q['question']]}
+        return document_index.search(query, num_results=NUM_RESULTS, return_scores=True)
+
+    def passage_search(q):
+        query = {'question_answer': query_vectors[q['question']]}
+        passages = passage_index.search(query, num_results=NUM_RESULTS * 3, return_scores=True)
+        return ingest.aggregate_passages(passages, documents_by_id, NUM_RESULTS)
+
+    results = {
+        'document': evaluate(ground_truth, document_search),
+        'passage': evaluate(ground_truth, passage_search),
+    }
+    for name, metrics in results.items():
+        print(
+            f"{name}: Hit Rate: {metrics['hit_rate']:.4f}, MRR: {metrics['mrr']:.4f}, "
+            f"Avg context tokens: {metrics['avg_context_tokens']:.0f}"
+        )
+    return results
+
+
+if __name__ == "__main__":
+    main()
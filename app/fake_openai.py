@@ -0,0 +1,201 @@
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class FakeOpenAIConfig:
+    """
+    Behaviour of the fake server.
+
+    Attributes:
+        latency (float): Base latency in seconds before the response (or first streamed token).
+        jitter (float): Uniform random latency added on top of the base latency.
+        slow_rate (float): Fraction of requests that take `slow_latency` instead.
+        slow_latency (float): Latency of slow requests in seconds.
+        error_rate (float): Fraction of requests answered with `error_status`.
+        error_status (int): HTTP status used for injected errors (e.g. 500 or 429).
+        completion_tokens (int): Number of completion tokens in every answer.
+        token_latency (float): Delay in seconds between streamed chunks.
+        answer (str): Answer content. Defaults to a canned answer of `completion_tokens` words.
+    """
+
+    def __init__(self, latency=0.2, jitter=0.05, slow_rate=0.0, slow_latency=2.0,
+                 error_rate=0.0, error_status=500, completion_tokens=100, token_latency=0.0,
+                 answer=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.completion_tokens = completion_tokens
+        self.token_latency = token_latency
+        self.answer = answer
+
+
+def _count_prompt_tokens(messages):
+    # Roughly 4 characters per token, which is close enough for load generation
+    return sum(len(m.get("content") or "") for m in messages) // 4 + 1
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if status == 429:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        config = self.server.config
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "Not found", "type": "invalid_request_error"}})
+            return
+
+        if random.random() < config.slow_rate:
+            time.sleep(config.slow_latency)
+        else:
+            time.sleep(config.latency + random.uniform(0, config.jitter))
+
+        if random.random() < config.error_rate:
+            self._send_json(config.error_status, {
+                "error": {"message": "Injected failure", "type": "server_error"}
+            })
+            return
+
+        prompt_tokens = _count_prompt_tokens(request.get("messages", []))
+        completion_tokens = config.completion_tokens
+        answer = config.answer or " ".join(["answer"] * completion_tokens)
+
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        if request.get("stream"):
+            self._send_stream(request, answer, usage)
+            return
+
+        self._send_json(200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "gpt-4o-mini"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": answer},
+                "finish_reason": "stop",
+            }],
+            "usage": usage,
+        })
+
+    def _send_stream(self, request, answer, usage):
+        config = self.server.config
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        base = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": request.get("model", "gpt-4o-mini"),
+        }
+
+        def send_event(payload):
+            data = f"data: {payload}\n\n".encode()
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        words = answer.split(" ")
+        for start in range(0, len(words), 10):
+            text = " ".join(words[start:start + 10]) + (" " if start + 10 < len(words) else "")
+            send_event(json.dumps({**base, "choices": [
+                {"index": 0, "delta": {"role": "assistant", "content": text}, "finish_reason": None}
+            ]}))
+            if config.token_latency:
+                time.sleep(config.token_latency)
+
+        send_event(json.dumps({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}))
+        if (request.get("stream_options") or {}).get("include_usage"):
+            send_event(json.dumps({**base, "choices": [], "usage": usage}))
+        send_event("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def make_server(host="127.0.0.1", port=0, config=None):
+    server = ThreadingHTTPServer((host, port), FakeOpenAIHandler)
+    server.daemon_threads = True
+    server.config = config or FakeOpenAIConfig()
+    return server
+
+
+def base_url_for(server):
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}/v1"
+
+
+def start_server(host="127.0.0.1", port=0, config=None):
+    """
+    Start the fake server on a background thread.
+
+    Returns:
+        tuple: The server and its base URL, suitable for OPENAI_BASE_URL.
+    """
+    server = make_server(host, port, config)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, base_url_for(server)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fake OpenAI-compatible chat completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--slow-rate", type=float, default=0.0)
+    parser.add_argument("--slow-latency", type=float, default=2.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--completion-tokens", type=int, default=100)
+    parser.add_argument("--token-latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    config = FakeOpenAIConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        slow_rate=args.slow_rate,
+        slow_latency=args.slow_latency,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        completion_tokens=args.completion_tokens,
+        token_latency=args.token_latency,
+    )
+    server = make_server(args.host, args.port, config)
+    print(f"Fake OpenAI server listening on {base_url_for(server)}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
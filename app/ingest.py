@@ -1,17 +1,24 @@
 import os
 import requests
+import numpy as np
 import pandas as pd
-from sentence_transformers import SentenceTransformer
 import minsearch2
+import minsearch_sharded
 from tqdm.auto import tqdm
 from dotenv import load_dotenv
 
 from db import init_db
+from profiling import profiled
+import thread_budget
 
 load_dotenv()
 
 MODEL_NAME = os.getenv("MODEL_NAME")
 INDEX_NAME = os.getenv("INDEX_NAME")
+INDEX_SHARDS = int(os.getenv("INDEX_SHARDS", "1"))
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "120"))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "30"))
 
 BASE_URL = "https://raw.githubusercontent.com/PerisN/Healthcare-QandA-System/main"
 
@@ -34,29 +41,100 @@ def fetch_ground_truth():
     return ground_truth
 
 def load_model():
-    print(f"Loading model: {MODEL_NAME}")
-    return SentenceTransformer(MODEL_NAME)
+    # Imported here because torch and sentence_transformers take seconds to import
+    import embeddings
 
+    print(f"Loading model: {MODEL_NAME} ({embeddings.EMBEDDING_BACKEND} backend)")
+    return embeddings.get_backend()
+
+def encode_in_batches(model, texts, batch_size=EMBED_BATCH_SIZE, desc="Encoding"):
+    vectors = []
+    for start in tqdm(range(0, len(texts), batch_size), desc=desc):
+        vectors.extend(model.encode(texts[start:start + batch_size], batch_size=batch_size))
+    return vectors
+
+def make_index(text_fields, keyword_fields):
+    if INDEX_SHARDS > 1:
+        return minsearch_sharded.ShardedIndex(text_fields, keyword_fields, num_shards=INDEX_SHARDS)
+    return minsearch2.Index(text_fields, keyword_fields)
+
+@profiled("index_documents")
 def index_documents(documents, model):
     print("Indexing documents...")
     
     text_fields = ['question_answer']
     keyword_fields = ['id']
 
+    # Vectors go to the index as a matrix; the documents themselves are left untouched
+    texts = [doc['question'] + " " + doc['answer'] for doc in documents]
+    vectors = {'question_answer': np.asarray(encode_in_batches(model, texts, desc="Encoding documents"))}
+
+    index = make_index(text_fields, keyword_fields)
+    index.fit(documents, vectors=vectors)
+    print(f"Indexed {len(documents)} documents")
+    return index
+
+def chunk_documents(documents, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """Split each answer into overlapping passages of `chunk_size` words."""
+    step = max(1, chunk_size - overlap)
+    passages = []
     for doc in documents:
-        doc['question_answer'] = doc['question'] + " " + doc['answer']
-    index = minsearch2.Index(text_fields, keyword_fields)
+        words = doc['answer'].split()
+        for chunk_id, start in enumerate(range(0, max(1, len(words) - overlap), step)):
+            passages.append({
+                'id': f"{doc['id']}-{chunk_id}",
+                'parent_id': doc['id'],
+                'chunk_id': chunk_id,
+                'question': doc['question'],
+                'answer': " ".join(words[start:start + chunk_size]),
+            })
+    return passages
+
+def index_passages(documents, model):
+    print("Indexing passages...")
 
-    for doc in tqdm(documents, desc="Encoding documents"):
-        for field in text_fields:
-            doc[field] = model.encode(doc[field]).tolist()
+    text_fields = ['question_answer']
+    keyword_fields = ['id', 'parent_id']
 
-    index.fit(documents)
-    print(f"Indexed {len(documents)} documents")
+    passages = chunk_documents(documents)
+    texts = [p['question'] + " " + p['answer'] for p in passages]
+    vectors = {'question_answer': np.asarray(encode_in_batches(model, texts, desc="Encoding passages"))}
+
+    index = make_index(text_fields, keyword_fields)
+    index.fit(passages, vectors=vectors)
+    print(f"Indexed {len(passages)} passages from {len(documents)} documents")
     return index
 
+def aggregate_passages(scored_passages, documents_by_id, num_results, passages_per_doc=2):
+    """
+    Group scored passages by parent document.
+
+    A parent is scored by its best passage, and its answer is replaced by its
+    best passages in their original order, so the prompt only carries the
+    relevant part of long answers.
+    """
+    grouped = {}
+    for passage, score in scored_passages:
+        grouped.setdefault(passage['parent_id'], []).append((passage, score))
+
+    ranked = sorted(grouped.items(), key=lambda item: -item[1][0][1])[:num_results]
+
+    results = []
+    for parent_id, hits in ranked:
+        parent = documents_by_id[parent_id]
+        best = sorted(hits[:passages_per_doc], key=lambda hit: hit[0]['chunk_id'])
+        results.append(({
+            'id': parent_id,
+            'question': parent['question'],
+            'answer': " ... ".join(passage['answer'] for passage, _ in best),
+            'source': parent.get('source'),
+            'focus_area': parent.get('focus_area'),
+        }, hits[0][1]))
+    return results
+
 def main():
     print("Starting the indexing process...")
+    thread_budget.configure()
 
     documents = fetch_documents()
     ground_truth = fetch_ground_truth()
@@ -0,0 +1,331 @@
+import os
+import time
+import random
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import httpx
+import openai
+from dotenv import load_dotenv
+
+load_dotenv()
+
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_ATTEMPT_TIMEOUT = float(os.getenv("LLM_ATTEMPT_TIMEOUT", "10"))
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", "30"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "8"))
+LLM_HEDGE = os.getenv("LLM_HEDGE", "1") == "1"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.95"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET = float(os.getenv("LLM_BREAKER_RESET", "30"))
+
+RETRYABLE_ERRORS = (
+    openai.APIConnectionError,  # includes APITimeoutError
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+
+class CircuitOpenError(openai.OpenAIError):
+    """Raised when the circuit breaker rejects a call without trying it."""
+
+
+class DeadlineExceededError(openai.OpenAIError):
+    """Raised when a call runs out of time before any attempt succeeded."""
+
+
+class StreamedCompletion:
+    """
+    A streamed chat completion collected into one result.
+
+    Attributes:
+        content (str): The full answer text.
+        usage: Token usage reported at the end of the stream, if any.
+        time_to_first_token (float): Seconds until the first content chunk arrived.
+        total_time (float): Seconds until the stream was fully consumed.
+    """
+
+    def __init__(self, content, usage, time_to_first_token, total_time):
+        self.content = content
+        self.usage = usage
+        self.time_to_first_token = time_to_first_token
+        self.total_time = total_time
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests after repeated failures.
+
+    After `failure_threshold` consecutive failures the breaker opens and rejects
+    calls for `reset_timeout` seconds. It then lets a single trial call through
+    and closes again if that call succeeds.
+    """
+
+    def __init__(self, failure_threshold=LLM_BREAKER_FAILURES, reset_timeout=LLM_BREAKER_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def record_rejected(self):
+        """
+        Record a request the API rejected as invalid, e.g. a 400.
+
+        That says nothing about the API's health, so it only counts when it was
+        the trial call, which must not leave the breaker half open.
+        """
+        with self._lock:
+            if self.state == "half_open":
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    logging.warning("LLM circuit breaker opened")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    """Keeps a sliding window of successful call latencies."""
+
+    def __init__(self, window=200):
+        self.samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self.samples.append(seconds)
+
+    def percentile(self, q, min_samples=1):
+        with self._lock:
+            if len(self.samples) < min_samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class LLMGateway:
+    """
+    A shared OpenAI chat client with retries, deadlines, hedging and a circuit breaker.
+
+    All calls go through one pooled HTTP client, so connections are reused
+    across requests and sessions. A call is retried with jittered exponential
+    backoff on connection errors, timeouts, rate limits and server errors, as
+    long as its deadline allows. When hedging is enabled and an attempt is
+    still running after the observed p95 latency, a second identical request
+    is sent and whichever answers first wins.
+
+    Attributes:
+        client (openai.OpenAI): The underlying OpenAI client, with its own retries disabled.
+        breaker (CircuitBreaker): Circuit breaker shared by all calls.
+        on_rate_limit (callable, optional): Called with the model and backoff delay on every 429.
+        on_extra_attempt (callable, optional): Called with the model and messages before every
+            retry and hedged request, which use rate limit budget like the first attempt.
+        latency (LatencyTracker): Latencies of successful attempts.
+        stats (dict): Counters for calls, retries, hedges and hedge wins.
+    """
+
+    def __init__(self, base_url=None, api_key=None, max_connections=LLM_MAX_CONNECTIONS,
+                 max_retries=LLM_MAX_RETRIES, attempt_timeout=LLM_ATTEMPT_TIMEOUT,
+                 deadline=LLM_DEADLINE, backoff_base=LLM_BACKOFF_BASE, backoff_max=LLM_BACKOFF_MAX,
+                 hedge=LLM_HEDGE, hedge_percentile=LLM_HEDGE_PERCENTILE,
+                 hedge_min_samples=LLM_HEDGE_MIN_SAMPLES, breaker=None, on_rate_limit=None,
+                 on_extra_attempt=None):
+        self.http_client = httpx.Client(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=attempt_timeout,
+        )
+        self.client = openai.OpenAI(
+            base_url=base_url, api_key=api_key, http_client=self.http_client, max_retries=0
+        )
+        self.max_retries = max_retries
+        self.attempt_timeout = attempt_timeout
+        self.deadline = deadline
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker = breaker or CircuitBreaker()
+        self.on_rate_limit = on_rate_limit
+        self.on_extra_attempt = on_extra_attempt
+        self.latency = LatencyTracker()
+        self.stats = {"calls": 0, "retries": 0, "hedges": 0, "hedge_wins": 0}
+        self._executor = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix="llm-hedge")
+
+    def chat(self, model, messages, deadline=None, **kwargs):
+        """
+        Create a chat completion.
+
+        Args:
+            model (str): Model name.
+            messages (list): Chat messages.
+            deadline (float, optional): Seconds the whole call, including retries, may take.
+            **kwargs: Extra arguments for `chat.completions.create`.
+
+        Returns:
+            The chat completion response, or a StreamedCompletion when `stream=True`.
+        """
+        self.stats["calls"] += 1
+        deadline_at = time.monotonic() + (deadline or self.deadline)
+        last_error = None
+
+        for attempt in range(self.max_retries + 1):
+            if not self.breaker.allow():
+                raise CircuitOpenError("LLM circuit breaker is open")
+
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                break
+
+            if attempt > 0 and self.on_extra_attempt is not None:
+                self.on_extra_attempt(model, messages)
+            try:
+                response = self._attempt(model, messages, min(self.attempt_timeout, remaining), deadline_at, kwargs)
+            except RETRYABLE_ERRORS as e:
+                self.breaker.record_failure()
+                last_error = e
+                delay = self._backoff(attempt, e)
+                if isinstance(e, openai.RateLimitError) and self.on_rate_limit is not None:
+                    self.on_rate_limit(model, delay)
+                if attempt == self.max_retries or time.monotonic() + delay >= deadline_at:
+                    break
+                logging.warning(f"LLM call failed ({e.__class__.__name__}), retrying in {delay:.2f}s")
+                self.stats["retries"] += 1
+                time.sleep(delay)
+                continue
+            except DeadlineExceededError:
+                # A stream too slow to finish in time, like a timeout
+                self.breaker.record_failure()
+                raise
+            except Exception:
+                # One caller's bad requests must not open the breaker for everyone
+                self.breaker.record_rejected()
+                raise
+
+            self.breaker.record_success()
+            return response
+
+        if last_error is None:
+            raise DeadlineExceededError("LLM call deadline exceeded")
+        raise last_error
+
+    def _backoff(self, attempt, error):
+        # Full jitter, but never retry a rate limit earlier than the server asked for
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                delay = max(delay, float(response.headers.get("retry-after", 0)))
+            except ValueError:
+                pass
+        return delay
+
+    def _call(self, model, messages, timeout, deadline_at, kwargs):
+        start = time.monotonic()
+        response = self.client.chat.completions.create(
+            model=model, messages=messages, timeout=timeout, **kwargs
+        )
+        if kwargs.get("stream"):
+            response = self._collect_stream(response, start, deadline_at)
+        self.latency.add(time.monotonic() - start)
+        return response
+
+    def _collect_stream(self, stream, start, deadline_at):
+        parts = []
+        usage = None
+        time_to_first_token = None
+        for chunk in stream:
+            # The attempt timeout only bounds the wait for each chunk, not the whole stream
+            if time.monotonic() > deadline_at:
+                stream.close()
+                raise DeadlineExceededError("LLM call deadline exceeded while streaming")
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                if time_to_first_token is None:
+                    time_to_first_token = time.monotonic() - start
+                parts.append(chunk.choices[0].delta.content)
+        total_time = time.monotonic() - start
+        if time_to_first_token is None:
+            time_to_first_token = total_time
+        return StreamedCompletion("".join(parts), usage, time_to_first_token, total_time)
+
+    def _attempt(self, model, messages, timeout, deadline_at, kwargs):
+        threshold = None
+        if self.hedge:
+            threshold = self.latency.percentile(self.hedge_percentile, self.hedge_min_samples)
+        if threshold is None or threshold >= timeout:
+            return self._call(model, messages, timeout, deadline_at, kwargs)
+
+        start = time.monotonic()
+        primary = self._executor.submit(self._call, model, messages, timeout, deadline_at, kwargs)
+        done, _ = wait([primary], timeout=threshold)
+        if done:
+            return primary.result()
+
+        self.stats["hedges"] += 1
+        if self.on_extra_attempt is not None:
+            self.on_extra_attempt(model, messages)
+        hedge_timeout = max(0.1, timeout - (time.monotonic() - start))
+        hedged = self._executor.submit(self._call, model, messages, hedge_timeout, deadline_at, kwargs)
+        pending = {primary, hedged}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedged:
+                        self.stats["hedge_wins"] += 1
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.http_client.close()
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway():
+    """Return the process-wide gateway, creating it on first use."""
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                import llm_scheduler
+
+                scheduler = llm_scheduler.get_scheduler()
+                _gateway = LLMGateway(
+                    on_rate_limit=scheduler.rate_limited if scheduler else None,
+                    on_extra_attempt=scheduler.charge if scheduler else None,
+                )
+    return _gateway
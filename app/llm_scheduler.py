@@ -0,0 +1,280 @@
+import os
+import time
+import heapq
+import logging
+import itertools
+import threading
+from contextlib import contextmanager
+
+import openai
+from dotenv import load_dotenv
+
+load_dotenv()
+
+LLM_SCHEDULER = os.getenv("LLM_SCHEDULER", "1") == "1"
+# model:requests per minute:tokens per minute, comma separated
+LLM_RATE_LIMITS = os.getenv("LLM_RATE_LIMITS", "gpt-4o-mini:500:200000,gpt-4.1-nano:500:200000,gpt-4o:500:30000")
+LLM_RATE_HEADROOM = float(os.getenv("LLM_RATE_HEADROOM", "0.9"))
+LLM_COMPLETION_ESTIMATE = int(os.getenv("LLM_COMPLETION_ESTIMATE", "300"))
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", "30"))
+
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+
+class SchedulerTimeoutError(openai.OpenAIError):
+    """Raised when a call waited in the queue until its deadline."""
+
+
+def parse_rate_limits(spec):
+    limits = {}
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        model, rpm, tpm = entry.split(":")
+        limits[model] = (float(rpm), float(tpm))
+    return limits
+
+
+def estimate_prompt_tokens(messages, model):
+    from context_builder import count_tokens
+
+    # Each message carries a few tokens of chat formatting on top of its content
+    tokens = 3
+    for message in messages:
+        try:
+            tokens += 4 + count_tokens(message["content"], model)
+        except Exception:
+            # No tokenizer available (e.g. offline); about 4 characters per token
+            tokens += 4 + len(message["content"]) // 4
+    return tokens
+
+
+class TokenBucket:
+    """A budget of `per_minute` units that refills continuously."""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until `amount` is available; 0 if it is now."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount):
+        self._refill()
+        self.level -= min(amount, self.capacity)
+
+    def give(self, amount):
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+    def pause(self, seconds):
+        """Spend everything, plus `seconds` worth of refill."""
+        self._refill()
+        self.level = min(self.level, 0) - seconds * self.rate
+
+
+class ModelBudget:
+    def __init__(self, rpm, tpm, completion_estimate=LLM_COMPLETION_ESTIMATE):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.completion_estimate = completion_estimate
+        self.queue = []
+
+    def wait_time(self, tokens):
+        return max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+
+    def take(self, tokens):
+        self.requests.take(1)
+        self.tokens.take(tokens)
+
+
+class Slot:
+    """A dispatched call; report the tokens it really used with `used`."""
+
+    def __init__(self, model, estimate, queue_seconds):
+        self.model = model
+        self.estimate = estimate
+        self.queue_seconds = queue_seconds
+        self.actual = None
+
+    def used(self, total_tokens, completion_tokens=None):
+        self.actual = (total_tokens, completion_tokens)
+
+
+class LLMScheduler:
+    """
+    Dispatches LLM calls within per-model request and token budgets.
+
+    Each model has requests-per-minute and tokens-per-minute token buckets,
+    set to `headroom` of the account limits. A call is charged its estimated
+    prompt tokens plus the running average completion length, and corrected
+    with the real usage when it finishes. Calls wait in a priority queue per
+    model, so interactive answers are dispatched before background judging,
+    in arrival order within a priority. Models without configured limits are
+    never throttled.
+    """
+
+    def __init__(self, limits=None, headroom=LLM_RATE_HEADROOM, default_deadline=LLM_DEADLINE):
+        limits = parse_rate_limits(LLM_RATE_LIMITS) if limits is None else limits
+        self.budgets = {
+            model: ModelBudget(rpm * headroom, tpm * headroom) for model, (rpm, tpm) in limits.items()
+        }
+        self.default_deadline = default_deadline
+        self._cond = threading.Condition()
+        self._sequence = itertools.count()
+        self._stats = {
+            name: {"dispatched": 0, "timeouts": 0, "total_wait": 0.0, "max_wait": 0.0}
+            for name in PRIORITY_NAMES.values()
+        }
+        self._extra_attempts = {model: 0 for model in self.budgets}
+
+    def acquire(self, model, estimate, priority=INTERACTIVE, timeout=None):
+        """
+        Wait until the call may be sent and charge it to the model's budget.
+
+        Returns:
+            float: Seconds spent waiting in the queue.
+        """
+        budget = self.budgets.get(model)
+        if budget is None:
+            return 0.0
+        start = time.monotonic()
+        deadline_at = start + (timeout or self.default_deadline)
+        ticket = (priority, next(self._sequence))
+
+        with self._cond:
+            heapq.heappush(budget.queue, ticket)
+            try:
+                while True:
+                    wait = None
+                    if budget.queue[0] == ticket:
+                        wait = budget.wait_time(estimate)
+                        if wait == 0:
+                            heapq.heappop(budget.queue)
+                            budget.take(estimate)
+                            self._cond.notify_all()
+                            break
+                    remaining = deadline_at - time.monotonic()
+                    if remaining <= 0:
+                        raise SchedulerTimeoutError(f"Waited too long for {model} rate limit budget")
+                    self._cond.wait(min(wait, remaining) if wait is not None else remaining)
+            except BaseException:
+                if ticket in budget.queue:
+                    budget.queue.remove(ticket)
+                    heapq.heapify(budget.queue)
+                    self._cond.notify_all()
+                self._record(priority, time.monotonic() - start, timed_out=True)
+                raise
+
+        waited = time.monotonic() - start
+        self._record(priority, waited)
+        return waited
+
+    def release(self, model, estimate, total_tokens=None, completion_tokens=None):
+        """Correct the model's budget with the tokens a call really used."""
+        budget = self.budgets.get(model)
+        if budget is None or total_tokens is None:
+            return
+        with self._cond:
+            budget.tokens.give(estimate - total_tokens)
+            if completion_tokens is not None:
+                budget.completion_estimate = 0.9 * budget.completion_estimate + 0.1 * completion_tokens
+            self._cond.notify_all()
+
+    def charge(self, model, messages):
+        """
+        Charge a retry or hedged duplicate of a dispatched call to the model's budget.
+
+        The request is already being sent, so it does not wait; queued calls
+        wait longer instead.
+        """
+        budget = self.budgets.get(model)
+        if budget is None:
+            return
+        estimate = estimate_prompt_tokens(messages, model) + int(budget.completion_estimate)
+        with self._cond:
+            budget.take(estimate)
+            self._extra_attempts[model] += 1
+
+    def rate_limited(self, model, retry_after=0.0):
+        """Empty the model's budget after a 429, so queued calls back off too."""
+        budget = self.budgets.get(model)
+        if budget is None:
+            return
+        with self._cond:
+            budget.requests.pause(retry_after)
+            budget.tokens.pause(retry_after)
+        logging.warning(f"Rate limited on {model}, pausing its queue")
+
+    @contextmanager
+    def slot(self, model, messages, priority=INTERACTIVE, timeout=None):
+        """
+        Hold a dispatch slot for one call.
+
+        Usage:
+            with scheduler.slot(model, messages) as slot:
+                response = client.chat(...)
+                slot.used(response.usage.total_tokens, response.usage.completion_tokens)
+        """
+        budget = self.budgets.get(model)
+        estimate = 0
+        if budget is not None:
+            estimate = estimate_prompt_tokens(messages, model) + int(budget.completion_estimate)
+        waited = self.acquire(model, estimate, priority, timeout)
+        slot = Slot(model, estimate, waited)
+        try:
+            yield slot
+        finally:
+            if slot.actual is not None:
+                self.release(model, estimate, *slot.actual)
+
+    def _record(self, priority, waited, timed_out=False):
+        with self._cond:
+            stats = self._stats[PRIORITY_NAMES.get(priority, "background")]
+            if timed_out:
+                stats["timeouts"] += 1
+                return
+            stats["dispatched"] += 1
+            stats["total_wait"] += waited
+            stats["max_wait"] = max(stats["max_wait"], waited)
+
+    def stats(self):
+        with self._cond:
+            result = {
+                name: {
+                    "dispatched": s["dispatched"],
+                    "timeouts": s["timeouts"],
+                    "avg_wait_ms": s["total_wait"] / (s["dispatched"] or 1) * 1000,
+                    "max_wait_ms": s["max_wait"] * 1000,
+                }
+                for name, s in self._stats.items()
+            }
+            result["queued"] = {model: len(budget.queue) for model, budget in self.budgets.items()}
+            result["extra_attempts"] = dict(self._extra_attempts)
+        return result
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Return the process-wide scheduler, or None when LLM_SCHEDULER is off."""
+    global _scheduler
+    if not LLM_SCHEDULER:
+        return None
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = LLMScheduler()
+    return _scheduler
@@ -1,8 +1,37 @@
+import os
+import json
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from scipy import sparse
+from sklearn.feature_extraction.text import TfidfVectorizer, HashingVectorizer, TfidfTransformer
+from sklearn.preprocessing import normalize
 import numpy as np
 
+from topk import top_k
+from docstore import ColumnarDocStore
+
+# Below this many documents a process pool costs more than it saves
+PARALLEL_MIN_DOCS = 10000
+
+
+def _fit_tfidf(texts, vectorizer_params):
+    vectorizer = TfidfVectorizer(**vectorizer_params)
+    # Normalize once here so cosine similarity is a sparse dot product at query time
+    matrix = normalize(vectorizer.fit_transform(texts))
+    # Only kept for introspection and can be as large as the vocabulary
+    vectorizer.stop_words_ = None
+    return vectorizer, matrix
+
+
+def _hash_counts(texts, vectorizer_params, n_features):
+    return _hashing_vectorizer(vectorizer_params, n_features).transform(texts)
+
+
+def _hashing_vectorizer(vectorizer_params, n_features):
+    return HashingVectorizer(n_features=n_features, alternate_sign=False, norm=None, **vectorizer_params)
+
 
 class Index:
     """
@@ -11,25 +40,36 @@ class Index:
     Attributes:
         text_fields (list): List of text field names to index.
         keyword_fields (list): List of keyword field names to index.
-        vectorizers (dict): Dictionary of TfidfVectorizer instances for each text field.
+        vectorizers (dict): Dictionary of fitted vectorizers for each text field.
         keyword_df (pd.DataFrame): DataFrame containing keyword field data.
-        text_matrices (dict): Dictionary of TF-IDF matrices for each text field.
-        docs (list): List of documents indexed.
+        text_matrices (dict): Dictionary of row-normalized TF-IDF matrices for each text field.
+        docs (ColumnarDocStore): The indexed documents.
     """
 
-    def __init__(self, text_fields, keyword_fields, vectorizer_params={}):
+    def __init__(self, text_fields, keyword_fields, vectorizer_params={}, hashing=False,
+                 n_features=2 ** 20, n_jobs=None):
         """
         Initializes the Index with specified text and keyword fields.
 
         Args:
             text_fields (list): List of text field names to index.
             keyword_fields (list): List of keyword field names to index.
-            vectorizer_params (dict): Optional parameters to pass to TfidfVectorizer.
+            vectorizer_params (dict): Optional parameters to pass to TfidfVectorizer,
+                or to HashingVectorizer in hashing mode.
+            hashing (bool): Hash terms into `n_features` columns instead of learning a
+                vocabulary, so memory stays bounded however many distinct terms there are.
+            n_features (int): Number of hashed columns in hashing mode.
+            n_jobs (int, optional): Processes used to fit large corpora. Defaults to the
+                number of CPUs; 1 fits in the current process.
         """
         self.text_fields = text_fields
         self.keyword_fields = keyword_fields
+        self.vectorizer_params = vectorizer_params
+        self.hashing = hashing
+        self.n_features = n_features
+        self.n_jobs = n_jobs or os.cpu_count() or 1
 
-        self.vectorizers = {field: TfidfVectorizer(**vectorizer_params) for field in text_fields}
+        self.vectorizers = {}
         self.keyword_df = None
         self.text_matrices = {}
         self.docs = []
@@ -38,57 +78,197 @@ class Index:
         """
         Fits the index with the provided documents.
 
+        Text fields are fitted in parallel processes when the corpus is large.
+        In hashing mode each field is also split into chunks, since hashing
+        needs no shared vocabulary.
+
         Args:
             docs (list of dict): List of documents to index. Each document is a dictionary.
         """
-        self.docs = docs
-        keyword_data = {field: [] for field in self.keyword_fields}
-
-        for field in self.text_fields:
-            texts = [doc.get(field, '') for doc in docs]
-            self.text_matrices[field] = self.vectorizers[field].fit_transform(texts)
+        texts = {field: [doc.get(field, '') for doc in docs] for field in self.text_fields}
+        n_jobs = self.n_jobs if len(docs) >= PARALLEL_MIN_DOCS else 1
 
-        for doc in docs:
-            for field in self.keyword_fields:
-                keyword_data[field].append(doc.get(field, ''))
+        if self.hashing:
+            self._fit_hashing(texts, len(docs), n_jobs)
+        elif n_jobs > 1 and len(self.text_fields) > 1:
+            with self._executor(min(n_jobs, len(self.text_fields))) as executor:
+                futures = {
+                    field: executor.submit(_fit_tfidf, field_texts, self.vectorizer_params)
+                    for field, field_texts in texts.items()
+                }
+                for field, future in futures.items():
+                    self.vectorizers[field], self.text_matrices[field] = future.result()
+        else:
+            for field, field_texts in texts.items():
+                self.vectorizers[field], self.text_matrices[field] = _fit_tfidf(field_texts, self.vectorizer_params)
 
-        self.keyword_df = pd.DataFrame(keyword_data)
+        self.keyword_df = pd.DataFrame({
+            field: [doc.get(field, '') for doc in docs] for field in self.keyword_fields
+        })
+        self.docs = ColumnarDocStore.from_docs(docs)
 
         return self
 
-    def search(self, query, filter_dict={}, boost_dict={}, num_results=10):
+    @staticmethod
+    def _executor(max_workers):
+        # Spawned rather than forked, so fitting is safe from a multi-threaded app
+        return ProcessPoolExecutor(max_workers=max_workers, mp_context=mp.get_context("spawn"))
+
+    def _fit_hashing(self, texts, num_docs, n_jobs):
+        chunk_size = max(1, -(-num_docs // n_jobs))
+        if n_jobs > 1:
+            with self._executor(n_jobs) as executor:
+                futures = {
+                    field: [
+                        executor.submit(_hash_counts, field_texts[start:start + chunk_size],
+                                        self.vectorizer_params, self.n_features)
+                        for start in range(0, len(field_texts), chunk_size)
+                    ]
+                    for field, field_texts in texts.items()
+                }
+                counts = {field: sparse.vstack([f.result() for f in chunks]).tocsr() for field, chunks in futures.items()}
+        else:
+            counts = {field: _hash_counts(field_texts, self.vectorizer_params, self.n_features)
+                      for field, field_texts in texts.items()}
+
+        for field, field_counts in counts.items():
+            transformer = TfidfTransformer()
+            self.text_matrices[field] = transformer.fit_transform(field_counts).tocsr()
+            self.vectorizers[field] = (_hashing_vectorizer(self.vectorizer_params, self.n_features), transformer)
+
+    def _transform(self, field, texts):
+        if self.hashing:
+            hasher, transformer = self.vectorizers[field]
+            return transformer.transform(hasher.transform(texts))
+        return normalize(self.vectorizers[field].transform(texts))
+
+    def save(self, path):
+        """
+        Save the fitted index to a directory.
+
+        Vocabularies and settings are written as JSON, IDF weights and the CSR
+        parts of each TF-IDF matrix as .npy files, and the documents as a
+        ColumnarDocStore, so `load` can memory-map all of it.
+
+        Args:
+            path (str): Directory to write to; created if needed.
+        """
+        os.makedirs(path, exist_ok=True)
+        meta = {
+            'text_fields': self.text_fields,
+            'keyword_fields': self.keyword_fields,
+            'vectorizer_params': self.vectorizer_params,
+            'hashing': self.hashing,
+            'n_features': self.n_features,
+            'shapes': {field: list(matrix.shape) for field, matrix in self.text_matrices.items()},
+        }
+        with open(os.path.join(path, "index.json"), "w") as f:
+            json.dump(meta, f)
+
+        for i, field in enumerate(self.text_fields):
+            matrix = self.text_matrices[field]
+            for part in ('data', 'indices', 'indptr'):
+                np.save(os.path.join(path, f"{i}.{part}.npy"), getattr(matrix, part))
+            if self.hashing:
+                idf = self.vectorizers[field][1].idf_
+            else:
+                idf = self.vectorizers[field].idf_
+                vocabulary = {term: int(column) for term, column in self.vectorizers[field].vocabulary_.items()}
+                with open(os.path.join(path, f"{i}.vocabulary.json"), "w") as f:
+                    json.dump(vocabulary, f)
+            np.save(os.path.join(path, f"{i}.idf.npy"), idf)
+
+        self.keyword_df.to_pickle(os.path.join(path, "keywords.pkl"))
+        self.docs.save(os.path.join(path, "docs"))
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        Load an index written by `save`, ready to search without refitting.
+
+        Args:
+            path (str): Directory the index was saved to.
+            mmap_mode (str, optional): Memory-map the matrices and documents; None reads them into memory.
+
+        Returns:
+            Index: The loaded index.
+        """
+        with open(os.path.join(path, "index.json")) as f:
+            meta = json.load(f)
+        params = dict(meta['vectorizer_params'])
+        if 'ngram_range' in params:
+            params['ngram_range'] = tuple(params['ngram_range'])
+
+        index = cls(meta['text_fields'], meta['keyword_fields'], params, meta['hashing'], meta['n_features'])
+        for i, field in enumerate(index.text_fields):
+            data, indices, indptr = (
+                np.load(os.path.join(path, f"{i}.{part}.npy"), mmap_mode=mmap_mode)
+                for part in ('data', 'indices', 'indptr')
+            )
+            index.text_matrices[field] = sparse.csr_matrix(
+                (data, indices, indptr), shape=tuple(meta['shapes'][field]), copy=False
+            )
+            idf = np.load(os.path.join(path, f"{i}.idf.npy"))
+            if index.hashing:
+                transformer = TfidfTransformer()
+                transformer.idf_ = idf
+                index.vectorizers[field] = (_hashing_vectorizer(params, index.n_features), transformer)
+            else:
+                with open(os.path.join(path, f"{i}.vocabulary.json")) as f:
+                    vectorizer = TfidfVectorizer(vocabulary=json.load(f), **params)
+                vectorizer.idf_ = idf
+                index.vectorizers[field] = vectorizer
+
+        index.keyword_df = pd.read_pickle(os.path.join(path, "keywords.pkl"))
+        index.docs = ColumnarDocStore.load(os.path.join(path, "docs"), mmap_mode=mmap_mode)
+        return index
+
+    def search(self, query, filter_dict={}, boost_dict={}, num_results=10, offset=0, min_score=None,
+               return_scores=False, after=None):
         """
         Searches the index with the given query, filters, and boost parameters.
 
+        Scores are not cached between calls: every page scores the whole corpus
+        again. `after` only keeps the selection for a deep page as small as one page.
+
         Args:
             query (str): The search query string.
             filter_dict (dict): Dictionary of keyword fields to filter by. Keys are field names and values are the values to filter by.
             boost_dict (dict): Dictionary of boost scores for text fields. Keys are field names and values are the boost scores.
             num_results (int): The number of top results to return. Defaults to 10.
+            offset (int): The number of top results to skip, for pagination. Defaults to 0.
+            min_score (float, optional): Minimum score a result must reach. By default only results with a positive score are returned.
+            return_scores (bool): Return (document, score) pairs instead of documents.
+            after (tuple, optional): (score, doc.row) of the last result of the previous page. Cheaper than `offset` for deep pages, see topk.top_k.
 
         Returns:
-            list of dict: List of documents matching the search criteria, ranked by relevance.
+            list of DocView: List of documents matching the search criteria, ranked by relevance.
         """
-        query_vecs = {field: self.vectorizers[field].transform([query]) for field in self.text_fields}
-        scores = np.zeros(len(self.docs))
-
-        # Compute cosine similarity for each text field and apply boost
-        for field, query_vec in query_vecs.items():
-            sim = cosine_similarity(query_vec, self.text_matrices[field]).flatten()
-            boost = boost_dict.get(field, 1)
-            scores += sim * boost
+        query_vecs = {
+            field: self._transform(field, [query]).T
+            for field in self.text_fields
+        }
 
-        # Apply keyword filters
-        for field, value in filter_dict.items():
-            if field in self.keyword_fields:
-                mask = self.keyword_df[field] == value
-                scores = scores * mask.to_numpy()
+        # Compute cosine similarity for each text field and apply boost, one block of rows at a time
+        def score_rows(rows):
+            scores = 0
+            for field, query_vec in query_vecs.items():
+                sim = (self.text_matrices[field][rows] @ query_vec).toarray().ravel()
+                scores = scores + sim * boost_dict.get(field, 1)
+            return scores
 
-        # Use argpartition to get top num_results indices
-        top_indices = np.argpartition(scores, -num_results)[-num_results:]
-        top_indices = top_indices[np.argsort(-scores[top_indices])]
+        # Apply keyword filters by narrowing the candidate rows
+        candidates = None
+        filters = [(field, value) for field, value in filter_dict.items() if field in self.keyword_fields]
+        if filters:
+            mask = np.ones(len(self.docs), dtype=bool)
+            for field, value in filters:
+                mask &= (self.keyword_df[field] == value).to_numpy()
+            candidates = np.flatnonzero(mask)
 
-        # Filter out zero-score results
-        top_docs = [self.docs[i] for i in top_indices if scores[i] > 0]
+        top = top_k(score_rows, len(self.docs), num_results, candidates=candidates,
+                    offset=offset, min_score=min_score, after=after)
 
-        return top_docs
\ No newline at end of file
+        if return_scores:
+            return [(self.docs[i], score) for i, score in top]
+        return [self.docs[i] for i, _ in top]
@@ -1,8 +1,10 @@
 import pandas as pd
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 import numpy as np
 
+from topk import top_k
+from docstore import ColumnarDocStore
+from profiling import profiled
+
 class Index:
     """
     A class for indexing and searching documents using both vector and keyword fields.
@@ -14,13 +16,13 @@ class Index:
     Attributes:
         vector_fields (list): List of field names for vector data.
         keyword_fields (list): List of field names for keyword data.
-        vector_matrices (dict): Dictionary of numpy arrays for vector data.
+        vector_matrices (dict): Dictionary of row-normalized numpy arrays for vector data.
         keyword_df (pandas.DataFrame): DataFrame for keyword data.
-        docs (list): List of all indexed documents.
+        docs (ColumnarDocStore): Text and metadata of the indexed documents, without the vectors.
 
     Methods:
-        fit(docs): Index the given documents.
-        search(query_vectors, filter_dict, boost_dict, num_results): 
+        fit(docs, vectors): Index the given documents.
+        search(query_vectors, filter_dict, boost_dict, num_results, offset, min_score, return_scores, after):
             Search the indexed documents using vector similarity and keyword filtering.
     """
 
@@ -31,27 +33,39 @@ class Index:
         self.keyword_df = None
         self.docs = []
 
-    def fit(self, docs):
+    def fit(self, docs, vectors=None):
         """
         Index the given documents.
 
         Args:
             docs (list): List of documents to index.
+            vectors (dict, optional): Matrix of document vectors for each vector field.
+                Fields not given here are read from the documents.
 
         Returns:
             self: Returns the instance itself.
         """
-        self.docs = docs
+        vectors = vectors or {}
+        self.docs = ColumnarDocStore.from_docs(docs, exclude=self.vector_fields)
         keyword_data = {field: [] for field in self.keyword_fields}
         for field in self.vector_fields:
-            self.vector_matrices[field] = np.array([doc[field] for doc in docs])
+            if field in vectors:
+                matrix = np.asarray(vectors[field], dtype=np.float32)
+            else:
+                matrix = np.array([doc[field] for doc in docs], dtype=np.float32)
+            # Normalize once here so cosine similarity is a plain dot product at query time
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            self.vector_matrices[field] = matrix / norms
         for doc in docs:
             for field in self.keyword_fields:
                 keyword_data[field].append(doc.get(field, ''))
         self.keyword_df = pd.DataFrame(keyword_data)
         return self
 
-    def search(self, query_vectors, filter_dict={}, boost_dict={}, num_results=10):
+    @profiled("search")
+    def search(self, query_vectors, filter_dict={}, boost_dict={}, num_results=10,
+               offset=0, min_score=None, return_scores=False, after=None):
         """
         Search the indexed documents using vector similarity and keyword filtering.
 
@@ -60,24 +74,46 @@ class Index:
             filter_dict (dict): Dictionary of keyword filters to apply.
             boost_dict (dict): Dictionary of boost values for each vector field.
             num_results (int): Number of top results to return.
+            offset (int): Number of top results to skip, for pagination.
+            min_score (float, optional): Minimum score a result must reach. By default
+                only results with a positive score are returned.
+            return_scores (bool): Return (document, score) pairs instead of documents.
+            after (tuple, optional): (score, doc.row) of the last result of the previous
+                page. Cheaper than `offset` for deep pages, see topk.top_k; each page is
+                still scored against every row, as scores are not cached between calls.
 
         Returns:
-            list: List of top matching documents.
+            list: List of top matching documents, as DocView rows of `docs`.
         """
-        scores = np.zeros(len(self.docs))
+        queries = []
         for field, query_vec in query_vectors.items():
             if field in self.vector_matrices:
-                sim = cosine_similarity(query_vec.reshape(1, -1), self.vector_matrices[field]).flatten()
-                boost = boost_dict.get(field, 1)
-                scores += sim * boost
-        # Apply keyword filters
-        for field, value in filter_dict.items():
-            if field in self.keyword_fields:
-                mask = self.keyword_df[field] == value
-                scores = scores * mask.to_numpy()
-        # Use argpartition to get top num_results indices
-        top_indices = np.argpartition(scores, -num_results)[-num_results:]
-        top_indices = top_indices[np.argsort(-scores[top_indices])]
-        # Filter out zero-score results
-        top_docs = [self.docs[i] for i in top_indices if scores[i] > 0]
-        return top_docs
\ No newline at end of file
+                query_vec = np.asarray(query_vec, dtype=np.float32).reshape(-1)
+                norm = np.linalg.norm(query_vec)
+                if norm > 0:
+                    query_vec = query_vec / norm
+                queries.append((self.vector_matrices[field], query_vec, boost_dict.get(field, 1)))
+
+        if not queries:
+            return []
+
+        def score_rows(rows):
+            scores = 0
+            for matrix, query_vec, boost in queries:
+                scores = scores + (matrix[rows] @ query_vec) * boost
+            return scores
+
+        # Keyword filters narrow the candidate rows instead of masking every score
+        candidates = None
+        filters = [(field, value) for field, value in filter_dict.items() if field in self.keyword_fields]
+        if filters:
+            mask = np.ones(len(self.docs), dtype=bool)
+            for field, value in filters:
+                mask &= (self.keyword_df[field] == value).to_numpy()
+            candidates = np.flatnonzero(mask)
+
+        top = top_k(score_rows, len(self.docs), num_results, candidates=candidates,
+                    offset=offset, min_score=min_score, after=after)
+        if return_scores:
+            return [(self.docs[i], score) for i, score in top]
+        return [self.docs[i] for i, _ in top]
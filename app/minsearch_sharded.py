@@ -0,0 +1,271 @@
+import os
+import heapq
+import itertools
+import shutil
+import tempfile
+import threading
+import multiprocessing as mp
+from concurrent.futures import Future
+
+import numpy as np
+import pandas as pd
+
+from topk import top_k
+from docstore import ColumnarDocStore
+
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def _shard_worker(shard_path, offset, vector_fields, keyword_fields, conn):
+    """
+    Serve searches for a single shard until told to stop.
+
+    The shard's vectors are memory-mapped read-only, so the worker only keeps
+    the pages it actually touches resident. Vectors are stored pre-normalized,
+    which turns cosine similarity into a plain dot product.
+    """
+    vector_matrices = {
+        field: np.load(os.path.join(shard_path, f"{field}.npy"), mmap_mode="r")
+        for field in vector_fields
+    }
+    keyword_df = pd.read_pickle(os.path.join(shard_path, "keywords.pkl"))
+    # The keyword frame has no rows when there are no keyword fields
+    num_docs = len(next(iter(vector_matrices.values()))) if vector_matrices else len(keyword_df)
+
+    while True:
+        message = conn.recv()
+        if message[0] == "close":
+            break
+
+        _, request_id, query_vectors, filter_dict, boost_dict, num_results, min_score, after = message
+        queries = []
+        for field, query_vec in query_vectors.items():
+            if field in vector_matrices:
+                query_vec = np.asarray(query_vec, dtype=np.float32).reshape(-1)
+                norm = np.linalg.norm(query_vec)
+                if norm > 0:
+                    query_vec = query_vec / norm
+                queries.append((vector_matrices[field], query_vec, boost_dict.get(field, 1)))
+        if not queries:
+            conn.send((request_id, []))
+            continue
+
+        def score_rows(rows):
+            scores = 0
+            for matrix, query_vec, boost in queries:
+                scores = scores + (matrix[rows] @ query_vec) * boost
+            return scores
+
+        # Apply keyword filters locally, before the top-k is taken
+        candidates = None
+        filters = [(field, value) for field, value in filter_dict.items() if field in keyword_fields]
+        if filters:
+            mask = np.ones(num_docs, dtype=bool)
+            for field, value in filters:
+                mask &= (keyword_df[field] == value).to_numpy()
+            candidates = np.flatnonzero(mask)
+
+        if after is not None:
+            # The cursor holds a global row
+            after = (after[0], after[1] - offset)
+        top = top_k(score_rows, num_docs, num_results, candidates=candidates, min_score=min_score, after=after)
+        conn.send((request_id, [(score, offset + i) for i, score in top]))
+
+    conn.close()
+
+
+class ShardedIndex:
+    """
+    A vector index that partitions documents across several worker processes.
+
+    Each shard is written to disk as memory-mapped numpy arrays and served by
+    its own process. A search fans the query out to every shard, each shard
+    applies the keyword filters and returns its local top results, and the
+    local lists are merged into the global top results. Requests carry an id
+    and each shard's replies are read by its own thread, so concurrent
+    searches queue at every shard instead of waiting for each other's round
+    trips. The documents themselves stay in this process, which returns them.
+
+    The constructor and `search` mirror `minsearch2.Index`, so the sharded
+    index can be used as a drop-in replacement.
+
+    Attributes:
+        vector_fields (list): List of field names for vector data.
+        keyword_fields (list): List of field names for keyword data.
+        num_shards (int): Number of shards (and worker processes).
+        shard_dir (str): Directory holding the shard files.
+        docs (ColumnarDocStore): Text and metadata of the indexed documents, without the vectors.
+    """
+
+    def __init__(self, vector_fields, keyword_fields, num_shards=None, shard_dir=None):
+        self.vector_fields = vector_fields
+        self.keyword_fields = keyword_fields
+        self.num_shards = num_shards or os.cpu_count() or 1
+        self._owns_shard_dir = shard_dir is None
+        self.shard_dir = shard_dir or tempfile.mkdtemp(prefix="minsearch-shards-")
+        self.docs = []
+        self._workers = []
+        self._connections = []
+        self._send_locks = []
+        self._readers = []
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._request_ids = itertools.count()
+
+    def fit(self, docs, vectors=None):
+        """
+        Partition the given documents into shards and start the shard workers.
+
+        Args:
+            docs (list): List of documents to index.
+            vectors (dict, optional): Matrix of document vectors for each vector field.
+                Fields not given here are read from the documents.
+
+        Returns:
+            self: Returns the instance itself.
+        """
+        self._stop_workers()
+        vectors = vectors or {}
+        self.docs = ColumnarDocStore.from_docs(docs, exclude=self.vector_fields)
+
+        num_shards = max(1, min(self.num_shards, len(docs)))
+        boundaries = np.linspace(0, len(docs), num_shards + 1).astype(int)
+
+        ctx = mp.get_context("spawn")
+        for shard_id in range(num_shards):
+            start, stop = boundaries[shard_id], boundaries[shard_id + 1]
+            shard_vectors = {field: matrix[start:stop] for field, matrix in vectors.items()}
+            shard_path = self._write_shard(shard_id, docs[start:stop], shard_vectors)
+
+            parent_conn, child_conn = ctx.Pipe()
+            worker = ctx.Process(
+                target=_shard_worker,
+                args=(shard_path, int(start), self.vector_fields, self.keyword_fields, child_conn),
+                daemon=True,
+            )
+            worker.start()
+            child_conn.close()
+            self._workers.append(worker)
+            self._connections.append(parent_conn)
+            self._send_locks.append(threading.Lock())
+            self._pending.append({})
+            reader = threading.Thread(
+                target=self._read_replies, args=(shard_id,), name=f"minsearch-shard-{shard_id}", daemon=True
+            )
+            reader.start()
+            self._readers.append(reader)
+
+        return self
+
+    def _write_shard(self, shard_id, shard_docs, shard_vectors):
+        shard_path = os.path.join(self.shard_dir, f"shard-{shard_id:04d}")
+        os.makedirs(shard_path, exist_ok=True)
+
+        for field in self.vector_fields:
+            if field in shard_vectors:
+                matrix = np.asarray(shard_vectors[field], dtype=np.float32)
+            else:
+                matrix = np.array([doc[field] for doc in shard_docs], dtype=np.float32)
+            np.save(os.path.join(shard_path, f"{field}.npy"), _normalize_rows(matrix))
+
+        keyword_data = {
+            field: [doc.get(field, '') for doc in shard_docs] for field in self.keyword_fields
+        }
+        pd.DataFrame(keyword_data).to_pickle(os.path.join(shard_path, "keywords.pkl"))
+        return shard_path
+
+    def search(self, query_vectors, filter_dict={}, boost_dict={}, num_results=10,
+               offset=0, min_score=None, return_scores=False, after=None):
+        """
+        Search all shards in parallel and merge their results.
+
+        Args:
+            query_vectors (dict): Dictionary of query vectors for each vector field.
+            filter_dict (dict): Dictionary of keyword filters, applied inside each shard.
+            boost_dict (dict): Dictionary of boost values for each vector field.
+            num_results (int): Number of top results to return.
+            offset (int): Number of top results to skip, for pagination.
+            min_score (float, optional): Minimum score a result must reach.
+            return_scores (bool): Return (document, score) pairs instead of documents.
+            after (tuple, optional): (score, doc.row) of the last result of the previous
+                page. Each shard then returns only `num_results`, rather than `offset + num_results`.
+
+        Returns:
+            list: List of top matching documents.
+        """
+        # Every shard has to return offset + num_results, since any of them may hold the page
+        request_id = next(self._request_ids)
+        message = (
+            "search", request_id, query_vectors, filter_dict, boost_dict, offset + num_results, min_score, after
+        )
+        replies = []
+        for shard_id, conn in enumerate(self._connections):
+            reply = Future()
+            with self._pending_lock:
+                self._pending[shard_id][request_id] = reply
+            with self._send_locks[shard_id]:
+                conn.send(message)
+            replies.append(reply)
+        shard_results = [reply.result() for reply in replies]
+
+        # Each shard list is sorted by descending score, so a k-way merge is enough
+        merged = heapq.merge(*shard_results, key=lambda item: (-item[0], item[1]))
+        top = itertools.islice(merged, offset, offset + num_results)
+        if return_scores:
+            return [(self.docs[i], score) for score, i in top]
+        return [self.docs[i] for _, i in top]
+
+    def _read_replies(self, shard_id):
+        conn = self._connections[shard_id]
+        while True:
+            try:
+                request_id, results = conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._pending_lock:
+                reply = self._pending[shard_id].pop(request_id)
+            reply.set_result(results)
+
+        # The worker is gone; fail whatever was still waiting for it
+        with self._pending_lock:
+            pending, self._pending[shard_id] = self._pending[shard_id], {}
+        for reply in pending.values():
+            reply.set_exception(RuntimeError(f"Shard {shard_id} worker stopped"))
+
+    def _stop_workers(self):
+        for conn, send_lock in zip(self._connections, self._send_locks):
+            try:
+                with send_lock:
+                    conn.send(("close",))
+            except (BrokenPipeError, OSError):
+                pass
+        for worker in self._workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        # The readers see the worker's end close; only then is it safe to close ours
+        for reader in self._readers:
+            reader.join(timeout=5)
+        for conn in self._connections:
+            conn.close()
+        self._workers = []
+        self._connections = []
+        self._send_locks = []
+        self._readers = []
+        self._pending = []
+
+    def close(self):
+        """Stop the shard workers and remove shard files this index created."""
+        self._stop_workers()
+        if self._owns_shard_dir:
+            shutil.rmtree(self.shard_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,72 +1,195 @@
 import os
-import requests
+import re
+import json
+import shutil
+import hashlib
+import argparse
+import unicodedata
+import multiprocessing as mp
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
-from sentence_transformers import SentenceTransformer
-import minsearch2
 from tqdm.auto import tqdm
-from dotenv import load_dotenv
-
-from db import init_db
-
-load_dotenv()
-
-MODEL_NAME = os.getenv("MODEL_NAME")
-INDEX_NAME = os.getenv("INDEX_NAME")
-
-BASE_URL = "https://raw.githubusercontent.com/PerisN/Healthcare-QandA-System/main"
 
-def fetch_documents():
-    print("Fetching documents...")
-    relative_url = "data/data-with-ids.json"
-    docs_url = f"{BASE_URL}/{relative_url}"
-    docs_response = requests.get(docs_url)
-    documents = docs_response.json()
-    print(f"Fetched {len(documents)} documents")
-    return documents
+from docstore import ColumnarDocStore, ColumnarDocStoreWriter
 
-def fetch_ground_truth():
-    print("Fetching ground truth data...")
-    relative_url = "data/ground-truth-retrieval.csv"
-    ground_truth_url = f"{BASE_URL}/{relative_url}"
-    df_ground_truth = pd.read_csv(ground_truth_url)
-    ground_truth = df_ground_truth.to_dict(orient="records")
-    print(f"Fetched {len(ground_truth)} ground truth records")
-    return ground_truth
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+# Untracked, so that a run does not overwrite the data-with-ids.json the app and ground truth use
+OUTPUT_DIR = os.path.join(DATA_DIR, "prepared")
 
-def load_model():
-    print(f"Loading model: {MODEL_NAME}")
-    return SentenceTransformer(MODEL_NAME)
+FIELDS = ["question", "answer", "source", "focus_area"]
+OUTPUT_FIELDS = FIELDS + ["id"]
 
-def index_documents(documents, model):
-    print("Indexing documents...")
-    
-    text_fields = ['question_answer']
-    keyword_fields = ['id']
+SPACES = re.compile(r"[ \t\u00a0]+")
+
+
+def generate_document_id(doc, length=8):
+    """
+    Content hash of a raw CSV row, as used for data-with-ids.json and the ground truth.
+
+    The id is computed before normalization, so it only changes when the source row does.
+    """
+    combined = f"{doc['question']}-{doc['answer']}-{doc['source']}-{doc['focus_area'][:10]}"
+    return hashlib.md5(combined.encode()).hexdigest()[:length]
+
+
+def normalize_text(text):
+    """Unicode NFC, with runs of spaces collapsed and blank lines and surrounding whitespace removed."""
+    text = unicodedata.normalize("NFC", text)
+    lines = (SPACES.sub(" ", line).strip() for line in text.splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def dedupe_key(doc):
+    """Question and answer compared case- and whitespace-insensitively."""
+    text = " ".join(doc["question"].casefold().split()) + "\0" + " ".join(doc["answer"].casefold().split())
+    return hashlib.md5(text.encode()).digest()
+
+
+def clean_chunk(records, normalize=True):
+    """
+    Give each row its id and normalize its text, dropping rows without a question or answer.
+
+    Runs in the worker processes.
+
+    Returns:
+        tuple: The cleaned documents, in input order, and the number of rows dropped.
+    """
+    docs = []
+    for record in records:
+        if not record["question"].strip() or not record["answer"].strip():
+            continue
+        doc = {field: normalize_text(record[field]) if normalize else record[field] for field in FIELDS}
+        # A longer id than needed, so that a colliding id can be extended in prepare
+        doc["id"] = generate_document_id(record, length=16)
+        docs.append(doc)
+    return docs, len(records) - len(docs)
+
+
+def read_chunks(path, chunk_size):
+    # Read as text, so that values like "NA" are kept as written
+    for chunk in pd.read_csv(path, chunksize=chunk_size, dtype=str, keep_default_na=False, usecols=FIELDS):
+        yield chunk.to_dict(orient="records")
+
+
+def clean_chunks(chunks, workers, normalize=True):
+    """Clean chunks in a process pool, yielding results in input order with a bounded number in flight."""
+    if workers <= 1:
+        for records in chunks:
+            yield clean_chunk(records, normalize)
+        return
+
+    # Spawned rather than forked, like the index fitting in minsearch
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn")) as executor:
+        pending = deque()
+        for records in chunks:
+            pending.append(executor.submit(clean_chunk, records, normalize))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def load_previous_ids(binary_path):
+    if not os.path.exists(os.path.join(binary_path, "docstore.json")):
+        return None
+    store = ColumnarDocStore.load(binary_path)
+    return {store.get(row, "id") for row in range(len(store))}
+
+
+def prepare(input_path, json_path, binary_path, chunk_size=10000, workers=None, normalize=True):
+    """
+    Stream a CSV of question/answer pairs into JSON and a ColumnarDocStore.
+
+    The CSV is read in chunks that are cleaned in a process pool, and
+    documents are written out as they arrive, so the text is never held in
+    memory as a whole. What does grow linearly with the corpus is small per
+    document: the dedupe keys and ids seen so far, and the offsets and
+    missing-value flags the docstore writer keeps until it closes. Pairs
+    that repeat an earlier question and answer are dropped. Outputs are
+    written next to their destination and moved into place when complete.
+
+    Args:
+        input_path (str): CSV with question, answer, source and focus_area columns.
+        json_path (str): JSON output, in the layout of data-with-ids.json.
+        binary_path (str): Directory for the ColumnarDocStore copy.
+        chunk_size (int): Rows per chunk.
+        workers (int, optional): Cleaning processes; defaults to the number of CPUs.
+        normalize (bool): Normalize whitespace and Unicode in the text.
+
+    Returns:
+        dict: Row, document, duplicate and id counts.
+    """
+    workers = workers or os.cpu_count() or 1
+    previous_ids = load_previous_ids(binary_path)
+    stats = {"rows": 0, "documents": 0, "dropped": 0, "duplicates": 0, "id_collisions": 0}
+    seen_keys = set()
+    ids = set()
+
+    os.makedirs(os.path.dirname(os.path.abspath(json_path)), exist_ok=True)
+    json_tmp, binary_tmp = json_path + ".tmp", binary_path + ".tmp"
+    shutil.rmtree(binary_tmp, ignore_errors=True)
+    with open(json_tmp, "w") as f, ColumnarDocStoreWriter(binary_tmp, OUTPUT_FIELDS) as writer:
+        f.write("[")
+        progress = tqdm(desc="Preparing", unit=" rows")
+        for docs, dropped in clean_chunks(read_chunks(input_path, chunk_size), workers, normalize):
+            stats["rows"] += len(docs) + dropped
+            stats["dropped"] += dropped
+            progress.update(len(docs) + dropped)
+            for doc in docs:
+                key = dedupe_key(doc)
+                if key in seen_keys:
+                    stats["duplicates"] += 1
+                    continue
+                seen_keys.add(key)
+
+                # Eight hex digits can collide in a large corpus; the later document keeps a longer id
+                if doc["id"][:8] in ids:
+                    stats["id_collisions"] += 1
+                else:
+                    doc["id"] = doc["id"][:8]
+                ids.add(doc["id"])
+
+                f.write(",\n" if stats["documents"] else "\n")
+                f.write("\n".join("  " + line for line in json.dumps(doc, indent=2).splitlines()))
+                writer.append(doc)
+                stats["documents"] += 1
+        progress.close()
+        f.write("\n]" if stats["documents"] else "]")
+
+    os.replace(json_tmp, json_path)
+    shutil.rmtree(binary_path, ignore_errors=True)
+    os.rename(binary_tmp, binary_path)
+
+    if previous_ids is not None:
+        stats["unchanged_ids"] = len(previous_ids.intersection(ids))
+        stats["new_ids"] = len(ids) - stats["unchanged_ids"]
+        stats["removed_ids"] = len(previous_ids) - stats["unchanged_ids"]
+    return stats
 
-    for doc in documents:
-        doc['question_answer'] = doc['question'] + " " + doc['answer']
-    index = minsearch2.Index(text_fields, keyword_fields)
-
-    for doc in tqdm(documents, desc="Encoding documents"):
-        for field in text_fields:
-            doc[field] = model.encode(doc[field]).tolist()
-
-    index.fit(documents)
-    print(f"Indexed {len(documents)} documents")
-    return index
 
 def main():
-    print("Starting the indexing process...")
-
-    documents = fetch_documents()
-    ground_truth = fetch_ground_truth()
-    model = load_model()
-    index = index_documents(documents, model)
-
-    print("Initializing database...")
-    init_db()
+    parser = argparse.ArgumentParser(description="Prepare the FAQ corpus: clean, deduplicate and assign ids")
+    parser.add_argument("--input", default=os.path.join(DATA_DIR, "sample_data.csv"))
+    parser.add_argument("--output", default=os.path.join(OUTPUT_DIR, "data-with-ids.json"))
+    parser.add_argument("--binary-output", default=None,
+                        help="ColumnarDocStore directory, defaults to the output path without .json")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="CSV rows per chunk")
+    parser.add_argument("--workers", type=int, default=None, help="Cleaning processes, defaults to the CPUs")
+    parser.add_argument("--no-normalize", action="store_true", help="Keep the text exactly as in the CSV")
+    args = parser.parse_args()
+
+    binary_output = args.binary_output or os.path.splitext(args.output)[0]
+    stats = prepare(args.input, args.output, binary_output, args.chunk_size, args.workers, not args.no_normalize)
+
+    print(f"{stats['rows']} rows: {stats['documents']} documents written, {stats['duplicates']} duplicates "
+          f"and {stats['dropped']} incomplete rows dropped, {stats['id_collisions']} id collisions")
+    if "unchanged_ids" in stats:
+        print(f"Compared with the previous output: {stats['unchanged_ids']} unchanged, "
+              f"{stats['new_ids']} new and {stats['removed_ids']} removed ids")
+    print(f"Written to {args.output} and {binary_output}")
 
-    print("Indexing process completed successfully!")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,156 @@
+import os
+import gzip
+import time
+import uuid
+import pickle
+import random
+import marshal
+import pstats
+import cProfile
+import argparse
+import functools
+import threading
+import tracemalloc
+from glob import glob
+from collections import defaultdict
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_TRACEMALLOC = os.getenv("PROFILE_TRACEMALLOC", "1") == "1"
+PROFILE_TRACEMALLOC_FRAMES = int(os.getenv("PROFILE_TRACEMALLOC_FRAMES", "10"))
+
+# cProfile and tracemalloc are process-wide, so only one capture runs at a time
+_capture_lock = threading.Lock()
+
+
+def _write_capture(name, capture_id, profiler, snapshot):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stem = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}-{capture_id}")
+
+    profiler.create_stats()
+    with gzip.open(f"{stem}.prof.gz", "wb") as f:
+        f.write(marshal.dumps(profiler.stats))
+
+    if snapshot is not None:
+        with gzip.open(f"{stem}.tracemalloc.gz", "wb") as f:
+            pickle.dump(snapshot, f)
+
+    print(f"Profile captured: {stem}", flush=True)
+
+
+@contextmanager
+def capture(name, capture_id=None, sample_rate=None):
+    """
+    Profile the enclosed block for a sampled fraction of calls.
+
+    With probability `sample_rate` (PROFILE_SAMPLE_RATE by default) the block
+    runs under cProfile and, if enabled, tracemalloc, and both captures are
+    written gzip-compressed to PROFILE_DIR. Captures never nest: if another
+    capture is already running the block just runs unprofiled.
+
+    Args:
+        name (str): Name of the profiled operation, used in file names.
+        capture_id (str, optional): Identifier such as the conversation id.
+        sample_rate (float, optional): Fraction of calls to profile.
+    """
+    rate = PROFILE_SAMPLE_RATE if sample_rate is None else sample_rate
+    if rate <= 0 or random.random() >= rate or not _capture_lock.acquire(blocking=False):
+        yield
+        return
+
+    try:
+        profiler = cProfile.Profile()
+        if PROFILE_TRACEMALLOC:
+            tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            snapshot = None
+            if PROFILE_TRACEMALLOC:
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+            _write_capture(name, capture_id or uuid.uuid4().hex[:8], profiler, snapshot)
+    finally:
+        _capture_lock.release()
+
+
+def profiled(name):
+    """Decorator version of `capture` for functions on the request path."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if PROFILE_SAMPLE_RATE <= 0:
+                return func(*args, **kwargs)
+            with capture(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class _LoadedProfile:
+    # pstats.Stats accepts any object with create_stats() and a stats dict
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def load_profile(path):
+    with gzip.open(path, "rb") as f:
+        return _LoadedProfile(marshal.loads(f.read()))
+
+
+def top_functions(directory=PROFILE_DIR, limit=20, sort="cumulative"):
+    paths = sorted(glob(os.path.join(directory, "*.prof.gz")))
+    if not paths:
+        print(f"No profiles found in {directory}")
+        return
+    stats = pstats.Stats(load_profile(paths[0]))
+    for path in paths[1:]:
+        stats.add(load_profile(path))
+    print(f"Top {limit} functions by {sort} time across {len(paths)} captures")
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+
+
+def top_allocations(directory=PROFILE_DIR, limit=20):
+    paths = sorted(glob(os.path.join(directory, "*.tracemalloc.gz")))
+    if not paths:
+        print(f"No allocation snapshots found in {directory}")
+        return
+    sizes = defaultdict(int)
+    counts = defaultdict(int)
+    for path in paths:
+        with gzip.open(path, "rb") as f:
+            snapshot = pickle.load(f)
+        for stat in snapshot.statistics("lineno"):
+            frame = stat.traceback[0]
+            key = f"{frame.filename}:{frame.lineno}"
+            sizes[key] += stat.size
+            counts[key] += stat.count
+
+    print(f"Top {limit} allocation sites across {len(paths)} captures")
+    for key in sorted(sizes, key=sizes.get, reverse=True)[:limit]:
+        print(f"{sizes[key] / len(paths) / 1024:10.1f} KiB avg  {counts[key]:8d} blocks  {key}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Aggregate sampled profiles")
+    parser.add_argument("directory", nargs="?", default=PROFILE_DIR)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--sort", default="cumulative", help="pstats sort key, e.g. cumulative or tottime")
+    args = parser.parse_args()
+
+    top_functions(args.directory, args.limit, args.sort)
+    top_allocations(args.directory, args.limit)
+
+
+if __name__ == "__main__":
+    main()
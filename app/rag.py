@@ -1,9 +1,16 @@
 import json
+import atexit
 from time import time
-import openai
-from openai import OpenAI
+import threading
+from contextlib import nullcontext
 import ingest
-from sentence_transformers import SentenceTransformer
+import db
+from context_builder import build_context
+from timings import StageTimer
+import routing
+import rerank
+import thread_budget
+from embedding_service import EmbeddingBatcher
 import os
 from dotenv import load_dotenv
 import logging
@@ -17,24 +24,129 @@ logging.basicConfig(level=logging.INFO)
 # OpenAI API and model configuration
 MODEL_NAME = os.getenv("MODEL_NAME")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+SEARCH_NUM_RESULTS = int(os.getenv("SEARCH_NUM_RESULTS", "10"))
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "document")
+PASSAGE_FANOUT = int(os.getenv("PASSAGE_FANOUT", "3"))
+READY_FILE = os.getenv("READY_FILE", "/tmp/health-assistant.ready")
+EMBED_BATCHER = os.getenv("EMBED_BATCHER", "1") == "1"
+JUDGE_MODEL = os.getenv("JUDGE_MODEL", "gpt-4o-mini")
+JUDGE_BATCH_SIZE = int(os.getenv("JUDGE_BATCH_SIZE", "8"))
+
+# Answer returned in place of a generated one when the LLM call fails
+LLM_ERROR_ANSWER = "Error in generating response"
+
+# Populated by warmup(), so that importing this module stays cheap
+documents = None
+documents_by_id = None
+model = None
+embedder = None
+index = None
+reranker = None
+startup_timings = {}
+
+_ready = threading.Event()
+_warmup_lock = threading.Lock()
+
+
+def warmup():
+    """
+    Load the corpus, the embedding model and the index, and connect the LLM client.
+
+    Each step is timed and the timings are kept in `startup_timings`. When
+    done, the module is marked ready and READY_FILE is written so that a
+    readiness probe can pick it up. A READY_FILE left by an earlier process,
+    e.g. before a container restart, is removed first, and the file is
+    removed again when this process exits. Calling warmup() again is a no-op.
+    """
+    global documents, documents_by_id, model, embedder, index, reranker
+
+    with _warmup_lock:
+        if _ready.is_set():
+            return startup_timings
+        _remove_ready_file()
+
+        # Before the model is loaded, so torch starts with the budget in place
+        thread_budget.configure()
+        logging.info(f"Thread settings: {thread_budget.report()}")
+
+        timer = StageTimer()
+        with timer.stage("fetch_documents"):
+            documents = ingest.fetch_documents()
+        with timer.stage("load_model"):
+            model = ingest.load_model()
+            if EMBED_BATCHER:
+                # One shared batcher, so concurrent sessions share forward passes
+                embedder = EmbeddingBatcher(model)
+        with timer.stage("index"):
+            if RETRIEVAL_MODE == "passage":
+                documents_by_id = {doc['id']: doc for doc in documents}
+                index = ingest.index_passages(documents, model)
+            else:
+                index = ingest.index_documents(documents, model)
+                # The index keeps a compact copy of the documents, the dicts are not needed anymore
+                documents = index.docs
+        if rerank.RERANKER:
+            with timer.stage("reranker"):
+                reranker = rerank.get_reranker()
+        with timer.stage("llm_client"):
+            import llm_client
+            llm_client.get_gateway()
+        if db.RUN_TIMEZONE_CHECK:
+            with timer.stage("timezone_check"):
+                db.check_timezone()
+
+        startup_timings.update(timer.spans)
+        _ready.set()
+        if READY_FILE:
+            with open(READY_FILE, "w") as f:
+                json.dump(startup_timings, f)
+            atexit.register(_remove_ready_file)
+
+        logging.info("Warm-up completed: " + ", ".join(
+            f"{stage} {duration_ms:.0f} ms" for stage, duration_ms in startup_timings.items()
+        ))
+        return startup_timings
+
+
+def _remove_ready_file():
+    if READY_FILE:
+        try:
+            os.remove(READY_FILE)
+        except FileNotFoundError:
+            pass
+
+
+def is_ready():
+    return _ready.is_set()
+
+
+def minsearch_search(field, query_vector, num_results=SEARCH_NUM_RESULTS):
+    query = {field: query_vector.reshape(1, -1)}
+    results = index.search(query_vectors=query, num_results=num_results, return_scores=True)
+    return results
 
-documents = ingest.fetch_documents()
-model = SentenceTransformer(MODEL_NAME)
-index = ingest.index_documents(documents, model)
+def passage_search(field, query_vector, num_results=SEARCH_NUM_RESULTS):
+    passages = minsearch_search(field, query_vector, num_results=num_results * PASSAGE_FANOUT)
+    return ingest.aggregate_passages(passages, documents_by_id, num_results)
 
-client = openai.OpenAI()
+def encode_query(question):
+    if embedder is not None:
+        return embedder.encode(question).reshape(1, -1)
+    return model.encode([question])
 
+def embedding_metrics():
+    return embedder.metrics() if embedder is not None else {}
 
-def minsearch_search(field, query_vector):
-    query = {field: query_vector.reshape(1, -1)}
-    results = index.search(query_vectors=query, num_results=10)
-    return results
-
-def search(question):
+def search_by_vector(query_vector):
     field = 'question_answer'
-    query_vector = model.encode([question])
+    if RETRIEVAL_MODE == "passage":
+        return passage_search(field, query_vector)
     return minsearch_search(field, query_vector)
 
+def search(question):
+    warmup()
+    return search_by_vector(encode_query(question))
+
 
 def build_prompt(query, search_results):
     prompt_template = """
@@ -46,30 +158,65 @@ CONTEXT: {context}
 
 """.strip()
 
-    context = ""
-    
-    for doc in search_results:
-        context += f"Question: {doc['question']}\nAnswer: {doc['answer']}\n\n"
-    
+    context, context_stats = build_context(query, search_results)
+    logging.info(
+        f"Context: {context_stats['context_docs']} docs, {context_stats['context_tokens']} tokens "
+        f"({context_stats['context_tokens_saved']} saved)"
+    )
+
     prompt = prompt_template.format(question=query, context=context).strip()
-    return prompt
+    return prompt, context_stats
+
+
+def llm(prompt, model=OPENAI_MODEL, deadline=None, timer=None, stage="llm", priority=None, raise_errors=False):
+    """
+    Get a completion for a prompt through the scheduler and the shared gateway.
 
+    API errors are logged and answered with LLM_ERROR_ANSWER and zero tokens,
+    unless `raise_errors` is set, for callers that retry failed work later.
+    """
+    # Imported here so that importing this module does not load the OpenAI client
+    import openai
+    import llm_client
+    import llm_scheduler
+
+    messages = [{"role": "user", "content": prompt}]
+    if priority is None:
+        # Judging is never what a user is waiting on first
+        priority = llm_scheduler.BACKGROUND if stage == "judge" else llm_scheduler.INTERACTIVE
+    scheduler = llm_scheduler.get_scheduler()
+    slot_context = scheduler.slot(model, messages, priority, deadline) if scheduler else nullcontext()
 
-def llm(prompt, model=OPENAI_MODEL, timeout=10):
     try:
-        response = client.chat.completions.create(
-            model=model, messages=[{"role": "user", "content": prompt}], timeout=timeout
-        )
-        answer = response.choices[0].message.content
+        # Time spent queued for rate limit budget counts against the deadline
+        deadline_at = time() + (deadline or llm_client.LLM_DEADLINE)
+        with slot_context as slot:
+            if slot is not None and timer is not None:
+                timer.record(f"{stage}_queue", slot.queue_seconds)
+            response = llm_client.get_gateway().chat(
+                model=model,
+                messages=messages,
+                deadline=max(0.1, deadline_at - time()),
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            if slot is not None and response.usage is not None:
+                slot.used(response.usage.total_tokens, response.usage.completion_tokens)
+        if timer is not None:
+            timer.record(f"{stage}_ttft", response.time_to_first_token)
+            timer.record(stage, response.total_time)
+        answer = response.content
         token_stats = {
             "prompt_tokens": response.usage.prompt_tokens,
             "completion_tokens": response.usage.completion_tokens,
             "total_tokens": response.usage.total_tokens,
         }
         return answer, token_stats
-    except openai.error.OpenAIError as e:
+    except openai.OpenAIError as e:
         logging.error(f"Error with OpenAI API: {e}")
-        return "Error in generating response", {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        if raise_errors:
+            raise
+        return LLM_ERROR_ANSWER, {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
 
 
 evaluation_prompt_template = """
@@ -93,9 +240,34 @@ and provide your evaluation in parsable JSON without using code blocks:
 """.strip()
 
 
-def evaluate_relevance(question, answer):
+batch_evaluation_prompt_template = """
+You are an expert evaluator for a RAG system.
+Your task is to analyze the relevance of each generated answer to its question.
+Based on the relevance of each generated answer, you will classify it
+as "NON_RELEVANT", "PARTLY_RELEVANT", or "RELEVANT".
+
+Here are {count} question and answer pairs for evaluation, each with an "id":
+
+{items}
+
+Please analyze each pair independently and provide your evaluation as a parsable
+JSON array without using code blocks, with exactly one object per pair, in the same order:
+
+[
+  {{
+    "id": <id of the pair>,
+    "Relevance": "NON_RELEVANT" | "PARTLY_RELEVANT" | "RELEVANT",
+    "Explanation": "[Provide a brief explanation for your evaluation]"
+  }}
+]
+""".strip()
+
+RELEVANCE_LABELS = {"NON_RELEVANT", "PARTLY_RELEVANT", "RELEVANT"}
+
+
+def evaluate_relevance(question, answer, timer=None, raise_errors=False):
     prompt = evaluation_prompt_template.format(question=question, answer=answer)
-    evaluation, tokens = llm(prompt, model="gpt-4o-mini")
+    evaluation, tokens = llm(prompt, model=JUDGE_MODEL, timer=timer, stage="judge", raise_errors=raise_errors)
 
     try:
         json_eval = json.loads(evaluation)
@@ -105,52 +277,220 @@ def evaluate_relevance(question, answer):
         return result, tokens
 
 
-def calculate_openai_cost(model, tokens):
-    openai_cost = 0
+def parse_batch_evaluation(evaluation, count):
+    """
+    Parse a batched judge response into {position: evaluation}.
 
-    if model == "gpt-4o-mini":
-        openai_cost = (
-            tokens["prompt_tokens"] * 0.00015 + tokens["completion_tokens"] * 0.0006
-        ) / 1000
-    else:
+    Tolerates text or code fences around the array. Items that are not
+    objects, have an unknown label or an id outside the batch are left out.
+    """
+    start, end = evaluation.find("["), evaluation.rfind("]")
+    if start == -1 or end < start:
+        return {}
+    try:
+        items = json.loads(evaluation[start:end + 1])
+    except json.JSONDecodeError:
+        return {}
+    if not isinstance(items, list):
+        return {}
+
+    parsed = {}
+    for position, item in enumerate(items):
+        if not isinstance(item, dict) or item.get("Relevance") not in RELEVANCE_LABELS:
+            continue
+        try:
+            key = int(item.get("id", position))
+        except (TypeError, ValueError):
+            continue
+        if 0 <= key < count and key not in parsed:
+            parsed[key] = {"Relevance": item["Relevance"], "Explanation": str(item.get("Explanation", ""))}
+    return parsed
+
+
+def split_tokens(total, weights):
+    """Split an integer token count proportionally to weights, keeping the sum exact."""
+    if not any(weights):
+        weights = [1] * len(weights)
+    weight_sum = sum(weights)
+    shares = [total * w / weight_sum for w in weights]
+    counts = [int(share) for share in shares]
+    # The rounding remainder goes to the largest fractional parts
+    by_fraction = sorted(range(len(shares)), key=lambda i: counts[i] - shares[i])
+    for i in by_fraction[:total - sum(counts)]:
+        counts[i] += 1
+    return counts
+
+
+def _evaluate_batch(pairs, timer=None, raise_errors=False):
+    items = [{"id": i, "question": question, "answer": answer} for i, (question, answer) in enumerate(pairs)]
+    prompt = batch_evaluation_prompt_template.format(count=len(items), items=json.dumps(items, indent=2))
+    import openai
+
+    try:
+        evaluation, tokens = llm(prompt, model=JUDGE_MODEL, timer=timer, stage="judge", raise_errors=True)
+    except openai.OpenAIError:
+        # Grading the items one by one would only add calls to an API that is failing
+        if raise_errors:
+            raise
+        failed = {"Relevance": "UNKNOWN", "Explanation": "Judge call failed"}
+        return [(dict(failed), dict(NO_TOKENS)) for _ in pairs]
+    parsed = parse_batch_evaluation(evaluation, len(pairs))
+
+    # The shared instructions are spread over the items in proportion to their size
+    prompt_shares = split_tokens(tokens["prompt_tokens"], [len(json.dumps(item)) for item in items])
+    completion_shares = split_tokens(
+        tokens["completion_tokens"],
+        [len(json.dumps(parsed[i])) if i in parsed else 0 for i in range(len(pairs))],
+    )
+
+    results = []
+    for i, (question, answer) in enumerate(pairs):
+        item_tokens = {
+            "prompt_tokens": prompt_shares[i],
+            "completion_tokens": completion_shares[i],
+            "total_tokens": prompt_shares[i] + completion_shares[i],
+        }
+        if i in parsed:
+            results.append((parsed[i], item_tokens))
+            continue
+
+        # The judge answered but this item could not be parsed: grade it on its own,
+        # keeping its share of the batch call
+        relevance, single_tokens = evaluate_relevance(question, answer, timer=timer, raise_errors=raise_errors)
+        results.append((relevance, {key: item_tokens[key] + single_tokens[key] for key in item_tokens}))
+
+    if len(parsed) < len(pairs):
+        logging.warning(f"Batched judge parsed {len(parsed)} of {len(pairs)} items, graded the rest one by one")
+    return results
+
+
+def evaluate_relevance_batch(pairs, batch_size=JUDGE_BATCH_SIZE, timer=None, raise_errors=False):
+    """
+    Grade many (question, answer) pairs, packing `batch_size` pairs per judge call.
+
+    Returns a (relevance, tokens) tuple per pair, like evaluate_relevance.
+    Each pair is attributed a share of its batch call's tokens, plus the
+    tokens of a single-pair call when its item could not be parsed. When the
+    batch call itself fails, its items are not retried one by one: they
+    raise with `raise_errors`, and are graded UNKNOWN otherwise.
+    """
+    results = []
+    for start in range(0, len(pairs), batch_size):
+        batch = pairs[start:start + batch_size]
+        if len(batch) == 1:
+            results.append(evaluate_relevance(*batch[0], timer=timer, raise_errors=raise_errors))
+        else:
+            results.extend(_evaluate_batch(batch, timer=timer, raise_errors=raise_errors))
+    return results
+
+
+def add_relevance(answer_data, relevance, tokens):
+    """Store a judge result and its cost in answer_data."""
+    answer_data["relevance"] = relevance.get("Relevance", "UNKNOWN")
+    answer_data["relevance_explanation"] = relevance.get("Explanation", "Failed to parse evaluation")
+    answer_data["eval_prompt_tokens"] = tokens["prompt_tokens"]
+    answer_data["eval_completion_tokens"] = tokens["completion_tokens"]
+    answer_data["eval_total_tokens"] = tokens["total_tokens"]
+    answer_data["openai_cost"] += calculate_openai_cost(JUDGE_MODEL, tokens)
+    return answer_data
+
+
+# USD per 1K prompt and completion tokens
+OPENAI_PRICES = {
+    "gpt-4o-mini": (0.00015, 0.0006),
+    "gpt-4.1-nano": (0.0001, 0.0004),
+    "gpt-4o": (0.0025, 0.01),
+    "gpt-3.5-turbo": (0.0005, 0.0015),
+}
+
+NO_TOKENS = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+
+
+def calculate_openai_cost(model, tokens):
+    # Dated snapshots like gpt-4o-mini-2024-07-18 are priced as their base model
+    prices = next(
+        (OPENAI_PRICES[name] for name in sorted(OPENAI_PRICES, key=len, reverse=True) if model.startswith(name)),
+        None,
+    )
+    if prices is None:
         print("Model not recognized. OpenAI cost calculation failed.")
+        return 0
 
-    return openai_cost
+    prompt_price, completion_price = prices
+    return (tokens["prompt_tokens"] * prompt_price + tokens["completion_tokens"] * completion_price) / 1000
 
 
-def rag(query, model="gpt-4o-mini"):
-    logging.info(f"Running RAG for query: {query}")
-    t0 = time()
+def stored_answer(doc):
+    # In passage mode the search result only carries the best passages of the answer
+    if documents_by_id is not None:
+        return documents_by_id[doc["id"]]["answer"]
+    return doc["answer"]
 
-    search_results = search(query)
-    prompt = build_prompt(query, search_results)
-    answer, token_stats = llm(prompt, model=model)
 
-    relevance, rel_token_stats = evaluate_relevance(query, answer)
+def rag(query, model="gpt-4o-mini", search_results=None, evaluate=True, raise_errors=False):
+    """
+    Answer a question and grade the answer.
 
-    t1 = time()
-    took = t1 - t0
+    `search_results` can be passed in when retrieval was already done, e.g.
+    for a whole batch of questions at once; embedding and search are skipped then.
+    With `evaluate=False` the judge is skipped, for callers that grade answers
+    in batches with evaluate_relevance_batch and add_relevance. With
+    `raise_errors=True` a failed answer or judge call raises instead of
+    being recorded as an error answer or an UNKNOWN grade.
 
-    openai_cost_rag = calculate_openai_cost(model, token_stats)
-    openai_cost_eval = calculate_openai_cost(model, rel_token_stats)
+    The search scores decide the route (see routing.py): a close match to a
+    stored entry is answered with its stored answer, and medium-confidence
+    questions can go to a cheaper model. Routing is off unless ROUTING=1.
+    """
+    logging.info(f"Running RAG for query: {query}")
+    warmup()
+    t0 = time()
+    timer = StageTimer()
+
+    if search_results is None:
+        with timer.stage("embedding"):
+            query_vector = encode_query(query)
+        with timer.stage("search"):
+            search_results = search_by_vector(query_vector)
+
+    route, answer_model = routing.choose_route(search_results, model)
+    if route == routing.FAQ:
+        # The question matches a stored one closely enough to reuse its curated answer
+        doc, score = search_results[0]
+        answer, token_stats, context_stats = stored_answer(doc), NO_TOKENS, {"context_tokens_saved": 0}
+        logging.info(f"Answering with a stored FAQ answer (similarity {score:.3f})")
+    else:
+        if reranker is not None:
+            # Fewer, better ordered documents make a shorter prompt
+            with timer.stage("rerank"):
+                search_results, _ = rerank.rerank(query, search_results, reranker)
+        with timer.stage("prompt_build"):
+            prompt, context_stats = build_prompt(query, search_results)
+        answer, token_stats = llm(prompt, model=answer_model, timer=timer, raise_errors=raise_errors)
+
+    # Stored answers are graded too: a close search score does not mean the entry answers the question
+    if evaluate:
+        relevance, rel_token_stats = evaluate_relevance(query, answer, timer=timer, raise_errors=raise_errors)
+    else:
+        relevance = {"Relevance": "UNKNOWN", "Explanation": "Not evaluated"}
+        rel_token_stats = NO_TOKENS
 
-    openai_cost = openai_cost_rag + openai_cost_eval
+    t1 = time()
+    took = t1 - t0
 
     answer_data = {
         "answer": answer,
         "response_time": took,
-        "relevance": relevance.get("Relevance", "UNKNOWN"),
-        "relevance_explanation": relevance.get(
-            "Explanation", "Failed to parse evaluation"
-        ),
         "prompt_tokens": token_stats["prompt_tokens"],
         "completion_tokens": token_stats["completion_tokens"],
         "total_tokens": token_stats["total_tokens"],
-        "eval_prompt_tokens": rel_token_stats["prompt_tokens"],
-        "eval_completion_tokens": rel_token_stats["completion_tokens"],
-        "eval_total_tokens": rel_token_stats["total_tokens"],
-        "openai_cost": openai_cost,
+        "openai_cost": calculate_openai_cost(answer_model, token_stats) if answer_model else 0,
+        "route": route,
+        "model_used": answer_model,
+        "context_tokens_saved": context_stats["context_tokens_saved"],
+        "stage_timings": timer.spans,
     }
+    add_relevance(answer_data, relevance, rel_token_stats)
 
     return answer_data
 logging.info("LLM response generated successfully.")
@@ -0,0 +1,216 @@
+import os
+import re
+import logging
+import argparse
+from time import perf_counter
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# "linear", "cross-encoder", or empty to keep the search order
+RERANKER = os.getenv("RERANKER", "")
+RERANK_MODEL = os.getenv("RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+RERANK_BUDGET_MS = float(os.getenv("RERANK_BUDGET_MS", "100"))
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", "4"))
+# Documents kept for the prompt after re-ranking
+RERANK_TOP_N = int(os.getenv("RERANK_TOP_N", "5"))
+# Feature weights then bias, comma separated, as printed by `python rerank.py`
+RERANK_WEIGHTS = os.getenv("RERANK_WEIGHTS", "")
+
+FEATURES = ["vector_score", "reciprocal_rank", "question_overlap", "answer_overlap", "focus_area_overlap"]
+WORD = re.compile(r"[a-z0-9]+")
+
+
+def _words(text):
+    return {w for w in WORD.findall((text or "").lower()) if len(w) > 2}
+
+
+def features(query, candidates, first_rank=0):
+    """
+    Lexical and vector features of (document, score) candidates for a query.
+
+    Returns:
+        np.ndarray: One row per candidate, one column per name in FEATURES.
+    """
+    query_words = _words(query)
+    rows = []
+    for rank, (doc, score) in enumerate(candidates, start=first_rank):
+        focus_words = _words(doc.get("focus_area"))
+        rows.append([
+            score,
+            1 / (rank + 1),
+            len(query_words & _words(doc["question"])) / max(1, len(query_words)),
+            len(query_words & _words(doc["answer"])) / max(1, len(query_words)),
+            len(query_words & focus_words) / max(1, len(focus_words)),
+        ])
+    return np.array(rows, dtype=np.float64).reshape(-1, len(FEATURES))
+
+
+class LinearReranker:
+    """
+    Scores candidates with a linear model over `features`.
+
+    With the default weights it keeps the search order; fit weights on the
+    ground truth with `python rerank.py` and set them in RERANK_WEIGHTS.
+    """
+
+    name = "linear"
+
+    def __init__(self, weights=None, bias=0.0):
+        if weights is None:
+            weights, bias = self.parse_weights(RERANK_WEIGHTS)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.bias = bias
+
+    @staticmethod
+    def parse_weights(spec):
+        if not spec:
+            return [1.0] + [0.0] * (len(FEATURES) - 1), 0.0
+        values = [float(value) for value in spec.split(",")]
+        if len(values) != len(FEATURES) + 1:
+            raise ValueError(f"RERANK_WEIGHTS needs {len(FEATURES) + 1} values: {', '.join(FEATURES)}, bias")
+        return values[:-1], values[-1]
+
+    def score(self, query, candidates, first_rank=0):
+        return features(query, candidates, first_rank) @ self.weights + self.bias
+
+
+class CrossEncoderReranker:
+    """Scores query and document pairs with a small cross-encoder on CPU."""
+
+    name = "cross-encoder"
+
+    def __init__(self, model_name=RERANK_MODEL):
+        # Imported here because sentence_transformers takes seconds to import
+        from sentence_transformers import CrossEncoder
+
+        self.model = CrossEncoder(model_name, device="cpu")
+
+    def score(self, query, candidates, first_rank=0):
+        pairs = [(query, doc["question"] + " " + doc["answer"]) for doc, _ in candidates]
+        return np.asarray(self.model.predict(pairs, batch_size=len(pairs), show_progress_bar=False))
+
+
+RERANKERS = {reranker.name: reranker for reranker in (LinearReranker, CrossEncoderReranker)}
+
+
+def get_reranker(name=RERANKER):
+    """Create a reranker by name, or return None when re-ranking is off."""
+    if not name:
+        return None
+    if name not in RERANKERS:
+        raise ValueError(f"Unknown reranker {name!r}, expected one of {', '.join(RERANKERS)}")
+    return RERANKERS[name]()
+
+
+def rerank(query, search_results, reranker, budget_ms=RERANK_BUDGET_MS, batch_size=RERANK_BATCH_SIZE,
+           top_n=RERANK_TOP_N):
+    """
+    Re-order search results by reranker score within a time budget.
+
+    Candidates are scored in batches. A batch is only started if it is
+    expected to finish within the budget, judging by the slowest batch so
+    far. If a batch is not expected to fit, or one overruns the budget, the
+    search order is kept, with all results.
+
+    Args:
+        query (str): The question.
+        search_results (list): (document, score) pairs from the index, best first.
+        reranker: An object with a `score(query, candidates, first_rank)` method.
+
+    Returns:
+        tuple: The results and whether they were re-ranked. Re-ranked results are the
+            best `top_n` (document, reranker score) pairs.
+    """
+    start = perf_counter()
+    deadline = start + budget_ms / 1000
+    scores = []
+    slowest = 0.0
+    for first in range(0, len(search_results), batch_size):
+        batch_start = perf_counter()
+        if batch_start + slowest > deadline:
+            logging.warning(f"Re-ranking stopped after {first} of {len(search_results)} candidates, "
+                            f"keeping the search order")
+            return search_results, False
+        scores.extend(reranker.score(query, search_results[first:first + batch_size], first))
+        batch_end = perf_counter()
+        if batch_end > deadline:
+            logging.warning(f"Re-ranking overran its {budget_ms:.0f} ms budget, keeping the search order")
+            return search_results, False
+        slowest = max(slowest, batch_end - batch_start)
+
+    # The results carry the reranker score, which build_context orders by
+    order = np.argsort(-np.asarray(scores), kind="stable")[:top_n]
+    return [(search_results[i][0], float(scores[i])) for i in order], True
+
+
+def _report(name, ground_truth, results, latencies=None, fallbacks=0):
+    import evaluate
+    from context_builder import count_tokens, format_entry
+
+    relevance = [[doc["id"] == q["id"] for doc, _ in r] for q, r in zip(ground_truth, results)]
+    context_tokens = sum(count_tokens(format_entry(doc)) for r in results for doc, _ in r) / len(results)
+    line = (f"{name:>20}: MRR {evaluate.mrr(relevance):.4f}, hit rate {evaluate.hit_rate(relevance):.4f}, "
+            f"avg context tokens {context_tokens:.0f}")
+    if latencies is not None:
+        line += (f", latency p50 {np.percentile(latencies, 50):.2f} ms p95 {np.percentile(latencies, 95):.2f} ms, "
+                 f"{fallbacks} fallbacks")
+    print(line)
+
+
+def main():
+    """Fit the linear reranker on the ground truth and compare MRR and latency with the search order."""
+    import rag
+    import ingest
+    from sklearn.linear_model import LogisticRegression
+
+    parser = argparse.ArgumentParser(description="Fit and evaluate the reranker on the retrieval ground truth")
+    parser.add_argument("--test-share", type=float, default=0.2, help="Share of documents held out for evaluation")
+    parser.add_argument("--cross-encoder", action="store_true", help=f"Also evaluate {RERANK_MODEL}")
+    parser.add_argument("--budget-ms", type=float, default=RERANK_BUDGET_MS)
+    parser.add_argument("--top-n", type=int, default=RERANK_TOP_N)
+    args = parser.parse_args()
+
+    rag.warmup()
+    ground_truth = ingest.fetch_ground_truth()
+    questions = [q["question"] for q in ground_truth]
+    vectors = ingest.encode_in_batches(rag.model, questions, desc="Encoding questions")
+    results = [rag.search_by_vector(vector.reshape(1, -1)) for vector in vectors]
+
+    # Split by document, so that no test question has a paraphrase in training
+    doc_ids = sorted({q["id"] for q in ground_truth})
+    rng = np.random.default_rng(1)
+    test_ids = set(rng.choice(doc_ids, size=int(len(doc_ids) * args.test_share), replace=False))
+    train = [i for i, q in enumerate(ground_truth) if q["id"] not in test_ids]
+    test = [i for i, q in enumerate(ground_truth) if q["id"] in test_ids]
+
+    x = np.vstack([features(questions[i], results[i]) for i in train])
+    y = np.concatenate([[doc["id"] == ground_truth[i]["id"] for doc, _ in results[i]] for i in train])
+    classifier = LogisticRegression(max_iter=1000).fit(x, y)
+    linear = LinearReranker(classifier.coef_[0], float(classifier.intercept_[0]))
+
+    test_truth = [ground_truth[i] for i in test]
+    print(f"{len(train)} training and {len(test)} test questions")
+    _report("search order", test_truth, [results[i] for i in test])
+    _report(f"search order, top {args.top_n}", test_truth, [results[i][:args.top_n] for i in test])
+
+    rerankers = [linear] + ([CrossEncoderReranker()] if args.cross_encoder else [])
+    for reranker in rerankers:
+        reranked, latencies, fallbacks = [], [], 0
+        for i in test:
+            start = perf_counter()
+            r, done = rerank(questions[i], results[i], reranker, budget_ms=args.budget_ms, top_n=args.top_n)
+            latencies.append((perf_counter() - start) * 1000)
+            fallbacks += not done
+            reranked.append(r)
+        _report(f"{reranker.name}, top {args.top_n}", test_truth, reranked, latencies, fallbacks)
+
+    print("\nSetting for .env:")
+    print("RERANK_WEIGHTS=" + ",".join(f"{w:.4f}" for w in [*linear.weights, linear.bias]))
+    return linear
+
+
+if __name__ == "__main__":
+    main()
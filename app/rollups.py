@@ -0,0 +1,269 @@
+import os
+import gzip
+import time
+import logging
+import argparse
+from datetime import datetime, timedelta, timezone
+
+from dotenv import load_dotenv
+
+from db import get_db_connection
+
+load_dotenv()
+
+GRANULARITIES = ["minute", "hour"]
+
+ROLLUP_INTERVAL = float(os.getenv("ROLLUP_INTERVAL", "60"))
+ROLLUP_LATENESS = float(os.getenv("ROLLUP_LATENESS", "300"))
+RAW_RETENTION_DAYS = float(os.getenv("RAW_RETENTION_DAYS", "30"))
+MINUTE_ROLLUP_RETENTION_DAYS = float(os.getenv("MINUTE_ROLLUP_RETENTION_DAYS", "7"))
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))
+ROLLUP_ARCHIVE_DIR = os.getenv("ROLLUP_ARCHIVE_DIR")
+
+# Each rollup recomputes whole buckets from the raw table, starting at the
+# bucket that contains (watermark - lateness), so percentiles stay exact and
+# rows committed a little after their timestamp are still counted.
+ROLLUPS = {
+    "conversation_rollups": """
+        INSERT INTO conversation_rollups
+        (granularity, bucket, conversations, response_time_avg, response_time_p50,
+        response_time_p95, response_time_p99, relevant, partly_relevant, non_relevant,
+        prompt_tokens, completion_tokens, total_tokens, eval_total_tokens, openai_cost)
+        SELECT
+            %(granularity)s,
+            date_trunc(%(granularity)s, timestamp) AS bucket,
+            COUNT(*),
+            AVG(response_time),
+            percentile_cont(0.5) WITHIN GROUP (ORDER BY response_time),
+            percentile_cont(0.95) WITHIN GROUP (ORDER BY response_time),
+            percentile_cont(0.99) WITHIN GROUP (ORDER BY response_time),
+            COUNT(*) FILTER (WHERE relevance = 'RELEVANT'),
+            COUNT(*) FILTER (WHERE relevance = 'PARTLY_RELEVANT'),
+            COUNT(*) FILTER (WHERE relevance = 'NON_RELEVANT'),
+            SUM(prompt_tokens),
+            SUM(completion_tokens),
+            SUM(total_tokens),
+            SUM(eval_total_tokens),
+            SUM(openai_cost)
+        FROM conversations
+        WHERE timestamp >= date_trunc(%(granularity)s, %(since)s::timestamptz)
+        GROUP BY bucket
+        ON CONFLICT (granularity, bucket) DO UPDATE SET
+            conversations = EXCLUDED.conversations,
+            response_time_avg = EXCLUDED.response_time_avg,
+            response_time_p50 = EXCLUDED.response_time_p50,
+            response_time_p95 = EXCLUDED.response_time_p95,
+            response_time_p99 = EXCLUDED.response_time_p99,
+            relevant = EXCLUDED.relevant,
+            partly_relevant = EXCLUDED.partly_relevant,
+            non_relevant = EXCLUDED.non_relevant,
+            prompt_tokens = EXCLUDED.prompt_tokens,
+            completion_tokens = EXCLUDED.completion_tokens,
+            total_tokens = EXCLUDED.total_tokens,
+            eval_total_tokens = EXCLUDED.eval_total_tokens,
+            openai_cost = EXCLUDED.openai_cost
+    """,
+    "feedback_rollups": """
+        INSERT INTO feedback_rollups (granularity, bucket, thumbs_up, thumbs_down)
+        SELECT
+            %(granularity)s,
+            date_trunc(%(granularity)s, timestamp) AS bucket,
+            COUNT(*) FILTER (WHERE feedback > 0),
+            COUNT(*) FILTER (WHERE feedback < 0)
+        FROM feedback
+        WHERE timestamp >= date_trunc(%(granularity)s, %(since)s::timestamptz)
+        GROUP BY bucket
+        ON CONFLICT (granularity, bucket) DO UPDATE SET
+            thumbs_up = EXCLUDED.thumbs_up,
+            thumbs_down = EXCLUDED.thumbs_down
+    """,
+    "stage_timing_rollups": """
+        INSERT INTO stage_timing_rollups (granularity, bucket, stage, requests, p50, p95, p99)
+        SELECT
+            %(granularity)s,
+            date_trunc(%(granularity)s, timestamp) AS bucket,
+            stage,
+            COUNT(*),
+            percentile_cont(0.5) WITHIN GROUP (ORDER BY duration_ms),
+            percentile_cont(0.95) WITHIN GROUP (ORDER BY duration_ms),
+            percentile_cont(0.99) WITHIN GROUP (ORDER BY duration_ms)
+        FROM stage_timings
+        WHERE timestamp >= date_trunc(%(granularity)s, %(since)s::timestamptz)
+        GROUP BY bucket, stage
+        ON CONFLICT (granularity, bucket, stage) DO UPDATE SET
+            requests = EXCLUDED.requests,
+            p50 = EXCLUDED.p50,
+            p95 = EXCLUDED.p95,
+            p99 = EXCLUDED.p99
+    """,
+    # Conversations saved before routing existed have no route; the FAQ route has no model
+    "route_rollups": """
+        INSERT INTO route_rollups (granularity, bucket, route, model_used, conversations)
+        SELECT
+            %(granularity)s,
+            date_trunc(%(granularity)s, timestamp) AS bucket,
+            COALESCE(route, 'unknown') AS route_name,
+            COALESCE(model_used, '') AS model_name,
+            COUNT(*)
+        FROM conversations
+        WHERE timestamp >= date_trunc(%(granularity)s, %(since)s::timestamptz)
+        GROUP BY bucket, route_name, model_name
+        ON CONFLICT (granularity, bucket, route, model_used) DO UPDATE SET
+            conversations = EXCLUDED.conversations
+    """,
+}
+
+# Raw rows to drop for a retention cutoff, by the rollups that aggregate them.
+# Each table is pruned by its own timestamp; a conversation is kept while
+# feedback or stage timings still refer to it, and goes on a later run.
+RAW_TABLES = {
+    "stage_timings": (["stage_timing_rollups"], "timestamp < %(cutoff)s"),
+    "feedback": (["feedback_rollups"], "timestamp < %(cutoff)s"),
+    "conversations": (["conversation_rollups", "route_rollups"], """
+        timestamp < %(cutoff)s
+        AND NOT EXISTS (SELECT 1 FROM feedback f WHERE f.conversation_id = conversations.id)
+        AND NOT EXISTS (SELECT 1 FROM stage_timings s WHERE s.conversation_id = conversations.id)
+    """),
+}
+
+
+def refresh_rollups(conn, lateness=ROLLUP_LATENESS):
+    """
+    Bring every rollup up to date with the raw tables.
+
+    Only buckets at or after each rollup's watermark (minus `lateness`
+    seconds) are recomputed, so the cost of a refresh depends on the traffic
+    since the previous one, not on the size of the raw tables.
+
+    Returns:
+        dict: Number of buckets written per rollup and granularity.
+    """
+    written = {}
+    with conn.cursor() as cur:
+        cur.execute("SELECT now()")
+        started = cur.fetchone()[0]
+        for table, sql in ROLLUPS.items():
+            for granularity in GRANULARITIES:
+                name = f"{table}:{granularity}"
+                cur.execute("SELECT watermark FROM rollup_watermarks WHERE name = %s", (name,))
+                row = cur.fetchone()
+                since = row[0] - timedelta(seconds=lateness) if row else datetime.fromtimestamp(0, timezone.utc)
+
+                cur.execute(sql, {"granularity": granularity, "since": since})
+                written[name] = cur.rowcount
+                cur.execute(
+                    """
+                    INSERT INTO rollup_watermarks (name, watermark) VALUES (%s, %s)
+                    ON CONFLICT (name) DO UPDATE SET watermark = EXCLUDED.watermark
+                    """,
+                    (name, started),
+                )
+    conn.commit()
+    return written
+
+
+def retention_cutoff(conn, rollups, retention_days=RAW_RETENTION_DAYS, lateness=ROLLUP_LATENESS):
+    """
+    Oldest timestamp the raw rows behind `rollups` must be kept from.
+
+    The cutoff never passes the earliest bucket a refresh of any of those
+    rollups could still recompute, so pruning cannot shrink an existing bucket.
+    Returns None while one of the rollups has never been refreshed.
+    """
+    names = [f"{rollup}:{granularity}" for rollup in rollups for granularity in GRANULARITIES]
+    with conn.cursor() as cur:
+        cur.execute("SELECT COUNT(*), MIN(watermark) FROM rollup_watermarks WHERE name = ANY(%s)", (names,))
+        count, oldest = cur.fetchone()
+        if count < len(names):
+            return None
+        cur.execute(
+            "SELECT LEAST(now() - %s * interval '1 day', date_trunc('hour', %s::timestamptz - %s * interval '1 second'))",
+            (retention_days, oldest, lateness),
+        )
+        return cur.fetchone()[0]
+
+
+def archive_rows(cur, table, where, params, archive_dir):
+    query = cur.mogrify(f"SELECT * FROM {table} WHERE {where}", params).decode()
+    path = os.path.join(archive_dir, f"{table}-{params['cutoff']:%Y%m%dT%H%M%S}.csv.gz")
+    with gzip.open(path, "wb") as f:
+        cur.copy_expert(f"COPY ({query}) TO STDOUT WITH CSV HEADER", f)
+    return path
+
+
+def apply_retention(conn, retention_days=RAW_RETENTION_DAYS,
+                    minute_retention_days=MINUTE_ROLLUP_RETENTION_DAYS, archive_dir=ROLLUP_ARCHIVE_DIR):
+    """
+    Prune raw rows older than the retention window and old minute buckets.
+
+    Each raw table is pruned up to its own cutoff (see retention_cutoff).
+    Raw rows are written to gzipped CSV files in `archive_dir` before being
+    deleted when it is set. Hourly rollups are kept; they are what the
+    dashboards read for long time ranges.
+
+    Returns:
+        dict: Number of rows deleted per table.
+    """
+    deleted = {}
+    if archive_dir:
+        os.makedirs(archive_dir, exist_ok=True)
+    with conn.cursor() as cur:
+        for table, (rollups, where) in RAW_TABLES.items():
+            cutoff = retention_cutoff(conn, rollups, retention_days)
+            if cutoff is None:
+                logging.warning(f"{', '.join(rollups)} not refreshed yet, keeping raw {table} rows")
+                continue
+            params = {"cutoff": cutoff}
+            if archive_dir:
+                archive_rows(cur, table, where, params, archive_dir)
+            cur.execute(f"DELETE FROM {table} WHERE {where}", params)
+            deleted[table] = cur.rowcount
+
+        for table in ROLLUPS:
+            cur.execute(
+                f"DELETE FROM {table} WHERE granularity = 'minute' AND bucket < now() - %s * interval '1 day'",
+                (minute_retention_days,),
+            )
+            deleted[f"{table}:minute"] = cur.rowcount
+    conn.commit()
+    return deleted
+
+
+def run(interval=ROLLUP_INTERVAL, retention_interval=RETENTION_INTERVAL, once=False, retention=True):
+    last_retention = None
+    while True:
+        conn = get_db_connection()
+        try:
+            start = time.perf_counter()
+            written = refresh_rollups(conn)
+            print(f"Refreshed rollups in {time.perf_counter() - start:.2f}s: {written}")
+
+            if retention and (last_retention is None or time.monotonic() - last_retention >= retention_interval):
+                deleted = apply_retention(conn)
+                last_retention = time.monotonic()
+                print(f"Applied retention: {deleted}")
+        except Exception as e:
+            logging.error(f"Rollup refresh failed: {e}")
+            conn.rollback()
+            if once:
+                raise
+        finally:
+            conn.close()
+
+        if once:
+            return
+        time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain monitoring rollups and prune raw rows")
+    parser.add_argument("--once", action="store_true", help="Refresh once and exit")
+    parser.add_argument("--interval", type=float, default=ROLLUP_INTERVAL, help="Seconds between refreshes")
+    parser.add_argument("--no-retention", action="store_true", help="Only refresh, never delete rows")
+    args = parser.parse_args()
+
+    run(args.interval, once=args.once, retention=not args.no_retention)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import os
+import argparse
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Off by default: the thresholds below are uncalibrated placeholders. The scores compare the
+# question with each entry's question and answer embedding, so their scale depends on the
+# corpus; run `python routing.py` and set both thresholds before turning routing on
+ROUTING = os.getenv("ROUTING", "0") == "1"
+# Similarity of the best search result above which its stored answer is returned
+ROUTE_FAQ_THRESHOLD = float(os.getenv("ROUTE_FAQ_THRESHOLD", "0.9"))
+# Similarity above which the answer is generated with ROUTE_CHEAP_MODEL
+ROUTE_CHEAP_THRESHOLD = float(os.getenv("ROUTE_CHEAP_THRESHOLD", "0.8"))
+# Must differ from the requested model (OPENAI_MODEL, gpt-4o-mini by default) for the cheap route to be used
+ROUTE_CHEAP_MODEL = os.getenv("ROUTE_CHEAP_MODEL", "gpt-4.1-nano")
+ROUTE_TARGET_PRECISION = float(os.getenv("ROUTE_TARGET_PRECISION", "0.95"))
+
+# Routes recorded with each conversation
+FAQ = "faq"
+CHEAP = "cheap"
+LLM = "llm"
+
+
+def choose_route(search_results, model, faq_threshold=None, cheap_threshold=None, cheap_model=None):
+    """
+    Pick how to answer a question from the scores of its search results.
+
+    Args:
+        search_results (list): (document, score) pairs, best first.
+        model (str): Model asked for by the caller.
+
+    Returns:
+        tuple: The route, and the model to answer with (None for the FAQ route).
+    """
+    faq_threshold = ROUTE_FAQ_THRESHOLD if faq_threshold is None else faq_threshold
+    cheap_threshold = ROUTE_CHEAP_THRESHOLD if cheap_threshold is None else cheap_threshold
+    cheap_model = cheap_model or ROUTE_CHEAP_MODEL
+
+    if not ROUTING or not search_results:
+        return LLM, model
+    top_score = search_results[0][1]
+    if top_score >= faq_threshold:
+        return FAQ, None
+    if top_score >= cheap_threshold and cheap_model != model:
+        return CHEAP, cheap_model
+    return LLM, model
+
+
+def calibrate_threshold(scores, correct, target_precision):
+    """
+    Lowest score threshold at which routed questions are still right often enough.
+
+    Args:
+        scores (np.ndarray): Top search score of each question.
+        correct (np.ndarray): Whether routing that question would have been right.
+        target_precision (float): Share of routed questions that must be right.
+
+    Returns:
+        tuple: The threshold (inf if no threshold reaches the target) and the share of questions routed.
+    """
+    order = np.argsort(-scores, kind="stable")
+    precision = np.cumsum(correct[order]) / np.arange(1, len(order) + 1)
+    reached = np.flatnonzero(precision >= target_precision)
+    if reached.size == 0:
+        return float("inf"), 0.0
+    last = reached[-1]
+    threshold = scores[order][last]
+    return float(threshold), float(np.mean(scores >= threshold))
+
+
+def main():
+    """Calibrate the routing thresholds on the retrieval ground truth."""
+    import rag
+    import ingest
+
+    parser = argparse.ArgumentParser(description="Calibrate the routing thresholds on the retrieval ground truth")
+    parser.add_argument("--target-precision", type=float, default=ROUTE_TARGET_PRECISION,
+                        help="Share of routed questions whose search results must be right")
+    args = parser.parse_args()
+
+    rag.warmup()
+    ground_truth = ingest.fetch_ground_truth()
+    questions = [q["question"] for q in ground_truth]
+    vectors = ingest.encode_in_batches(rag.model, questions, desc="Encoding questions")
+    results = [rag.search_by_vector(vector.reshape(1, -1)) for vector in vectors]
+
+    scores = np.array([r[0][1] if r else 0.0 for r in results])
+    # The stored answer is only right if the best result is the question's document;
+    # a generated answer only needs the document somewhere in the context
+    top_hit = np.array([bool(r) and r[0][0]["id"] == q["id"] for q, r in zip(ground_truth, results)])
+    any_hit = np.array([any(d["id"] == q["id"] for d, _ in r) for q, r in zip(ground_truth, results)])
+
+    faq_threshold, faq_share = calibrate_threshold(scores, top_hit, args.target_precision)
+    cheap_threshold, cheap_share = calibrate_threshold(scores, any_hit, args.target_precision)
+    cheap_threshold = min(cheap_threshold, faq_threshold)
+
+    print(f"{len(questions)} questions, top score range {scores.min():.3f} to {scores.max():.3f}")
+    print(f"FAQ route: threshold {faq_threshold:.4f}, {faq_share:.1%} of questions")
+    print(f"Cheap route: threshold {cheap_threshold:.4f}, {cheap_share - faq_share:.1%} of questions")
+    print(f"LLM route: {1 - max(cheap_share, faq_share):.1%} of questions")
+    print("\nSettings for .env:")
+    print(f"ROUTE_FAQ_THRESHOLD={faq_threshold:.4f}")
+    print(f"ROUTE_CHEAP_THRESHOLD={cheap_threshold:.4f}")
+    return faq_threshold, cheap_threshold
+
+
+if __name__ == "__main__":
+    main()
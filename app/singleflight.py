@@ -0,0 +1,61 @@
+import copy
+import threading
+import unicodedata
+from concurrent.futures import Future
+
+
+def normalize_question(question):
+    """Key for questions that should share an answer: case, spacing and end punctuation are ignored."""
+    text = unicodedata.normalize("NFKC", question).casefold()
+    return " ".join(text.split()).rstrip(" ?!.")
+
+
+class SingleFlight:
+    """
+    Runs a function once per key for all callers that arrive while it is running.
+
+    The first caller for a key executes the function; callers arriving with
+    the same key before it finishes wait for that execution. Every caller
+    gets its own deep copy of the result, or the exception. Nothing is kept
+    once the call finishes, so this is not a cache.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._stats = {"calls": 0, "shared": 0}
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Call `fn(*args, **kwargs)`, or join an in-flight call with the same key.
+
+        Returns:
+            tuple: The result and whether it was shared from another caller's execution.
+        """
+        with self._lock:
+            self._stats["calls"] += 1
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+            else:
+                self._stats["shared"] += 1
+
+        if not leader:
+            return copy.deepcopy(future.result()), True
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return copy.deepcopy(result), False
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, in_flight=len(self._calls))
@@ -0,0 +1,127 @@
+import os
+import sys
+import logging
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+THREAD_BUDGET = os.getenv("THREAD_BUDGET", "1") == "1"
+# Processes on this host that share its CPUs, e.g. the app, ingest and batch workers
+THREAD_BUDGET_WORKERS = int(os.getenv("THREAD_BUDGET_WORKERS", "1"))
+# Threads per process; 0 divides the available CPUs between the workers
+THREAD_BUDGET_THREADS = int(os.getenv("THREAD_BUDGET_THREADS", "0"))
+TORCH_INTEROP_THREADS = int(os.getenv("TORCH_INTEROP_THREADS", "1"))
+
+# Read by OpenMP, the BLAS libraries and numexpr when they are loaded
+THREAD_ENV_VARS = [
+    "OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS",
+]
+
+_budget = None
+
+
+def available_cpus():
+    """CPUs this process may use, taking CPU affinity and a cgroup CPU quota (e.g. Docker --cpus) into account."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = _cgroup_quota()
+    if quota is not None:
+        cpus = min(cpus, max(1, quota))
+    return cpus
+
+
+def _cgroup_quota():
+    # cgroup v2 exposes "<quota> <period>", or "max <period>" when unlimited
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        return None if quota == "max" else int(quota) // int(period)
+    except (OSError, ValueError):
+        pass
+    # cgroup v1 has separate files, with a quota of -1 when unlimited
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        return None if quota <= 0 else quota // period
+    except (OSError, ValueError):
+        return None
+
+
+def configure(workers=None, threads=None, interop_threads=None):
+    """
+    Limit the threads of every native thread pool in this process.
+
+    Call it once at startup, ideally before torch is imported. Libraries
+    loaded later pick the limit up from the environment variables, those
+    already loaded are limited with threadpoolctl, and torch is limited
+    directly. Later calls return the budget already in place.
+
+    Args:
+        workers (int, optional): Processes sharing the host. Defaults to THREAD_BUDGET_WORKERS.
+        threads (int, optional): Threads for this process. Defaults to THREAD_BUDGET_THREADS,
+            or the available CPUs divided by the workers.
+        interop_threads (int, optional): torch inter-op threads. Defaults to TORCH_INTEROP_THREADS.
+
+    Returns:
+        dict: The budget, or None when THREAD_BUDGET is off.
+    """
+    global _budget
+    if not THREAD_BUDGET or _budget is not None:
+        return _budget
+
+    workers = workers or THREAD_BUDGET_WORKERS
+    threads = threads or THREAD_BUDGET_THREADS or max(1, available_cpus() // workers)
+    interop_threads = interop_threads or TORCH_INTEROP_THREADS
+
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(threads)
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(limits=threads)
+
+    _budget = {"workers": workers, "threads": threads, "interop_threads": interop_threads}
+    if "torch" in sys.modules:
+        apply_torch()
+    logging.info(f"Thread budget: {threads} threads per process for {workers} workers")
+    return _budget
+
+
+def threads():
+    """Threads per process under the budget, or 0 when there is none."""
+    return _budget["threads"] if _budget else 0
+
+
+def apply_torch():
+    """Apply the budget to torch, importing it; call before the first model is run."""
+    if _budget is None:
+        return
+    import torch
+
+    torch.set_num_threads(_budget["threads"])
+    try:
+        torch.set_num_interop_threads(_budget["interop_threads"])
+    except RuntimeError:
+        # Only possible before any inter-op parallel work has started
+        logging.warning("torch inter-op threads were already in use and could not be limited")
+
+
+def report():
+    """The effective thread settings of this process."""
+    settings = {
+        "cpus": available_cpus(),
+        "budget": _budget,
+        "env": {var: os.environ.get(var) for var in THREAD_ENV_VARS},
+    }
+    from threadpoolctl import threadpool_info
+    settings["threadpools"] = [
+        {"library": os.path.basename(pool["filepath"]), "api": pool["internal_api"], "threads": pool["num_threads"]}
+        for pool in threadpool_info()
+    ]
+    if "torch" in sys.modules:
+        torch = sys.modules["torch"]
+        settings["torch"] = {"threads": torch.get_num_threads(), "interop_threads": torch.get_num_interop_threads()}
+    return settings
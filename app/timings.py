@@ -0,0 +1,28 @@
+from time import perf_counter
+from contextlib import contextmanager
+
+
+class StageTimer:
+    """
+    Collects how long each stage of a request took, in milliseconds.
+
+    Usage:
+        timer = StageTimer()
+        with timer.stage("search"):
+            ...
+        timer.spans  # {"search": 12.3}
+    """
+
+    def __init__(self):
+        self.spans = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, perf_counter() - start)
+
+    def record(self, name, seconds):
+        self.spans[name] = self.spans.get(name, 0.0) + seconds * 1000
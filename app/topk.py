@@ -0,0 +1,81 @@
+import numpy as np
+
+DEFAULT_BLOCK_SIZE = 4096
+
+
+def _select(indices, scores, k):
+    """Positions of the k best rows, breaking ties at the k-th score by row like the final sort."""
+    threshold = -np.partition(-scores, k - 1)[k - 1]
+    above = np.flatnonzero(scores > threshold)
+    tied = np.flatnonzero(scores == threshold)
+    tied = tied[np.argsort(indices[tied], kind="stable")[:k - len(above)]]
+    return np.concatenate([above, tied])
+
+
+def top_k(score_rows, num_docs, num_results, candidates=None, offset=0, min_score=None,
+          after=None, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Select the highest scoring rows without materializing every score at once.
+
+    Rows are scored block by block and only the running best `offset + num_results`
+    rows are kept between blocks, so memory per query is bounded by the block size
+    rather than the corpus size. Asking for more results than there are rows is fine.
+
+    Every page rescores all rows. Paging with `offset` also keeps every row of the
+    earlier pages, so deep pages grow with the offset; paging with `after`, the
+    last result of the previous page, keeps only `num_results`.
+
+    Args:
+        score_rows (callable): Takes a slice or an array of row indices and returns their scores.
+        num_docs (int): Total number of rows in the index.
+        num_results (int): Number of results to return.
+        candidates (array-like, optional): Only score these row indices, e.g. rows left by a filter.
+        offset (int): Number of top results to skip, for pagination.
+        min_score (float, optional): Minimum score a result must reach. By default only
+            results with a positive score are returned.
+        after (tuple, optional): (score, row index) of the last result of the previous
+            page; only results ranked after it are returned.
+        block_size (int): Number of rows scored at a time.
+
+    Returns:
+        list of tuple: (row index, score) pairs sorted by descending score.
+    """
+    k = offset + num_results
+    if k <= 0:
+        return []
+
+    if candidates is not None:
+        candidates = np.asarray(candidates, dtype=np.int64)
+        total = len(candidates)
+    else:
+        total = num_docs
+
+    best_indices = np.empty(0, dtype=np.int64)
+    best_scores = np.empty(0, dtype=np.float64)
+
+    for start in range(0, total, block_size):
+        stop = min(start + block_size, total)
+        if candidates is None:
+            rows = slice(start, stop)
+            indices = np.arange(start, stop)
+        else:
+            rows = indices = candidates[start:stop]
+
+        scores = np.asarray(score_rows(rows), dtype=np.float64).ravel()
+        keep = scores > 0 if min_score is None else scores >= min_score
+        if after is not None:
+            # Results are ranked by descending score, then by row
+            after_score, after_row = after
+            keep &= (scores < after_score) | ((scores == after_score) & (indices > after_row))
+
+        best_indices = np.concatenate([best_indices, indices[keep]])
+        best_scores = np.concatenate([best_scores, scores[keep]])
+
+        if len(best_scores) > k:
+            selected = _select(best_indices, best_scores, k)
+            best_indices = best_indices[selected]
+            best_scores = best_scores[selected]
+
+    # Sort by descending score, breaking ties by row order to keep pages stable
+    order = np.lexsort((best_indices, -best_scores))[offset:k]
+    return [(int(best_indices[i]), float(best_scores[i])) for i in order]
@@ -19,6 +19,9 @@ PG_USER = os.getenv("POSTGRES_USER")
 PG_PASSWORD = os.getenv("POSTGRES_PASSWORD")
 PG_PORT = os.getenv("POSTGRES_PORT")
 
+# How long rollups.py keeps minute buckets; older ranges are read from hourly buckets
+MINUTE_ROLLUP_RETENTION_DAYS = os.getenv("MINUTE_ROLLUP_RETENTION_DAYS", "7")
+
 
 def create_api_key():
     auth = (GRAFANA_USER, GRAFANA_PASSWORD)
@@ -115,6 +118,109 @@ def create_or_update_datasource(api_key):
         return None
 
 
+STAGES = [
+    "embedding", "search", "rerank", "prompt_build", "llm_queue", "llm_ttft", "llm", "judge_queue", "judge", "db_write",
+]
+PERCENTILES = [("p50", 0.5), ("p95", 0.95), ("p99", 0.99)]
+
+# Dashboards read rollups.py tables: minute buckets for short ranges within
+# MINUTE_ROLLUP_RETENTION_DAYS, hourly otherwise. dashboard.json is written for
+# the default of 7 days and is adjusted to the setting when it is uploaded.
+DASHBOARD_MINUTE_RETENTION = "now() - interval '7 days'"
+MINUTE_RETENTION = f"now() - interval '{float(MINUTE_ROLLUP_RETENTION_DAYS):g} days'"
+ROLLUP_GRANULARITY = (
+    "granularity = CASE"
+    " WHEN $__timeTo()::timestamptz - $__timeFrom()::timestamptz > interval '2 days'"
+    f" OR $__timeFrom()::timestamptz < {MINUTE_RETENTION} THEN 'hour'"
+    " ELSE 'minute' END"
+)
+
+
+def stage_timing_panels(start_id, start_y):
+    """
+    Build one time series panel per percentile, with a series per RAG stage.
+
+    The summary table averages the bucket percentiles weighted by request
+    count, an approximation of the percentile over the whole range.
+    """
+    panels = []
+    stage_list = ", ".join(f"'{stage}'" for stage in STAGES)
+    for i, (label, _) in enumerate(PERCENTILES):
+        panels.append({
+            "datasource": {"type": "postgres", "uid": None},
+            "fieldConfig": {"defaults": {"unit": "ms"}, "overrides": []},
+            "gridPos": {"h": 8, "w": 8, "x": 8 * i, "y": start_y},
+            "id": start_id + i,
+            "options": {"legend": {"displayMode": "list", "placement": "bottom"}},
+            "targets": [{
+                "datasource": {"type": "postgres", "uid": None},
+                "editorMode": "code",
+                "format": "time_series",
+                "rawQuery": True,
+                "rawSql": (
+                    "SELECT\n"
+                    "  bucket AS time,\n"
+                    "  stage AS metric,\n"
+                    f"  {label} AS value\n"
+                    "FROM stage_timing_rollups\n"
+                    f"WHERE $__timeFilter(bucket) AND {ROLLUP_GRANULARITY} AND stage IN ({stage_list})\n"
+                    "ORDER BY 1"
+                ),
+                "refId": "A",
+            }],
+            "title": f"Stage latency {label}",
+            "type": "timeseries",
+        })
+
+    panels.append({
+        "datasource": {"type": "postgres", "uid": None},
+        "fieldConfig": {"defaults": {"unit": "ms"}, "overrides": []},
+        "gridPos": {"h": 8, "w": 24, "x": 0, "y": start_y + 8},
+        "id": start_id + len(PERCENTILES),
+        "targets": [{
+            "datasource": {"type": "postgres", "uid": None},
+            "editorMode": "code",
+            "format": "table",
+            "rawQuery": True,
+            "rawSql": (
+                "SELECT\n"
+                "  stage,\n"
+                + "".join(
+                    f"  SUM({label} * requests) / SUM(requests) AS {label},\n"
+                    for label, _ in PERCENTILES
+                )
+                + "  SUM(requests) AS requests\n"
+                "FROM stage_timing_rollups\n"
+                f"WHERE $__timeFilter(bucket) AND {ROLLUP_GRANULARITY}\n"
+                "GROUP BY stage\n"
+                "ORDER BY p95 DESC"
+            ),
+            "refId": "A",
+        }],
+        "title": "Stage latency percentiles",
+        "type": "table",
+    })
+    return panels
+
+
+def add_stage_timing_panels(dashboard_json):
+    panels = dashboard_json.setdefault("panels", [])
+    titles = {panel.get("title") for panel in panels}
+    next_id = max((panel.get("id", 0) for panel in panels), default=0) + 1
+    next_y = max((panel["gridPos"]["y"] + panel["gridPos"]["h"] for panel in panels), default=0)
+
+    for panel in stage_timing_panels(next_id, next_y):
+        if panel["title"] not in titles:
+            panels.append(panel)
+
+
+def set_minute_retention(dashboard_json):
+    for panel in dashboard_json.get("panels", []):
+        for target in panel.get("targets", []):
+            if "rawSql" in target:
+                target["rawSql"] = target["rawSql"].replace(DASHBOARD_MINUTE_RETENTION, MINUTE_RETENTION)
+
+
 def create_dashboard(api_key, datasource_uid):
     headers = {
         "Authorization": f"Bearer {api_key}",
@@ -135,6 +241,9 @@ def create_dashboard(api_key, datasource_uid):
 
     print("Dashboard JSON loaded successfully.")
 
+    add_stage_timing_panels(dashboard_json)
+    set_minute_retention(dashboard_json)
+
     # Update datasource UID in the dashboard JSON
     panels_updated = 0
     for panel in dashboard_json.get("panels", []):
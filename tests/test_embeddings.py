@@ -0,0 +1,43 @@
+import json
+
+import pytest
+
+pytest.importorskip("sentence_transformers")
+
+import embeddings
+
+MIN_COSINE = 0.98
+NUM_TEXTS = 20
+
+
+@pytest.fixture(scope="module")
+def texts():
+    with open(embeddings.DATA_PATH) as f:
+        documents = json.load(f)
+    half = NUM_TEXTS // 2
+    # Short questions and long question+answer texts, as in embeddings.parity
+    questions = [doc["question"] for doc in documents[:half]]
+    return questions + [doc["question"] + " " + doc["answer"] for doc in documents[half:NUM_TEXTS]]
+
+
+@pytest.fixture(scope="module")
+def reference():
+    if not embeddings.MODEL_NAME:
+        pytest.skip("MODEL_NAME is not set")
+    try:
+        return embeddings.SentenceTransformerBackend()
+    except OSError as e:
+        # The model is neither cached nor downloadable
+        pytest.skip(f"embedding model unavailable: {e}")
+
+
+@pytest.mark.parametrize("name", ["quantized", "onnx"])
+def test_backend_matches_the_reference(name, reference, texts):
+    if name == "onnx":
+        pytest.importorskip("onnxruntime")
+    backend = embeddings.get_backend(name)
+    if backend.name != name:
+        pytest.skip(f"{name} backend fell back to {backend.name}")
+
+    cosine = embeddings._cosine_rows(reference.encode(texts), backend.encode(texts))
+    assert cosine.min() >= MIN_COSINE, f"{name} min cosine {cosine.min():.4f}"
@@ -0,0 +1,33 @@
+import os
+import sys
+import json
+import subprocess
+
+MODULES = ["db", "rag", "ingest", "minsearch2"]
+HEAVY_MODULES = ["torch", "sentence_transformers", "openai", "sklearn", "tiktoken"]
+IMPORT_TIME_BUDGET = float(os.getenv("IMPORT_TIME_BUDGET", "1.5"))
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+
+PROBE = """
+import sys, json, time
+start = time.perf_counter()
+for name in {modules!r}:
+    __import__(name)
+elapsed = time.perf_counter() - start
+heavy = [name for name in {heavy!r} if name in sys.modules]
+print(json.dumps({{"seconds": elapsed, "heavy": heavy}}))
+"""
+
+
+def measure(modules):
+    # A fresh interpreter, so nothing is already imported
+    code = PROBE.format(modules=modules, heavy=HEAVY_MODULES)
+    result = subprocess.run([sys.executable, "-c", code], cwd=APP_DIR, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_app_modules_import_quickly():
+    # The fastest of a few runs, so a busy machine does not fail the test
+    best = min((measure(MODULES) for _ in range(3)), key=lambda run: run["seconds"])
+    assert best["seconds"] <= IMPORT_TIME_BUDGET, f"importing {', '.join(MODULES)} took {best['seconds']:.3f}s"
+    assert not best["heavy"], f"heavy modules imported eagerly: {', '.join(best['heavy'])}"
@@ -0,0 +1,152 @@
+import time
+
+import openai
+import pytest
+
+import fake_openai
+import llm_scheduler
+from llm_client import CircuitBreaker, CircuitOpenError, DeadlineExceededError, LLMGateway
+
+MESSAGES = [{"role": "user", "content": "What is glaucoma?"}]
+
+
+@pytest.fixture
+def server():
+    server, url = fake_openai.start_server(config=fake_openai.FakeOpenAIConfig(latency=0, jitter=0))
+    yield server, url
+    server.shutdown()
+    server.server_close()
+
+
+def make_gateway(url, **kwargs):
+    kwargs.setdefault("hedge", False)
+    kwargs.setdefault("backoff_base", 0.01)
+    return LLMGateway(base_url=url, api_key="x", **kwargs)
+
+
+def test_retries_a_server_error(server):
+    server, url = server
+    server.config.error_rate = 1.0
+    gateway = make_gateway(url)
+
+    def recover(attempt, error):
+        server.config.error_rate = 0.0
+        return 0.0
+
+    gateway._backoff = recover
+    response = gateway.chat("gpt-4o-mini", MESSAGES)
+    assert response.choices[0].message.content
+    assert gateway.stats["retries"] == 1
+    assert gateway.breaker.state == "closed"
+
+
+def test_retries_are_charged_to_the_scheduler(server, monkeypatch):
+    server, url = server
+    server.config.error_rate = 1.0
+    monkeypatch.setattr(llm_scheduler, "estimate_prompt_tokens", lambda messages, model: 100)
+    scheduler = llm_scheduler.LLMScheduler(limits={"gpt-4o-mini": (60, 6000)}, headroom=1.0)
+    gateway = make_gateway(url, max_retries=2, breaker=CircuitBreaker(failure_threshold=10),
+                           on_extra_attempt=scheduler.charge)
+    gateway._backoff = lambda attempt, error: 0.0
+
+    with pytest.raises(openai.InternalServerError):
+        gateway.chat("gpt-4o-mini", MESSAGES)
+    budget = scheduler.budgets["gpt-4o-mini"]
+    assert scheduler.stats()["extra_attempts"]["gpt-4o-mini"] == 2
+    assert budget.requests.level == pytest.approx(58, abs=0.5)
+    assert budget.tokens.level == pytest.approx(6000 - 2 * (100 + llm_scheduler.LLM_COMPLETION_ESTIMATE), abs=50)
+
+
+def test_gives_up_after_max_retries(server):
+    server, url = server
+    server.config.error_rate = 1.0
+    gateway = make_gateway(url, max_retries=2, breaker=CircuitBreaker(failure_threshold=10))
+
+    with pytest.raises(openai.InternalServerError):
+        gateway.chat("gpt-4o-mini", MESSAGES)
+    assert gateway.stats["retries"] == 2
+
+
+def test_breaker_opens_and_recovers(server):
+    server, url = server
+    server.config.error_rate = 1.0
+    gateway = make_gateway(url, max_retries=0, breaker=CircuitBreaker(failure_threshold=2, reset_timeout=0.2))
+
+    for _ in range(2):
+        with pytest.raises(openai.InternalServerError):
+            gateway.chat("gpt-4o-mini", MESSAGES)
+    assert gateway.breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        gateway.chat("gpt-4o-mini", MESSAGES)
+
+    server.config.error_rate = 0.0
+    time.sleep(0.25)
+    gateway.chat("gpt-4o-mini", MESSAGES)
+    assert gateway.breaker.state == "closed"
+
+
+def test_non_retryable_error_is_not_retried(server):
+    server, url = server
+    server.config.error_rate = 1.0
+    server.config.error_status = 400
+    gateway = make_gateway(url)
+
+    with pytest.raises(openai.BadRequestError):
+        gateway.chat("gpt-4o-mini", MESSAGES)
+    assert gateway.stats["retries"] == 0
+
+
+def test_non_retryable_errors_do_not_open_breaker(server):
+    server, url = server
+    server.config.error_rate = 1.0
+    server.config.error_status = 400
+    gateway = make_gateway(url, breaker=CircuitBreaker(failure_threshold=2))
+
+    for _ in range(3):
+        with pytest.raises(openai.BadRequestError):
+            gateway.chat("gpt-4o-mini", MESSAGES)
+    assert gateway.breaker.state == "closed"
+    assert gateway.breaker.failures == 0
+
+
+def test_non_retryable_error_during_trial_call_reopens_breaker(server):
+    server, url = server
+    server.config.error_rate = 1.0
+    server.config.error_status = 400
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.2)
+    breaker.record_failure()
+    gateway = make_gateway(url, breaker=breaker)
+
+    time.sleep(0.25)
+    with pytest.raises(openai.BadRequestError):
+        gateway.chat("gpt-4o-mini", MESSAGES)
+    assert breaker.state == "open"
+
+    # The breaker lets the next trial call through rather than staying stuck half open
+    server.config.error_rate = 0.0
+    time.sleep(0.25)
+    gateway.chat("gpt-4o-mini", MESSAGES)
+    assert breaker.state == "closed"
+
+
+def test_streaming_answer_is_collected(server):
+    server, url = server
+    server.config.completion_tokens = 25
+    gateway = make_gateway(url)
+
+    response = gateway.chat("gpt-4o-mini", MESSAGES, stream=True, stream_options={"include_usage": True})
+    assert response.content == " ".join(["answer"] * 25)
+    assert response.usage.completion_tokens == 25
+
+
+def test_deadline_is_enforced_while_streaming(server):
+    server, url = server
+    # Ten words per chunk: five chunks 0.8 s apart, each within the attempt timeout
+    server.config.completion_tokens = 50
+    server.config.token_latency = 0.8
+    gateway = make_gateway(url, attempt_timeout=1)
+
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceededError):
+        gateway.chat("gpt-4o-mini", MESSAGES, deadline=2, stream=True)
+    assert time.monotonic() - start < 3